@@ -0,0 +1,417 @@
+"""Offline benchmarks for the switchboard, admission control under floods, the game engine (including audience votes and games coming and going),
+decks and the deadline scheduler, run against the fakes in Benchmarks/Fakes.py.
+
+Usage (from the repository root):
+
+    python -m Benchmarks.Benchmarks [--quick] [--save results.json] [--compare baseline.json] [--tolerance 1.2]
+
+Results are a flat JSON object of metric name -> number (plus a "meta" entry), so that two runs can be compared key by key. Metrics ending in
+_per_s are better when higher; every other metric is a time, better when lower. With --compare, any metric worse than the baseline by more than
+the tolerance factor is reported and the exit status is 1.
+"""
+from time import perf_counter
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import random
+import sys
+import weakref
+
+from Benchmarks.Fakes import FakeWorld
+from Objs.Admission.Admission import AdmissionControl
+from Objs.CardsAgainstGovernance.CardsAgainstGovernance import CardsAgainstGovernance, CARDS_PER_PLAYER
+from Objs.Deck.Deck import CardCatalog, Deck
+from Objs.DiscordSwitchboard.DiscordSwitchboard import DiscordSwitchboard, MessageEnvelope, PriorityLevel
+from Objs.Metrics.Metrics import MetricsRegistry
+from Objs.Outbox.Outbox import Outbox
+from Objs.Scheduler.Scheduler import DeadlineScheduler
+
+SWITCHBOARD_HANDLERS = (10, 100, 1000, 10000)
+SWITCHBOARD_MESSAGES = 5000
+FLOOD_MESSAGES = (1000, 10000, 100000)
+FLOOD_PLAYERS = 200  # Players with a command in the flood, each sending one, spread evenly through it
+FLOOD_RATE = 20000  # Messages per second the flood arrives at: more than the handlers can keep up with, but not more than shedding can
+FLOOD_HANDLER_SECONDS = 50e-6  # CPU time each handler takes
+GAME_PLAYERS = (3, 10, 30, 100)
+GAME_ROUNDS = 10
+VOTE_VOTERS = (100, 1000, 10000)
+VOTE_PLAYERS = 10
+CHURN_GAMES = (100, 1000)
+CHURN_PLAYERS = 3
+DECK_SIZES = (1000, 10000, 100000)
+DECK_DEALS = 200
+SCHEDULER_TIMERS = (1000, 100000)
+
+QUICK_SWITCHBOARD_HANDLERS = (10, 1000)
+QUICK_SWITCHBOARD_MESSAGES = 500
+QUICK_FLOOD_MESSAGES = (1000, 10000)
+QUICK_GAME_PLAYERS = (3, 30)
+QUICK_GAME_ROUNDS = 3
+QUICK_VOTE_VOTERS = (100, 1000)
+QUICK_CHURN_GAMES = (100,)
+QUICK_DECK_SIZES = (1000, 100000)
+QUICK_DECK_DEALS = 20
+QUICK_SCHEDULER_TIMERS = (1000, 10000)
+
+
+def _AllTasks():
+    try:
+        return asyncio.all_tasks()
+    except AttributeError:  # Python < 3.7
+        return asyncio.Task.all_tasks()
+
+
+# Lets every other task run until there is nothing left to do. Always yields at least twice, so that tasks started by other tasks get going too.
+async def Settle():
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    while len([task for task in _AllTasks() if not task.done()]) > 1:
+        await asyncio.sleep(0)
+
+
+def Percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def _Summarize(results, prefix, durations):
+    durations.sort()
+    results[prefix + ".p50_us"] = Percentile(durations, 0.5) * 1e6
+    results[prefix + ".p99_us"] = Percentile(durations, 0.99) * 1e6
+    results[prefix + ".throughput_per_s"] = len(durations) / sum(durations)
+
+
+# on_message with handler_count per-player DM handlers registered (as Players do), plus a game-channel handler. Half the messages are DMs that hit
+# a handler, half are chatter in a channel that nothing listens to. With metrics, the switchboard is instrumented as it is in the bot.
+async def BenchSwitchboard(results, handler_counts, message_count, metrics=False):
+    for handler_count in handler_counts:
+        world = FakeWorld()
+        switchboard = DiscordSwitchboard(lanes=True, metrics=MetricsRegistry() if metrics else None)
+
+        async def output(message):
+            return True
+        for x in range(handler_count):
+            switchboard.RegisterOutput(output, PriorityLevel.PRIORITY, is_private=True, author_id=str(x))
+        switchboard.RegisterOutput(output, PriorityLevel.PRIORITY, channel_id="game", command="!choose")
+        rng = random.Random(handler_count)
+        messages = []
+        for x in range(message_count):
+            if x % 2:
+                messages.append(world.PrivateMessage("!submit 1", str(rng.randrange(handler_count))))
+            else:
+                messages.append(world.ChannelMessage("just chatting", str(rng.randrange(handler_count)), "chatter"))
+        durations = []
+        for message in messages:
+            start = perf_counter()
+            await switchboard.on_message(message)
+            durations.append(perf_counter() - start)
+        _Summarize(results, "switchboard{}.handlers_{}".format("_metrics" if metrics else "", handler_count), durations)
+
+
+# A flood of flood_count messages arriving at FLOOD_RATE, as after a raid or a reconnect: chatter, spammers repeating a command in a busy channel and
+# mentions from many one-off authors, with an in-game DM from each of FLOOD_PLAYERS players spread through it. Every output takes
+# FLOOD_HANDLER_SECONDS and yields once, as real handlers do. Measures how long the players' commands take from arrival to being handled, which
+# should stay flat however long the flood goes on, and the time to get through the flood per message, which is 1e6 / FLOOD_RATE us for as long as
+# it keeps up; without admission, everything is dispatched, so handling falls behind as the flood goes on, as a baseline.
+# Messages are handed over as they fall due, between turns of the event loop, as the gateway reads them. (Were they all handed over at once, every
+# message's latency would include a pass over all the others, whatever admission did.)
+async def BenchFlood(results, flood_counts, admit=True):
+    for flood_count in flood_counts:
+        world = FakeWorld()
+        switchboard = DiscordSwitchboard(lanes=True)
+        player_ids = [str(x) for x in range(FLOOD_PLAYERS)]
+        every = flood_count // FLOOD_PLAYERS
+
+        async def output(message):
+            end = perf_counter() + FLOOD_HANDLER_SECONDS
+            while perf_counter() < end:
+                pass
+            await asyncio.sleep(0)
+            return True
+        for player_id in player_ids:
+            switchboard.RegisterOutput(output, PriorityLevel.PRIORITY, is_private=True, author_id=player_id)
+        switchboard.RegisterOutput(output, PriorityLevel.PRIORITY, channel_id="busy")
+
+        def from_player(envelope):
+            return envelope.is_private and envelope.author_id in switchboard.priority_relay.Authors()
+        admission = None if not admit else AdmissionControl(lambda envelope: envelope.command is not None and envelope.command.startswith("!") or
+                                                            world.client.user.id in envelope.mention_ids, from_player, author_exempt=from_player)
+        rng = random.Random(flood_count)
+        messages = []
+        for x in range(flood_count):
+            if x % every == 0:
+                messages.append((True, world.PrivateMessage("!submit 1", player_ids[x // every])))
+            elif x % 3 == 0:
+                messages.append((False, world.ChannelMessage("just chatting", "c{}".format(rng.randrange(1000)), "busy")))
+            elif x % 3 == 1:
+                messages.append((False, world.ChannelMessage("!cardhelp", "s{}".format(rng.randrange(10)), "busy")))
+            else:
+                messages.append((False, world.MentionBot("m{}".format(x), "busy")))
+        durations = []
+        shed_players = []
+
+        # Latency is counted from when the message was due, so a handover that has fallen behind counts too.
+        async def arrive(is_player, message, due):
+            envelope = MessageEnvelope(message)
+            if admission is None:
+                admitted = True
+                await switchboard.on_message(message, envelope)
+            else:
+                admitted = await admission.Run(envelope, lambda: switchboard.on_message(message, envelope))
+            if is_player:
+                (durations if admitted else shed_players).append(perf_counter() - due)
+        start = perf_counter()
+        pending = set()
+        arrived = 0
+        while arrived < flood_count:
+            due = min(flood_count, int((perf_counter() - start) * FLOOD_RATE) + 1)
+            for x in range(arrived, due):
+                task = asyncio.ensure_future(arrive(*messages[x], start + x / FLOOD_RATE))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            arrived = due
+            await asyncio.sleep(0)
+        if pending:
+            await asyncio.wait(pending)
+        elapsed = perf_counter() - start
+        if shed_players:
+            raise RuntimeError("{} player commands were shed: {}".format(len(shed_players), admission.Stats()))
+        prefix = "flood{}.messages_{}".format("" if admit else "_unadmitted", flood_count)
+        results[prefix + ".per_message_us"] = elapsed / flood_count * 1e6
+        _Summarize(results, prefix + ".player", durations)
+
+
+def MakeCards(player_count, rounds):
+    questions = CardCatalog.FromList([("Question {}".format(x), 1, {"num_answers": 1}) for x in range(rounds + 5)])
+    answers = CardCatalog.FromList([("Answer {}".format(x), 1, None) for x in range((CARDS_PER_PLAYER + rounds) * player_count)])
+    return (questions, questions.DeckIds()), (answers, answers.DeckIds())
+
+
+# Whole rounds (every player submits, the czar chooses, the next turn is set up) of one game with player_count players. Player DMs and channel
+# messages go through a root switchboard and the game's scope, and outbound messages through an unpaced Outbox, exactly as in the bot.
+async def BenchGame(results, player_counts, rounds):
+    for player_count in player_counts:
+        world = FakeWorld()
+        root = DiscordSwitchboard(lanes=True)
+        outbox = Outbox(world.client, rate=1e9, burst=1e9)
+        channel = world.Channel("game")
+        game = CardsAgainstGovernance(root.CreateScope(channel_id=channel.id), channel, world.client, MakeCards(player_count, rounds), outbox)
+        player_ids = [str(x + 1) for x in range(player_count)]
+        for player_id in player_ids:
+            await root.on_message(world.MentionBot(player_id, channel.id))
+        await root.on_message(world.ChannelMessage("!startcardsgame", player_ids[0], channel.id))
+        await Settle()
+        durations = []
+        for round_number in range(rounds):
+            start = perf_counter()
+            for player_id in player_ids:
+                await root.on_message(world.PrivateMessage("!submit 0", player_id))
+            await Settle()
+            await root.on_message(world.ChannelMessage("!choose 0", game.cur_czar.user.id, channel.id))
+            await Settle()
+            durations.append(perf_counter() - start)
+            if sum(points for _, points in game.score.values()) != round_number + 1:
+                raise RuntimeError("Round {} of the {} player game did not complete".format(round_number, player_count))
+        await outbox.Flush()
+        prefix = "game.players_{}".format(player_count)
+        durations.sort()
+        results[prefix + ".round_p50_ms"] = Percentile(durations, 0.5) * 1e3
+        results[prefix + ".round_max_ms"] = durations[-1] * 1e3
+        results[prefix + ".messages_sent"] = len(world.client.sent)
+
+
+# game_count games, one after the other, each played for a round on one switchboard shared by all of them (no scopes) and then ended, as over weeks
+# of a bot's life. Fails if any game or player outlives its game, or if anything is left registered.
+async def BenchChurn(results, game_counts):
+    for game_count in game_counts:
+        world = FakeWorld()
+        root = DiscordSwitchboard(lanes=True)
+        outbox = Outbox(world.client, rate=1e9, burst=1e9)
+        player_ids = [str(x + 1) for x in range(CHURN_PLAYERS)]
+        survivors = weakref.WeakSet()
+        durations = []
+        for game_number in range(game_count):
+            start = perf_counter()
+            channel = world.Channel("game{}".format(game_number))
+            game = CardsAgainstGovernance(root, channel, world.client, MakeCards(CHURN_PLAYERS, 1), outbox)
+            for player_id in player_ids:
+                await root.on_message(world.MentionBot(player_id, channel.id))
+            await root.on_message(world.ChannelMessage("!startcardsgame", player_ids[0], channel.id))
+            for player_id in player_ids:
+                await root.on_message(world.PrivateMessage("!submit 0", player_id))
+            await Settle()
+            await root.on_message(world.ChannelMessage("!choose 0", game.cur_czar.user.id, channel.id))
+            game.EndGame()
+            await Settle()
+            survivors.add(game)
+            survivors.update(game.players)
+            del game
+            durations.append(perf_counter() - start)
+            await outbox.Flush()
+        gc.collect()
+        left = root.LiveHandlers()
+        if left or survivors:
+            raise RuntimeError("{} games left {} outputs registered and {} games and players alive".format(game_count, len(left), len(survivors)))
+        durations.sort()
+        results["churn.games_{}.game_p50_ms".format(game_count)] = Percentile(durations, 0.5) * 1e3
+
+
+# Making a deck, dealing hands from it, and the deal that has to reshuffle the discard back in.
+def BenchDeck(results, sizes, deals):
+    for size in sizes:
+        catalog = CardCatalog.FromList([("Card {}".format(x), 1, None) for x in range(size)])
+        card_ids = catalog.DeckIds()
+        prefix = "deck.size_{}".format(size)
+
+        start = perf_counter()
+        for _ in range(deals):
+            deck = Deck(catalog, card_ids)
+            deck.Deal(CARDS_PER_PLAYER)
+        results[prefix + ".create_and_first_deal_us"] = (perf_counter() - start) / deals * 1e6
+
+        deck = Deck(catalog, card_ids)
+        deck.Deal(1)
+        start = perf_counter()
+        for _ in range(deals):
+            deck.ReturnMany(deck.Deal(CARDS_PER_PLAYER))
+        results[prefix + ".deal_us"] = (perf_counter() - start) / deals * 1e6
+
+        durations = []
+        for _ in range(max(1, deals // 20)):
+            deck.ReturnMany(deck.Deal(len(deck.draw_pool)))  # Empty the draw pool into the discard
+            start = perf_counter()
+            deck.Deal(CARDS_PER_PLAYER)
+            durations.append(perf_counter() - start)
+        results[prefix + ".reshuffle_deal_us"] = sum(durations) / len(durations) * 1e6
+
+
+# A flood of audience votes on one turn of an audience game: every voter votes once and a tenth of them change their vote, through a root
+# switchboard and the game's scope as in the bot, and then the vote is closed.
+async def BenchVotes(results, voter_counts):
+    for voter_count in voter_counts:
+        world = FakeWorld()
+        root = DiscordSwitchboard(lanes=True)
+        outbox = Outbox(world.client, rate=1e9, burst=1e9)
+        channel = world.Channel("game")
+        game = CardsAgainstGovernance(root.CreateScope(channel_id=channel.id), channel, world.client, MakeCards(VOTE_PLAYERS, 1), outbox,
+                                      audience=True)
+        player_ids = [str(x + 1) for x in range(VOTE_PLAYERS)]
+        for player_id in player_ids:
+            await root.on_message(world.MentionBot(player_id, channel.id))
+        await root.on_message(world.ChannelMessage("!startcardsgame", player_ids[0], channel.id))
+        for player_id in player_ids:
+            await root.on_message(world.PrivateMessage("!submit 0", player_id))
+        await Settle()
+        rng = random.Random(voter_count)
+        voter_ids = ["v{}".format(x) for x in range(voter_count)]
+        messages = [world.ChannelMessage("!vote {}".format(rng.randrange(VOTE_PLAYERS)), voter_id, channel.id)
+                    for voter_id in voter_ids + voter_ids[:voter_count // 10]]
+        durations = []
+        for message in messages:
+            start = perf_counter()
+            await root.on_message(message)
+            durations.append(perf_counter() - start)
+        if sum(game.tallies) != voter_count:
+            raise RuntimeError("{} votes were cast but {} counted".format(voter_count, sum(game.tallies)))
+        start = perf_counter()
+        await root.on_message(world.ChannelMessage("!closevote", game.cur_czar.user.id, channel.id))
+        prefix = "votes.voters_{}".format(voter_count)
+        results[prefix + ".close_us"] = (perf_counter() - start) * 1e6
+        _Summarize(results, prefix, durations)
+        await outbox.Flush()
+
+
+# Arming, rescheduling (as every submission pushes a game along) and cancelling timer_count timers, then firing the survivors, on a fake clock.
+def BenchScheduler(results, timer_counts):
+    for timer_count in timer_counts:
+        now = [0.0]
+        scheduler = DeadlineScheduler(clock=lambda: now[0])
+        rng = random.Random(timer_count)
+        prefix = "scheduler.timers_{}".format(timer_count)
+
+        def callback():
+            pass
+        start = perf_counter()
+        timers = [scheduler.Schedule(rng.uniform(1, 600), callback) for _ in range(timer_count)]
+        results[prefix + ".schedule_us"] = (perf_counter() - start) / timer_count * 1e6
+
+        start = perf_counter()
+        timers = [scheduler.Reschedule(timer, rng.uniform(1, 600)) for timer in timers]
+        results[prefix + ".reschedule_us"] = (perf_counter() - start) / timer_count * 1e6
+
+        start = perf_counter()
+        for timer in timers[::2]:
+            timer.Cancel()
+        results[prefix + ".cancel_us"] = (perf_counter() - start) / (timer_count // 2) * 1e6
+
+        now[0] = 600
+        start = perf_counter()
+        fired = scheduler.RunDue()
+        results[prefix + ".fire_us"] = (perf_counter() - start) / max(1, fired) * 1e6
+
+
+def Run(quick=False):
+    results = {}
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        for metrics in (False, True):
+            loop.run_until_complete(BenchSwitchboard(results, QUICK_SWITCHBOARD_HANDLERS if quick else SWITCHBOARD_HANDLERS,
+                                                     QUICK_SWITCHBOARD_MESSAGES if quick else SWITCHBOARD_MESSAGES, metrics))
+        for admit in (False, True):
+            loop.run_until_complete(BenchFlood(results, QUICK_FLOOD_MESSAGES if quick else FLOOD_MESSAGES, admit))
+        loop.run_until_complete(BenchGame(results, QUICK_GAME_PLAYERS if quick else GAME_PLAYERS, QUICK_GAME_ROUNDS if quick else GAME_ROUNDS))
+        loop.run_until_complete(BenchVotes(results, QUICK_VOTE_VOTERS if quick else VOTE_VOTERS))
+        loop.run_until_complete(BenchChurn(results, QUICK_CHURN_GAMES if quick else CHURN_GAMES))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    BenchDeck(results, QUICK_DECK_SIZES if quick else DECK_SIZES, QUICK_DECK_DEALS if quick else DECK_DEALS)
+    BenchScheduler(results, QUICK_SCHEDULER_TIMERS if quick else SCHEDULER_TIMERS)
+    results["meta"] = {"python": platform.python_version(), "platform": platform.platform(), "quick": quick}
+    return results
+
+
+# Returns a list of (metric, baseline, current, ratio) for every metric that got worse by more than tolerance. Ratios are always >= 1 for worse.
+def Compare(baseline, current, tolerance):
+    regressions = []
+    for metric, value in sorted(current.items()):
+        if metric == "meta" or metric not in baseline or metric.endswith(".messages_sent"):
+            continue
+        old = baseline[metric]
+        if not old or not value:
+            continue
+        ratio = old / value if metric.endswith("_per_s") else value / old
+        if ratio > tolerance:
+            regressions.append((metric, old, value, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--quick", action="store_true", help="smaller sizes, for a fast sanity check")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against a baseline JSON file written by --save")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="how much worse than the baseline a metric may be (default 1.2x)")
+    args = parser.parse_args(argv)
+
+    results = Run(args.quick)
+    for metric, value in sorted(results.items()):
+        if metric != "meta":
+            print("{:<55} {:>14.2f}".format(metric, value))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = Compare(json.load(f), results, args.tolerance)
+        for metric, old, new, ratio in regressions:
+            print("REGRESSION {}: {:.2f} -> {:.2f} ({:.2f}x worse)".format(metric, old, new, ratio))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
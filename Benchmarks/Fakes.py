@@ -0,0 +1,101 @@
+"""Stand-ins for the parts of the discord API the bot uses, so that the switchboard and games can be driven without a connection.
+
+Only the attributes the code actually reads are modelled: message.content/author/channel/mentions, user.id/name,
+channel.id/is_private/permissions_for (only manage_channels, for the users in channel.managers), and client.user/send_message/edit_message/logout. Sent and edited messages are recorded on the client in order.
+"""
+from collections import namedtuple
+from itertools import count
+
+FakePermissions = namedtuple("FakePermissions", ["manage_channels"])
+
+
+class FakeUser:
+    def __init__(self, id, name=None):
+        self.id = id
+        self.name = "User" + id if name is None else name
+
+    def __repr__(self):
+        return "FakeUser(" + self.id + ")"
+
+
+class FakeChannel:
+    def __init__(self, id, is_private=False):
+        self.id = id
+        self.is_private = is_private
+        self.managers = set()  # Ids of the users allowed to manage the channel
+
+    def permissions_for(self, member):
+        return FakePermissions(member.id in self.managers)
+
+    def __repr__(self):
+        return "FakeChannel(" + self.id + ")"
+
+
+class FakeMessage:
+    _ids = count(1)
+
+    def __init__(self, content, author, channel, mentions=()):
+        self.id = str(next(self._ids))
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.mentions = list(mentions)
+
+
+class FakeClient:
+    def __init__(self, bot_id="0"):
+        self.user = FakeUser(bot_id, "CardsBot")
+        self.sent = []  # (destination id, content), in send order. Edits are ("edit", message id, content).
+        self._private_channels = {}
+
+    async def send_message(self, destination, content):
+        self.sent.append((destination.id, content))
+        channel = destination if isinstance(destination, FakeChannel) else self._PrivateChannel(destination)
+        return FakeMessage(content, self.user, channel)
+
+    async def edit_message(self, message, new_content):
+        self.sent.append(("edit", message.id, new_content))
+        message.content = new_content
+        return message
+
+    async def logout(self):
+        pass
+
+    def _PrivateChannel(self, user):
+        channel = self._private_channels.get(user.id)
+        if channel is None:
+            channel = self._private_channels[user.id] = FakeChannel("dm" + user.id, is_private=True)
+        return channel
+
+
+# Keeps one FakeUser per id and one FakeChannel per channel id, and makes messages between them, so that identity comparisons behave as with discord.
+class FakeWorld:
+    def __init__(self, bot_id="0"):
+        self.client = FakeClient(bot_id)
+        self.users = {}
+        self.channels = {}
+
+    # name, if given, becomes the user's name from then on.
+    def User(self, user_id, name=None):
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = FakeUser(user_id, name)
+        elif name is not None:
+            user.name = name
+        return user
+
+    def Channel(self, channel_id):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = FakeChannel(channel_id)
+        return channel
+
+    def ChannelMessage(self, content, author_id, channel_id, mentions=()):
+        return FakeMessage(content, self.User(author_id), self.Channel(channel_id), (self.User(x) for x in mentions))
+
+    def MentionBot(self, author_id, channel_id):
+        return FakeMessage("<@" + self.client.user.id + ">", self.User(author_id), self.Channel(channel_id), [self.client.user])
+
+    def PrivateMessage(self, content, author_id):
+        author = self.User(author_id)
+        return FakeMessage(content, author, self.client._PrivateChannel(author))
@@ -0,0 +1,155 @@
+"""Replays a trace recorded by the bot (see TRACE_FILE in CardsBot.py and Objs/Trace) through the whole bot, against the fakes in Benchmarks/Fakes.py,
+and checks that it still sends exactly what it sent when the trace was recorded.
+
+Usage (from the repository root; makes no connection, and doesn't need the discord library):
+
+    python -m Benchmarks.Replay trace.jsonl [--realtime] [--save results.json] [--compare baseline.json] [--tolerance 1.2]
+
+Messages are fed to Cardsbot.on_message one at a time, each handled to completion before the next, as fast as possible or, with --realtime, at
+the pace they were recorded. Either way the turn deadline scheduler runs on the trace's clock, so turns time out between the same messages as they
+did when recording, and admission control's token buckets run on it too. The bot is seeded with the recorded seed, so every game deals the same cards.
+
+Results are reported and compared like Benchmarks.py's. The exit status is 1 if the bot's output differs from the recording (the first difference
+is printed) or, with --compare, if a metric regressed.
+"""
+from time import perf_counter
+import argparse
+import asyncio
+import json
+import platform
+import sys
+
+from Benchmarks.Benchmarks import Compare, Settle, _Summarize
+from Benchmarks.Fakes import FakeChannel, FakeMessage, FakeWorld
+from CardsBot import Cardsbot
+from Objs.Admission.Admission import AdmissionControl
+from Objs.Outbox.Outbox import Outbox
+from Objs.Scheduler.Scheduler import DeadlineScheduler
+from Objs.Trace.Trace import ReadTrace, TracedOutbox
+
+
+# Collects what the bot sends, in the form a trace records it.
+class _Capture:
+    def __init__(self):
+        self.sent = []
+
+    def RecordSend(self, destination, content):
+        self.sent.append([destination.id, content])
+
+
+def _Message(world, record):
+    content, author_id, author_name, channel_id, is_private, mention_ids = record[2:8]
+    channel = world.channels.get(channel_id)
+    if channel is None:
+        channel = world.channels[channel_id] = FakeChannel(channel_id, is_private)
+    if len(record) > 8 and record[8]:  # Older traces don't say whether the author manages the channel.
+        channel.managers.add(author_id)
+    bot_user = world.client.user
+    mentions = [bot_user if user_id == bot_user.id else world.User(user_id) for user_id in mention_ids]
+    return FakeMessage(content, world.User(author_id, author_name), channel, mentions)
+
+
+# Returns (what the bot sent, what the trace says it sent, how long each message took to handle, total seconds).
+async def Replay(header, records, realtime=False):
+    world = FakeWorld(header["bot_user"][0])
+    world.client.user.name = header["bot_user"][1]
+    capture = _Capture()
+    now = [0.0]
+    bot = Cardsbot(state_directory=None, metrics_file=None, outbox=TracedOutbox(Outbox(world.client, rate=1e9, burst=1e9), capture),
+                   trace_file=None, seed=header["seed"], leaderboard_file=None)
+    bot.client = world.client
+    bot.scheduler = DeadlineScheduler(clock=lambda: now[0])
+    bot.admission = AdmissionControl(bot.IsRelevant, bot.IsUrgent, bot.IsAudienceVote, bot.IsPlayerCommand, clock=lambda: now[0])
+    await bot.on_ready()
+    bot.scheduler.Stop()  # Driven by hand below, on the trace's clock.
+
+    expected = []
+    durations = []
+    start = perf_counter()
+    for record in records:
+        kind = record[0]
+        if kind == "out":
+            expected.append(record[2:])
+            continue
+        if realtime:
+            delay = start + record[1] - perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        # Timers fire at their own deadlines, so that a timeout that sets up the next one (e.g. a skipped turn) goes on as it did live.
+        while True:
+            deadline = bot.scheduler.NextDeadline()
+            if deadline is None or deadline > record[1]:
+                break
+            now[0] = deadline
+            bot.scheduler.RunDue()
+            await Settle()
+        now[0] = record[1]
+        if kind == "in":
+            began = perf_counter()
+            await bot.on_message(_Message(world, record))
+            await Settle()
+            durations.append(perf_counter() - began)
+    elapsed = perf_counter() - start
+    await bot.outbox.Flush()
+    return capture.sent, expected, durations, elapsed
+
+
+# Returns None if sent matches expected, or a description of the first difference.
+def FirstDifference(sent, expected):
+    for x, (got, wanted) in enumerate(zip(sent, expected)):
+        if got != wanted:
+            return "message {} sent: expected {!r}, got {!r}".format(x, wanted, got)
+    if len(sent) != len(expected):
+        return "expected {} messages sent, got {}".format(len(expected), len(sent))
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("trace", help="a trace file recorded by the bot")
+    parser.add_argument("--realtime", action="store_true", help="replay at the pace the trace was recorded")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against a baseline JSON file written by --save")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="how much worse than the baseline a metric may be (default 1.2x)")
+    args = parser.parse_args(argv)
+
+    header, records = ReadTrace(args.trace)
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        sent, expected, durations, elapsed = loop.run_until_complete(Replay(header, records, args.realtime))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    results = {"meta": {"python": platform.python_version(), "platform": platform.platform(), "trace": args.trace, "realtime": args.realtime,
+                        "messages_received": len(durations)}}
+    if durations:
+        _Summarize(results, "replay", durations)
+    results["replay.elapsed_s"] = elapsed
+    results["replay.messages_sent"] = len(sent)
+    for metric, value in sorted(results.items()):
+        if metric != "meta":
+            print("{:<55} {:>14.2f}".format(metric, value))
+    status = 0
+    difference = FirstDifference(sent, expected)
+    if difference is None:
+        print("Output matches the trace ({} messages received, {} sent)".format(len(durations), len(sent)))
+    else:
+        print("OUTPUT DIFFERS from the trace at " + difference)
+        status = 1
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = Compare(json.load(f), results, args.tolerance)
+        for metric, old, new, ratio in regressions:
+            print("REGRESSION {}: {:.2f} -> {:.2f} ({:.2f}x worse)".format(metric, old, new, ratio))
+        if regressions:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,77 +3,499 @@
 # Purpose:
 # For the indexing and querying of text
 
-import discord
-import asyncio
-import pickle
+try:
+    import discord
+except ImportError:  # Only needed to connect; everything else runs without it, e.g. Benchmarks/Replay.py.
+    discord = None
 import random
 import secrets
-import re
-import time
-import threading
-from Objs.DiscordSwitchboard.DiscordSwitchboard import DiscordSwitchboard, PriorityLevel
+import logging
+import os
+import sqlite3
+from functools import partial
+from Objs.DiscordSwitchboard.DiscordSwitchboard import DiscordSwitchboard, MessageEnvelope
 from Objs.CardsAgainstGovernance.CardsAgainstGovernance import CardsAgainstGovernance
-from Objs.Deck.Deck import Card
-from Configs.CardList import QuestionsList, AnswersList
+from Objs.CardPack.CardPack import PackLibrary, DeckTemplateCache
+from Objs.Outbox.Outbox import Outbox, NullOutbox
+from Objs.GameStore.GameStore import GameStore
+from Objs.Scheduler.Scheduler import DeadlineScheduler
+from Objs.Metrics.Metrics import MetricsRegistry, PrometheusFileWriter
+from Objs.Sharding.Sharding import RemoteUser, ShardGateway
+from Objs.Trace.Trace import TraceRecorder, TracedOutbox
+from Objs.Leaderboard.Leaderboard import Leaderboard, ALL_TIME
+from Objs.Admission.Admission import AdmissionControl, SHED_REASONS
+from Configs.CardList import PACK_DIRECTORY, COMPILED_PACK_DIRECTORY, DEFAULT_PACKS
 
 ADMIN_ID = "192729741395099648"
-CHANNEL = "484621382810992661"
+METRICS_FILE = "cardsbot.prom"  # Rewritten every METRICS_INTERVAL seconds in the Prometheus text format. None to disable.
+METRICS_INTERVAL = 15
+STATE_DIRECTORY = "GameState"  # Live games are journaled and snapshotted here, and restored from it on startup. None to disable.
+SNAPSHOT_INTERVAL = 300  # Seconds. Bounds how much journal a restart has to replay.
+SHUTDOWN_GRACE = 5  # Seconds in-flight handlers get to finish on shutdown before they are cancelled
+WORKERS = 0  # Game worker processes behind a gateway process (see Objs/Sharding). 0 runs the games in the same process as the connection.
+LEADERBOARD_FILE = "leaderboard.sqlite3"  # SQLite database of rounds won across games (see Objs/Leaderboard), shared by every worker. None to disable.
+LEADERBOARD_SIZE = 10  # Players listed by !leaderboard
+LEADERBOARD_UNAVAILABLE = "Couldn't read the leaderboard just now. Try again in a moment."
+LEAK_REPORT_SIZE = 20  # Owners listed by !cardleaks
+TRACE_FILE = None  # Every message received and sent is recorded here, for replaying with Benchmarks/Replay.py (see Objs/Trace). Not used with WORKERS.
+
+logger = logging.getLogger(__name__)
 
 HELP_MESSAGE = """```
 Welcome to Cards Bot
+
+!cardpreparegame [audience] [pack ...]
+                             Start setting up a game in this channel with the given card packs (one game per channel). In an audience game,
+                             everyone in the channel votes on the responses instead of the czar choosing one.
+!cardpacks                   List the available card packs
+!cardendgame                 End the game in this channel (its players and the channel's managers only)
+!leaderboard [global] [alltime]
+                             The players who won the most rounds in this channel (or everywhere) this month (or ever)
+!stats [@user]               Your (or someone's) rounds won and rank, this month and ever
 ```"""
 
 
+# Finds the user with user_id, falling back to a bare user (which is enough to DM them) if they aren't in any server the client can see. Without
+# the discord library, the bare user is a RemoteUser stand-in.
+def ResolveUser(client, user_id, name):
+    for user in client.get_all_members():
+        if user.id == user_id:
+            return user
+    return RemoteUser(user_id, name) if discord is None else discord.User(username=name, id=user_id)
+
+
+# state_directory, metrics_file, trace_file and leaderboard_file override STATE_DIRECTORY, METRICS_FILE, TRACE_FILE and LEADERBOARD_FILE.
+# Messages go through admission control (see Objs/Admission and on_message) unless admission is False, e.g. when a gateway has already done it. outbox is made on_ready if it isn't given.
+# Every game's seed is drawn from seed (a random one if it isn't given), so a bot given the same seed and the same messages plays the same games.
 class Cardsbot:
-    def __init__(self):
-        # For now we assume only one game at a time. We can try doing more in the future as necessary.
-        self.game_started = False
-        self.game = None
-        self.game_lock = threading.Lock()
-
-    @staticmethod
-    def MakeCards():
-        questions_list = []
-        # Make cards
-        for card_param in QuestionsList:
-            for _ in range(card_param[1]):
-                questions_list.append(Card(card_param[0], card_param[2]))
-        answers_list = []
-        for card_param in AnswersList:
-            for _ in range(card_param[1]):
-                answers_list.append(Card(card_param[0], card_param[2]))
-        return questions_list, answers_list
+    def __init__(self, state_directory=STATE_DIRECTORY, metrics_file=METRICS_FILE, outbox=None, trace_file=TRACE_FILE, seed=None,
+                 leaderboard_file=LEADERBOARD_FILE, admission=True):
+        # Live games, keyed by the id of the channel they are played in. Each game gets its own scope of the switchboard. Only ever touched from the
+        # event loop, so it needs no lock.
+        self.games = {}
+        self.client = None
+        self.switchboard = None
+        self.outbox = outbox  # Shared by every game, so that pacing is per destination across games.
+        self.state_directory = state_directory
+        self.metrics_file = metrics_file
+        self.trace_file = trace_file
+        self.trace = None
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.random = random.Random(self.seed)
+        # Packs are compiled and memory-mapped on first use, and shared by every game. Decks are built once per pack selection and shared by
+        # every game using it until the game's copy changes.
+        self.pack_library = PackLibrary(PACK_DIRECTORY, COMPILED_PACK_DIRECTORY)
+        self.deck_templates = DeckTemplateCache(self.pack_library)
+        self.metrics = MetricsRegistry()
+        self.metrics_writer = None
+        self.store = None
+        self.leaderboard_file = leaderboard_file
+        self.leaderboard = None
+        self.scheduler = DeadlineScheduler()  # Turn timeouts for every game
+        self.admission = AdmissionControl(self.IsRelevant, self.IsUrgent, self.IsAudienceVote, self.IsPlayerCommand) if admission else None
+        # Command word -> handler(message, envelope). See on_message.
+        self.commands = {"!help": self.HelpCommand,
+                         "!cardshutdown": self.ShutdownCommand,
+                         "!cardmetrics": self.MetricsCommand,
+                         "!cardcheck": self.CheckCommand,
+                         "!cardleaks": self.LeaksCommand,
+                         "!cardpreparegame": self.PrepareGameCommand,
+                         "!cardpacks": self.PacksCommand,
+                         "!cardendgame": self.EndGameCommand,
+                         "!leaderboard": self.LeaderboardCommand,
+                         "!stats": self.StatsCommand}
+
+    # Raises KeyError if a pack doesn't exist.
+    def MakeCards(self, pack_names=DEFAULT_PACKS):
+        template = self.deck_templates.Get(pack_names)
+        return (template.questions_catalog, template.question_ids), (template.answers_catalog, template.answer_ids)
+
+    # Returns the new game, or None if the channel already has one. Raises KeyError if a pack doesn't exist. See CardsAgainstGovernance for audience.
+    def CreateGame(self, channel, pack_names=DEFAULT_PACKS, audience=False):
+        if channel.id in self.games:
+            return None
+        cards = self.MakeCards(pack_names)
+        scope = self.switchboard.CreateScope("game-{}".format(channel.id), channel_id=channel.id)
+        seed = self.random.getrandbits(64)
+        journal = None if self.store is None else self.store.Journal(channel.id)
+        record_win = None if self.leaderboard is None else self.leaderboard.Recorder(channel.id)
+        game = CardsAgainstGovernance(scope, channel, self.client, cards, self.outbox, journal=journal, seed=seed, scheduler=self.scheduler,
+                                      record_win=record_win, audience=audience)
+        if self.store is not None:
+            self.store.Add(channel.id, {"packs": tuple(pack_names), "seed": seed, "audience": audience}, game)
+        self.games[channel.id] = game
+        return game
+
+    # Rebuilds the games GameStore.Load returned. Each is rebuilt muted, so replaying it doesn't repeat its messages, and then told to carry on.
+    def RestoreGames(self, saved_games):
+        for channel_id, (header, state, events) in saved_games.items():
+            channel = self.client.get_channel(channel_id)
+            if channel is None:
+                logger.warning("Dropping the game in channel %s, which no longer exists", channel_id)
+                continue
+            scope = self.switchboard.CreateScope("game-{}".format(channel_id), channel_id=channel_id)
+            try:
+                game = CardsAgainstGovernance(scope, channel, self.client, self.MakeCards(header["packs"]), NullOutbox(), seed=header["seed"],
+                                              state=state, resolve_user=self.ResolveUser, scheduler=self.scheduler,
+                                              audience=header.get("audience", False))
+                for event in events:
+                    game.ApplyEvent(event)
+            except Exception:
+                logger.exception("Couldn't restore the game in channel %s", channel_id)
+                scope.Detach()
+                continue
+            game.SetOutbox(self.outbox)
+            game.journal = self.store.Journal(channel_id)
+            if self.leaderboard is not None:
+                game.record_win = self.leaderboard.Recorder(channel_id)
+            self.store.Track(channel_id, header, game)
+            self.games[channel_id] = game
+            game.Resume()
+
+    # Finds the user a restored player was.
+    def ResolveUser(self, user_id, name):
+        return ResolveUser(self.client, user_id, name)
+
+    def GetGame(self, channel_id):
+        return self.games.get(channel_id)
+
+    # Returns False if there was no game in the channel.
+    def EndGame(self, channel_id):
+        game = self.games.pop(channel_id, None)
+        if game is None:
+            return False
+        if self.store is not None:
+            self.store.Remove(channel_id)
+        game.EndGame()
+        return True
+
+    async def on_ready(self):
+        self.switchboard = DiscordSwitchboard(lanes=True, metrics=self.metrics)
+        if self.outbox is None:
+            self.outbox = Outbox(self.client)
+        if self.trace_file is not None and self.trace is None:
+            self.trace = TraceRecorder(self.trace_file, self.seed, (self.client.user.id, self.client.user.name))
+            self.outbox = TracedOutbox(self.outbox, self.trace)
+        self.metrics.Gauge("cardsbot_games", "Live games", function=lambda: len(self.games))
+        self.metrics.Gauge("switchboard_live_handlers", "Outputs registered with the switchboard and its scopes",
+                           function=lambda: len(self.switchboard.LiveHandlers()))
+        self.metrics.Gauge("tasks_in_flight", "Supervised tasks started and not yet done", function=lambda: self.switchboard.tasks.Stats()["in_flight"])
+        self.metrics.Gauge("tasks_waiting", "Supervised tasks waiting for a slot under their concurrency limit",
+                           function=lambda: self.switchboard.tasks.Stats()["waiting"])
+        self.metrics.Counter("tasks_failed_total", "Supervised tasks that raised", function=lambda: self.switchboard.tasks.Stats()["errors"])
+        self.metrics.Counter("tasks_cancelled_total", "Supervised tasks cancelled, e.g. when their game ended",
+                             function=lambda: self.switchboard.tasks.Stats()["cancelled"])
+        if self.admission is not None:
+            self.metrics.Counter("admission_admitted_total", "Messages admitted for dispatch", function=lambda: self.admission.admitted)
+            self.metrics.Gauge("admission_in_flight", "Messages being dispatched", function=lambda: self.admission.in_flight)
+            self.metrics.Gauge("admission_queued", "Messages waiting for a dispatch slot", function=lambda: self.admission.Stats()["queued"])
+            for reason in SHED_REASONS:
+                self.metrics.Counter("admission_shed_total", "Messages shed before dispatch",
+                                     function=lambda reason=reason: self.admission.shed[reason], reason=reason)
+        self.metrics.Gauge("outbox_queued_messages", "Messages waiting to be sent", function=lambda: self.outbox.GetStats()["queued"])
+        self.metrics.Gauge("outbox_max_queue_depth", "Longest queue to a single destination", function=lambda: self.outbox.GetStats()["max_queue_depth"])
+        self.metrics.Counter("outbox_sends_total", "send_message and edit_message calls made", function=lambda: self.outbox.sends)
+        self.metrics.Counter("outbox_edits_total", "Keyed messages delivered by editing the previous one", function=lambda: self.outbox.edits)
+        self.metrics.Counter("outbox_replaced_total", "Keyed messages replaced before they were sent", function=lambda: self.outbox.replaced)
+        self.metrics.Counter("outbox_failed_total", "Messages that failed to send", function=lambda: self.outbox.failed)
+        if self.metrics_file is not None and self.metrics_writer is None:
+            self.metrics_writer = PrometheusFileWriter(self.metrics, self.metrics_file, METRICS_INTERVAL)
+            self.metrics_writer.Start()
+        self.scheduler.Start()
+        if self.leaderboard_file is not None and self.leaderboard is None:
+            self.leaderboard = Leaderboard(self.leaderboard_file)
+            self.leaderboard.Start()
+            self.metrics.Gauge("leaderboard_pending_wins", "Rounds won not yet written to the leaderboard",
+                               function=lambda: len(self.leaderboard.pending))
+            self.metrics.Counter("leaderboard_written_wins_total", "Rounds won written to the leaderboard", function=lambda: self.leaderboard.flushed)
+            self.metrics.Counter("leaderboard_flushes_total", "Batches written to the leaderboard", function=lambda: self.leaderboard.flushes)
+        if self.state_directory is not None and self.store is None:
+            self.store = GameStore(self.state_directory, SNAPSHOT_INTERVAL)
+            self.RestoreGames(self.store.Load())
+            await self.store.Snapshot()  # Folds what was just replayed into a fresh snapshot.
+            self.store.Start()
+            if self.trace is not None and self.games:
+                logger.warning("Tracing to %s with %d restored games; the trace won't replay exactly", self.trace_file, len(self.games))
+
+    # The message is parsed once here, and the same envelope is handed down to the switchboard and the games' handlers. Admission control sheds
+    # messages nothing could handle, and floods, before any of that.
+    async def on_message(self, message):
+        if self.trace is not None:
+            self.trace.RecordMessage(message)
+        envelope = MessageEnvelope(message)
+        if self.admission is None:
+            await self.Dispatch(message, envelope)
+        else:
+            await self.admission.Run(envelope, partial(self.Dispatch, message, envelope))
+
+    # Only commands and mentions of the bot are ever handled.
+    def IsRelevant(self, envelope):
+        return envelope.command is not None or self.client.user.id in envelope.mention_ids
+
+    # Messages in a game's channel, and DMs from players, go ahead of everything else under load.
+    def IsUrgent(self, envelope):
+        if envelope.is_private:
+            return envelope.author_id in self.switchboard.priority_relay.Authors()
+        return envelope.channel_id in self.games
+
+    # Votes in an audience game come from a crowd of authors in one channel all at once, so they skip the channel's bucket; each voter's own
+    # bucket still applies.
+    def IsAudienceVote(self, envelope):
+        if envelope.command != "!vote":
+            return False
+        game = self.games.get(envelope.channel_id)
+        return game is not None and game.audience
+
+    # Players, and commands to a channel's game, skip their author's bucket, so that a quick run of a player's commands isn't shed; the channel's
+    # bucket still applies. Audience votes skip the channel's bucket instead, so each voter's own bucket is what holds back a voter flooding.
+    def IsPlayerCommand(self, envelope):
+        if envelope.author_id in self.switchboard.priority_relay.Authors():
+            return True
+        game = self.games.get(envelope.channel_id)
+        return game is not None and envelope.command in game.channel_commands and not (game.audience and envelope.command == "!vote")
+
+    # For the gateway's admission control, when running in a worker (see CardsbotGateway): channel id -> (whether the channel's game is an
+    # audience game, the commands it takes in the channel).
+    def ChannelInfo(self):
+        return {channel_id: (game.audience, game.channel_commands) for channel_id, game in self.games.items()}
+
+    async def Dispatch(self, message, envelope):
+        command = envelope.command
+        if command is not None:
+            handler = self.commands.get(command)
+            if handler is not None and await handler(message, envelope):
+                return
+        await self.switchboard.on_message(message, envelope)
+
+    # The bot's own commands. Each returns True if it handled the message, or False to let the message through to the games.
+    async def HelpCommand(self, message, envelope):
+        if envelope.content != "!help cardbot":
+            return False
+        self.outbox.Send(message.channel, HELP_MESSAGE)
+        return True
+
+    async def ShutdownCommand(self, message, envelope):
+        if envelope.args or envelope.author_id != ADMIN_ID:
+            return False
+        await self.Shutdown()
+        await self.client.logout()
+        return True
+
+    # Lets in-flight handlers finish (for up to SHUTDOWN_GRACE seconds), then saves the games and sends whatever is still queued.
+    async def Shutdown(self):
+        if not await self.switchboard.tasks.Join(SHUTDOWN_GRACE):
+            logger.warning("Cancelling %d tasks still running at shutdown", self.switchboard.tasks.Cancel())
+        if self.store is not None:
+            await self.store.Stop()
+        self.scheduler.Stop()
+        if self.leaderboard is not None:
+            await self.leaderboard.Stop()
+            self.leaderboard = None
+        if self.metrics_writer is not None:
+            self.metrics_writer.Stop()
+            self.metrics_writer = None
+        if self.trace is not None:
+            self.trace.Close()
+        await self.outbox.Flush()
+
+    async def MetricsCommand(self, message, envelope):
+        if envelope.args or envelope.author_id != ADMIN_ID:
+            return False
+        self.outbox.Send(message.author, "```\n" + (self.metrics.Summary() or "No metrics yet.") + "\n```")
+        return True
+
+    # Checks that every card of every live game is accounted for.
+    async def CheckCommand(self, message, envelope):
+        if envelope.args or envelope.author_id != ADMIN_ID:
+            return False
+        report = []
+        for channel_id, game in list(self.games.items()):
+            problems = game.CheckCards()
+            report.append(str(channel_id) + ": " + ("; ".join(problems) if problems else "all cards accounted for"))
+        self.outbox.Send(message.author, "\n".join(report) or "No games.")
+        return True
+
+    # Lists who has outputs registered with the switchboard, oldest first, marking what's left of games that are no longer live: a bot that has run
+    # for weeks should list about as much as one that just started.
+    async def LeaksCommand(self, message, envelope):
+        if envelope.args or envelope.author_id != ADMIN_ID:
+            return False
+        handlers = self.switchboard.LiveHandlers()
+        owners = {}  # owner -> [outputs, oldest age]
+        for path, owner, relay_name, name, age in handlers:
+            owner = owner or "{} {}".format(path, name)
+            counts = owners.setdefault(owner, [0, 0])
+            counts[0] += 1
+            counts[1] = max(counts[1], age or 0)
+        lines = []
+        for owner, (number, age) in sorted(owners.items(), key=lambda x: x[1][1], reverse=True)[:LEAK_REPORT_SIZE]:
+            game = owner.split()[0]
+            over = game.startswith("game-") and game[len("game-"):] not in self.games
+            lines.append("{}: {} output{}, oldest {:.1f}h{}".format(owner, number, "" if number == 1 else "s", age / 3600,
+                                                                   " (game over)" if over else ""))
+        if len(owners) > LEAK_REPORT_SIZE:
+            lines.append("... and {} more owners".format(len(owners) - LEAK_REPORT_SIZE))
+        self.outbox.Send(message.author, "```\n{} outputs registered, {} live games\n{}\n```".format(len(handlers), len(self.games), "\n".join(lines)))
+        return True
+
+    async def PrepareGameCommand(self, message, envelope):
+        if envelope.is_private:
+            return False
+        args = envelope.args
+        audience = bool(args) and args[0].lower() == "audience"
+        pack_names = (args[1:] if audience else args) or DEFAULT_PACKS
+        try:
+            game = self.CreateGame(message.channel, pack_names, audience)
+        except KeyError as e:
+            self.outbox.Send(message.channel, "There is no card pack called " + str(e) + ". Try !cardpacks.")
+            return True
+        if game is None:
+            self.outbox.Send(message.channel, "A game is already running here. End it with !cardendgame first.")
+        return True
+
+    async def PacksCommand(self, message, envelope):
+        if envelope.args or envelope.is_private:
+            return False
+        self.outbox.Send(message.channel, "Card packs: " + ", ".join(self.pack_library.Names()))
+        return True
+
+    # Only the game's players, and those who can manage the channel, can end a game.
+    async def EndGameCommand(self, message, envelope):
+        if envelope.args or envelope.is_private:
+            return False
+        game = self.games.get(envelope.channel_id)
+        if game is None:
+            return True
+        if (envelope.author_id not in game.score and envelope.author_id != ADMIN_ID and
+                not message.channel.permissions_for(message.author).manage_channels):
+            self.outbox.Send(message.channel, "Only the game's players or the channel's managers can end it.")
+            return True
+        self.EndGame(envelope.channel_id)
+        return True
         
+    # Lists the top LEADERBOARD_SIZE players of this channel (or, with "global" or by DM, of every channel) this season (or, with "alltime", ever).
+    async def LeaderboardCommand(self, message, envelope):
+        if self.leaderboard is None or not set(envelope.args) <= {"global", "alltime"}:
+            return False
+        channel_id = None if envelope.is_private or "global" in envelope.args else envelope.channel_id
+        season = ALL_TIME if "alltime" in envelope.args else self.leaderboard.Season()
+        try:
+            top = await self.leaderboard.Top(LEADERBOARD_SIZE, season, channel_id)
+        except sqlite3.Error:
+            logger.exception("Couldn't read the leaderboard")
+            self.outbox.Send(message.channel, LEADERBOARD_UNAVAILABLE)
+            return True
+        title = "Rounds won {}, {}".format("everywhere" if channel_id is None else "in this channel", "ever" if season == ALL_TIME else "in " + season)
+        lines = ["{:>2}. {} - {}".format(x + 1, name, points) for x, (name, points) in enumerate(top)]
+        self.outbox.Send(message.channel, "```\n" + title + "\n" + ("\n".join(lines) or "Nobody yet.") + "\n```")
+        return True
+
+    # A player's rounds won and rank across every channel, this season and ever. About the first user mentioned, or whoever asked.
+    async def StatsCommand(self, message, envelope):
+        if self.leaderboard is None:
+            return False
+        user = next((user for user in message.mentions if user.id != self.client.user.id), message.author)
+        name = user.name  # Mentions relayed from the gateway carry no name, but the leaderboard has the name they last won under.
+        lines = []
+        for season in (self.leaderboard.Season(), ALL_TIME):
+            try:
+                rank = await self.leaderboard.Rank(user.id, season)
+            except sqlite3.Error:
+                logger.exception("Couldn't read the leaderboard")
+                self.outbox.Send(message.channel, LEADERBOARD_UNAVAILABLE)
+                return True
+            when = "ever" if season == ALL_TIME else "in " + season
+            if rank is None:
+                lines.append("no rounds won " + when)
+            else:
+                lines.append("{} rounds won {} (#{})".format(rank[1], when, rank[0]))
+                name = rank[2] or name
+        self.outbox.Send(message.channel, (name or "That player") + ": " + "; ".join(lines))
+        return True
+
     def main(self):
-        client = discord.Client()
-        
-        @client.event
-        async def on_ready():
-            self.switchboard = DiscordSwitchboard()
-            self.switchboard.MustHave(channel_id=CHANNEL, is_private=True, any=True)   # We're not using it for any other channel right now, so let's just ahead and do this.
-
-        @client.event
-        async def on_message(message):
-            this_message = message.content.lower()
-            if this_message == "!help cardbot":
-                await client.send_message(message.channel, HELP_MESSAGE)
-                return
-            if this_message == '!cardshutdown' and message.author.id == ADMIN_ID:
-                await client.logout()
-                return
-            # We do this explicitly here for clarity but in the future the class can take care of it.
-            if this_message == '!cardpreparegame' and message.channel.id == CHANNEL and not self.game_started:
-                with self.game_lock:
-                    self.game = CardsAgainstGovernance(self.switchboard, message.channel, client, self.MakeCards())
-                    self.game_started = True
-                return
-            await self.switchboard.on_message(message)                  
-                
+        self.client = discord.Client()
+        self.client.event(self.on_ready)
+        self.client.event(self.on_message)
+        # Blocking. Must be last.
+        self.client.run(secrets.BOT_TOKEN)
+
+
+# Makes the Cardsbot that runs in a worker process. Each worker keeps its own state and metrics files, as each hosts its own games, but they all share
+# the leaderboard.
+def MakeShardHost(shard, client, outbox):
+    state_directory = None if STATE_DIRECTORY is None else os.path.join(STATE_DIRECTORY, "shard-{}".format(shard))
+    metrics_file = None
+    if METRICS_FILE is not None:
+        root, extension = os.path.splitext(METRICS_FILE)
+        metrics_file = "{}-shard-{}{}".format(root, shard, extension)
+    bot = Cardsbot(state_directory, metrics_file, outbox, trace_file=None, admission=False)
+    bot.client = client
+    return bot
+
+
+# The gateway process when running with WORKERS: it only owns the discord connection. Messages are routed to the workers (see ShardGateway), and
+# what the workers send comes back through this process's Outbox, so pacing still covers every game. Messages nothing could handle, and floods, are
+# shed here before they cost a trip to a worker; routing is only a queue put, so nothing waits for a dispatch slot.
+class CardsbotGateway:
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.client = None
+        self.outbox = None
+        self.gateway = None
+        self.admission = AdmissionControl(self.IsRelevant, None, self.IsAudienceVote, self.IsPlayerCommand)
+
+    def IsRelevant(self, envelope):
+        return envelope.command is not None or self.client.user.id in envelope.mention_ids
+
+    # The games live in the workers, so these go by what the workers last reported: the players whose DMs they want, and each game's ChannelInfo.
+    # See Cardsbot.IsAudienceVote and Cardsbot.IsPlayerCommand.
+    def IsAudienceVote(self, envelope):
+        if envelope.command != "!vote":
+            return False
+        info = self.gateway.channels.get(envelope.channel_id)
+        return info is not None and info[0]
+
+    def IsPlayerCommand(self, envelope):
+        if envelope.author_id in self.gateway.routes:
+            return True
+        info = self.gateway.channels.get(envelope.channel_id)
+        return info is not None and envelope.command in info[1] and not (info[0] and envelope.command == "!vote")
+
+    async def on_ready(self):
+        if self.outbox is None:
+            self.outbox = Outbox(self.client)
+        if self.gateway is None:
+            self.gateway = ShardGateway(self.workers, MakeShardHost, (self.client.user.id, self.client.user.name), self.Deliver)
+            self.gateway.Start()
+
+    def Deliver(self, kind, destination_id, name, content, key):
+        destination = self.client.get_channel(destination_id) if kind == "channel" else ResolveUser(self.client, destination_id, name)
+        if destination is None:
+            logger.warning("Dropping a message to %s %s, which can't be found", kind, destination_id)
+            return
+        self.outbox.Send(destination, content, key)
+
+    async def on_message(self, message):
+        if self.gateway is None:
+            return
+        if message.content.lower() == "!cardshutdown" and message.author.id == ADMIN_ID:
+            await self.gateway.Stop()
+            await self.outbox.Flush()
+            await self.client.logout()
+            return
+        if self.admission.Check(MessageEnvelope(message)):
+            self.gateway.Route(message)
+
+    def main(self):
+        self.client = discord.Client()
+        self.client.event(self.on_ready)
+        self.client.event(self.on_message)
         # Blocking. Must be last.
-        client.run(secrets.BOT_TOKEN)
+        self.client.run(secrets.BOT_TOKEN)
 
 if __name__ == '__main__':
-    bot = Cardsbot()
+    bot = CardsbotGateway() if WORKERS else Cardsbot()
     bot.main()
     
     
@@ -1,8 +1,9 @@
-# Might be json or something in future, but this is convenient.
+import os
 
-# Second value is how many of each card to make, third is additional data (in the case of CVG it ends up used to mark how many cards to play in response)
-QuestionsList = (("Question 1", 10, {"num_answers": 1}),
-                 ("Question 2", 10, {"num_answers": 1}))
-                
-AnswersList = (("Answer 1", 10, None),
-               ("Answer 2", 10, None))
\ No newline at end of file
+# Card packs live in PACK_DIRECTORY as JSON Lines or CSV files (see Objs/CardPack/CardPack.py for the format), and are compiled into
+# COMPILED_PACK_DIRECTORY the first time they are used.
+PACK_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Packs")
+COMPILED_PACK_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "CompiledPacks")
+
+# Used when !cardpreparegame doesn't name any packs. In CVG, question card data is used to mark how many cards to play in response.
+DEFAULT_PACKS = ("Base",)
@@ -0,0 +1,159 @@
+"""Admission control for inbound messages: decides, before a message reaches the switchboard, whether it's worth handling at all and, under load,
+which messages go first and which are shed.
+
+Usage:
+
+1. Make an AdmissionControl(relevant, priority), where relevant(envelope) says whether a message could be handled at all (e.g. it's a command or
+   mentions the bot) and priority(envelope) whether it's urgent (e.g. part of a live game). channel_exempt(envelope), if given, says whether a
+   message skips its channel's bucket, e.g. a vote in an audience game, where a crowd of authors in one channel is the point. author_exempt(envelope),
+   if given, says whether a message skips its author's bucket, e.g. a player's command to their game, so that a quick run of them isn't shed.
+2. Instead of dispatching each message directly, await admission.Run(envelope, dispatch), which calls await dispatch() if the message is admitted
+   and returns whether it was.
+3. Stats() gives the counts of messages admitted and shed, by reason (see SHED_REASONS), and how many are in flight or waiting.
+
+In order, a message is shed if it isn't relevant, which costs nothing but the check; if its author, or its channel, has run out of tokens in their
+token bucket (see Outbox.TokenBucket); or if it has to wait and the wait queue is full. At most max_in_flight messages are dispatched at once; the
+rest wait, urgent messages ahead of the others, and an urgent message that finds the queue full takes the place of the newest waiting non-urgent one.
+Messages of the same switchboard lane (see DiscordSwitchboard.LaneKey) are never reordered: an urgent message whose lane has a non-urgent message
+waiting waits behind it, as non-urgent.
+
+Buckets are kept for the bucket_limit most recently seen authors and channels; a forgotten one starts again full. Everything here is meant to be used
+from the event loop thread.
+"""
+from collections import OrderedDict, deque
+import asyncio
+import logging
+import time
+
+from ..DiscordSwitchboard.DiscordSwitchboard import DiscordSwitchboard
+from ..Outbox.Outbox import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+AUTHOR_RATE = 1.0  # Messages per second an author can keep up (players' commands to their games are exempt, see author_exempt)
+AUTHOR_BURST = 8  # Messages an author can send at once
+CHANNEL_RATE = 50.0  # Messages per second a channel can keep up (audience votes are exempt, see channel_exempt)
+CHANNEL_BURST = 200
+MAX_IN_FLIGHT = 64  # Messages dispatched at once
+QUEUE_LIMIT = 1024  # Messages waiting for a dispatch slot
+BUCKET_LIMIT = 10000  # Authors (and, separately, channels) whose buckets are kept
+SHED_REASONS = ("irrelevant", "author_rate", "channel_rate", "queue_full", "displaced")
+
+
+class AdmissionControl:
+    def __init__(self, relevant, priority, channel_exempt=None, author_exempt=None, author_rate=AUTHOR_RATE, author_burst=AUTHOR_BURST,
+                 channel_rate=CHANNEL_RATE, channel_burst=CHANNEL_BURST, max_in_flight=MAX_IN_FLIGHT, queue_limit=QUEUE_LIMIT, bucket_limit=BUCKET_LIMIT,
+                 clock=time.monotonic):
+        self.relevant = relevant
+        self.priority = priority
+        self.channel_exempt = channel_exempt
+        self.author_exempt = author_exempt
+        self.author_rate = author_rate
+        self.author_burst = author_burst
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.max_in_flight = max_in_flight
+        self.queue_limit = queue_limit
+        self.bucket_limit = bucket_limit
+        self.clock = clock
+        self._authors = OrderedDict()  # author id -> TokenBucket, least recently seen first
+        self._channels = OrderedDict()  # channel id -> TokenBucket, likewise
+        self._urgent = deque()  # (lane key, future) of the messages waiting for a slot, in arrival order
+        self._normal = deque()
+        self._normal_lanes = {}  # lane key -> messages of that lane in _normal
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = dict.fromkeys(SHED_REASONS, 0)
+
+    def _Take(self, buckets, key, rate, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst, self.clock)
+            if len(buckets) > self.bucket_limit:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+        return bucket.TryTake()
+
+    # The checks that don't wait: relevance and the token buckets. Returns whether the message passed them.
+    def Check(self, envelope):
+        if not self.relevant(envelope):
+            self.shed["irrelevant"] += 1
+            return False
+        if ((self.author_exempt is None or not self.author_exempt(envelope)) and
+                not self._Take(self._authors, envelope.author_id, self.author_rate, self.author_burst)):
+            self.shed["author_rate"] += 1
+            return False
+        if (not envelope.is_private and (self.channel_exempt is None or not self.channel_exempt(envelope)) and
+                not self._Take(self._channels, envelope.channel_id, self.channel_rate, self.channel_burst)):
+            self.shed["channel_rate"] += 1
+            return False
+        return True
+
+    async def Run(self, envelope, dispatch):
+        if not self.Check(envelope):
+            return False
+        if self.in_flight < self.max_in_flight and not self._urgent and not self._normal:
+            self.in_flight += 1
+        elif not await self._Wait(envelope):
+            return False
+        self.admitted += 1
+        try:
+            await dispatch()
+        finally:
+            self._Release()
+        return True
+
+    # Waits for a slot, which is handed over by _Release. Returns False if the message was shed instead.
+    async def _Wait(self, envelope):
+        lane = DiscordSwitchboard.LaneKey(envelope)
+        urgent = lane not in self._normal_lanes and self.priority(envelope)
+        if len(self._urgent) + len(self._normal) >= self.queue_limit:
+            if not urgent or not self._normal:
+                self.shed["queue_full"] += 1
+                return False
+            displaced_lane, displaced = self._normal.pop()
+            self._Dequeued(displaced_lane)
+            if not displaced.done():
+                displaced.set_result(False)
+        future = asyncio.get_event_loop().create_future()
+        if urgent:
+            self._urgent.append((lane, future))
+        else:
+            self._normal.append((lane, future))
+            self._normal_lanes[lane] = self._normal_lanes.get(lane, 0) + 1
+        try:
+            admitted = await future  # A waiter cancelled before its turn is skipped over by _Release.
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.result():
+                self._Release()  # Cancelled just after being handed a slot, so pass it on.
+            raise
+        if not admitted:
+            self.shed["displaced"] += 1
+        return admitted
+
+    def _Dequeued(self, lane):
+        count = self._normal_lanes[lane] - 1
+        if count:
+            self._normal_lanes[lane] = count
+        else:
+            del self._normal_lanes[lane]
+
+    # Hands the slot to the next waiting message, urgent ones first, or frees it.
+    def _Release(self):
+        while self._urgent or self._normal:
+            if self._urgent:
+                _, future = self._urgent.popleft()
+            else:
+                lane, future = self._normal.popleft()
+                self._Dequeued(lane)
+            if not future.done():
+                future.set_result(True)
+                return
+        self.in_flight -= 1
+
+    def Stats(self):
+        stats = {"admitted": self.admitted, "in_flight": self.in_flight, "queued": len(self._urgent) + len(self._normal)}
+        for reason, count in self.shed.items():
+            stats["shed_" + reason] = count
+        return stats
@@ -0,0 +1,296 @@
+"""Card packs: streaming loaders for pack source files, and a compiled binary pack format that is memory-mapped and decoded lazily.
+
+Source packs are either JSON Lines (.jsonl), one object per line:
+
+    {"kind": "question", "text": "Question 1", "count": 10, "data": {"num_answers": 1}}
+
+or CSV (.csv) with a header row of kind,text,count,data, where data is JSON (or empty for none). kind is "question" or "answer", count defaults to
+1 and data to None. Blank lines and lines starting with # are skipped in JSON Lines packs.
+
+Sources are streamed row by row and compiled once into a .cpk file (see PackLibrary). A compiled pack is laid out as:
+
+    header      '<4sIIQQQQ': magic, question count, answer count, question counts offset, question index offset, answer counts offset, answer index offset
+    blob        utf-8 card text and JSON-encoded data, back to back, in source order
+    per kind:   counts  (uint32 per card, how many copies a deck has)
+                index   ('<QIQI' per card: text offset, text length, data offset, data length; data length 0 means no data)
+
+Opening a compiled pack only reads the header; card text and data are decoded from the map when a card is looked up, so startup and game setup
+cost don't grow with the size of the pack library.
+"""
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import repeat
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from ..Deck.Deck import Card, CardCatalog
+
+MAGIC = b"CPK1"
+HEADER = struct.Struct('<4sIIQQQQ')
+INDEX_ROW = struct.Struct('<QIQI')
+KINDS = ("question", "answer")
+SOURCE_EXTENSIONS = (".jsonl", ".csv")
+COMPILED_EXTENSION = ".cpk"
+
+
+def _Row(kind, text, count, data, where):
+    if kind not in KINDS:
+        raise ValueError("{}: unknown card kind {!r}".format(where, kind))
+    if not isinstance(text, str) or not text:
+        raise ValueError("{}: card has no text".format(where))
+    count = 1 if count in (None, "") else int(count)
+    if count < 0:
+        raise ValueError("{}: negative card count".format(where))
+    return kind, text, count, data
+
+
+# Yields (kind, text, count, data) for each card in a pack source file, reading it one line at a time.
+def ReadPackSource(path):
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as source:
+            for line_number, line in enumerate(source, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                where = "{}:{}".format(path, line_number)
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    raise ValueError("{}: {}".format(where, e))
+                yield _Row(row.get("kind"), row.get("text"), row.get("count"), row.get("data"), where)
+    elif path.endswith(".csv"):
+        with open(path, encoding="utf-8", newline="") as source:
+            for line_number, row in enumerate(csv.DictReader(source), 2):
+                where = "{}:{}".format(path, line_number)
+                data = row.get("data")
+                try:
+                    data = json.loads(data) if data else None
+                except ValueError as e:
+                    raise ValueError("{}: {}".format(where, e))
+                yield _Row(row.get("kind"), row.get("text"), row.get("count"), data, where)
+    else:
+        raise ValueError("Unknown pack source format: " + path)
+
+
+def _ToLittleEndian(values):
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+# Streams a pack source into a compiled pack at pack_path. The file is written beside pack_path and moved into place when complete.
+def CompilePack(source_path, pack_path):
+    counts = {kind: array('I') for kind in KINDS}
+    index = {kind: bytearray() for kind in KINDS}
+    temp_path = pack_path + ".tmp"
+    with open(temp_path, "wb") as out:
+        out.write(b"\0" * HEADER.size)
+        offset = HEADER.size
+        for kind, text, count, data in ReadPackSource(source_path):
+            text_bytes = text.encode("utf-8")
+            data_bytes = b"" if data is None else json.dumps(data).encode("utf-8")
+            out.write(text_bytes)
+            out.write(data_bytes)
+            counts[kind].append(count)
+            index[kind] += INDEX_ROW.pack(offset, len(text_bytes), offset + len(text_bytes), len(data_bytes))
+            offset += len(text_bytes) + len(data_bytes)
+        sections = []
+        for kind in KINDS:
+            sections.append(offset)
+            counts_bytes = _ToLittleEndian(counts[kind])
+            out.write(counts_bytes)
+            offset += len(counts_bytes)
+            sections.append(offset)
+            out.write(index[kind])
+            offset += len(index[kind])
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, len(counts["question"]), len(counts["answer"]), *sections))
+    os.replace(temp_path, pack_path)
+
+
+# A read-only, memory-mapped compiled pack.
+class BinaryPack:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, question_count, answer_count, question_counts, question_index, answer_counts, answer_index = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(path + " is not a compiled card pack")
+        self._sections = {"question": (question_count, question_counts, question_index),
+                          "answer": (answer_count, answer_counts, answer_index)}
+
+    def Close(self):
+        self._map.close()
+
+    # Copies the pack into memory and closes the map and its file, e.g. so that a recompiled pack can replace the file while the games still using
+    # this one carry on.
+    def Detach(self):
+        if isinstance(self._map, mmap.mmap):
+            data = self._map[:]
+            self._map.close()
+            self._map = data
+
+    def Count(self, kind):
+        return self._sections[kind][0]
+
+    # The number of copies of each card of kind, as an array in card order.
+    def Counts(self, kind):
+        count, counts_offset, _ = self._sections[kind]
+        counts = array('I')
+        counts.frombytes(self._map[counts_offset:counts_offset + 4 * count])
+        if sys.byteorder != "little":
+            counts.byteswap()
+        return counts
+
+    def Card(self, kind, position):
+        count, _, index_offset = self._sections[kind]
+        if not 0 <= position < count:
+            raise IndexError("card position out of range")
+        text_offset, text_length, data_offset, data_length = INDEX_ROW.unpack_from(self._map, index_offset + INDEX_ROW.size * position)
+        text = self._map[text_offset:text_offset + text_length].decode("utf-8")
+        data = json.loads(self._map[data_offset:data_offset + data_length].decode("utf-8")) if data_length else None
+        return Card(text, data)
+
+
+# The cards of one kind from several packs, as one lazily decoded sequence. Card ids run through the packs in order.
+class PackCards:
+    def __init__(self, packs, kind):
+        self.packs = tuple(packs)
+        self.kind = kind
+        self._starts = []
+        total = 0
+        for pack in self.packs:
+            self._starts.append(total)
+            total += pack.Count(kind)
+        self._length = total
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, card_id):
+        if not 0 <= card_id < self._length:
+            raise IndexError("card id out of range")
+        pack_number = bisect_right(self._starts, card_id) - 1
+        return self.packs[pack_number].Card(self.kind, card_id - self._starts[pack_number])
+
+    def Counts(self):
+        counts = array('I')
+        for pack in self.packs:
+            counts.extend(pack.Counts(self.kind))
+        return counts
+
+
+# Returns (questions catalog, answers catalog) for the given open packs, in order.
+def PackCatalogs(packs):
+    catalogs = []
+    for kind in KINDS:
+        cards = PackCards(packs, kind)
+        catalogs.append(CardCatalog(cards, cards.Counts()))
+    return tuple(catalogs)
+
+
+# All the packs in source_directory. Each is compiled into compiled_directory the first time it is used (or when its source is newer than the
+# compiled copy) and stays open afterwards, until its source changes and it is compiled again (see BinaryPack.Detach). Nothing is read until a
+# pack is asked for.
+class PackLibrary:
+    def __init__(self, source_directory, compiled_directory):
+        self.source_directory = source_directory
+        self.compiled_directory = compiled_directory
+        self._open = {}  # name -> (source modification time, BinaryPack)
+
+    # Names of the available packs.
+    def Names(self):
+        names = set()
+        for filename in os.listdir(self.source_directory):
+            name, extension = os.path.splitext(filename)
+            if extension in SOURCE_EXTENSIONS:
+                names.add(name)
+        return sorted(names)
+
+    def _SourcePath(self, name):
+        for extension in SOURCE_EXTENSIONS:
+            path = os.path.join(self.source_directory, name + extension)
+            if os.path.exists(path):
+                return path
+        raise KeyError(name)
+
+    # Returns the open BinaryPack for name, compiling it first if needed. Raises KeyError if there is no such pack.
+    def Open(self, name):
+        if os.sep in name or (os.altsep and os.altsep in name) or name.startswith("."):
+            raise KeyError(name)
+        source_path = self._SourcePath(name)
+        source_time = os.path.getmtime(source_path)
+        opened = self._open.get(name)
+        if opened is not None:
+            if opened[0] == source_time:
+                return opened[1]
+            # Stale. Games already using it carry on with an in-memory copy, so the map can be closed now.
+            del self._open[name]
+            opened[1].Detach()
+        pack_path = os.path.join(self.compiled_directory, name + COMPILED_EXTENSION)
+        if not os.path.exists(pack_path) or os.path.getmtime(pack_path) < source_time:
+            os.makedirs(self.compiled_directory, exist_ok=True)
+            CompilePack(source_path, pack_path)
+        pack = BinaryPack(pack_path)
+        self._open[name] = (source_time, pack)
+        return pack
+
+    # Returns (questions catalog, answers catalog) for the given combination of packs.
+    def Catalogs(self, names):
+        return PackCatalogs([self.Open(name) for name in names])
+
+
+# The card ids of a full, unshuffled deck of each kind, with the catalogs they refer to. The id arrays are shared by every Deck made from the
+# template (Decks copy them on write), so they must never be changed.
+DeckTemplate = namedtuple("DeckTemplate", ["questions_catalog", "question_ids", "answers_catalog", "answer_ids"])
+
+
+# Builds deck templates from a PackLibrary once per combination of packs and copy counts, and hands out the cached template afterwards.
+# A template is rebuilt when any of its packs changes on disk; Invalidate drops templates explicitly.
+class DeckTemplateCache:
+    def __init__(self, library):
+        self.library = library
+        self._templates = {}  # (pack names, copies) -> (packs the template was built from, DeckTemplate)
+        self._lock = threading.Lock()
+
+    # copies overrides every card's count from its pack if given. Raises KeyError if a pack doesn't exist.
+    def Get(self, names, copies=None):
+        names = tuple(names)
+        key = (names, copies)
+        packs = [self.library.Open(name) for name in names]  # Cheap once open: just checks the sources haven't changed.
+        with self._lock:
+            cached = self._templates.get(key)
+            if cached is not None and all(old is new for old, new in zip(cached[0], packs)):
+                return cached[1]
+        questions_catalog, answers_catalog = PackCatalogs(packs)
+        template = DeckTemplate(questions_catalog, self._Ids(questions_catalog, copies), answers_catalog, self._Ids(answers_catalog, copies))
+        with self._lock:
+            self._templates[key] = (packs, template)
+        return template
+
+    @staticmethod
+    def _Ids(catalog, copies):
+        if copies is None:
+            return catalog.DeckIds()
+        card_ids = array('I')
+        for card_id in range(len(catalog)):
+            card_ids.extend(repeat(card_id, copies))
+        return card_ids
+
+    # Drops every cached template using the named pack, or all of them.
+    def Invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._templates.clear()
+                return
+            for key in [key for key in self._templates if name in key[0]]:
+                del self._templates[key]
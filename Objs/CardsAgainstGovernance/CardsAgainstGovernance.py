@@ -1,174 +1,571 @@
 import asyncio
-import discord
 import threading
 import random
+import logging
 from functools import partial
+from itertools import islice
+from time import perf_counter
 from ..DiscordSwitchboard.DiscordSwitchboard import PriorityLevel
-from ..Deck.Deck import Card, Deck, PlayingArea
+from ..Deck.Deck import Deck, PlayingArea, CardLedger
 from ..Player.Player import Player
+from ..Outbox.Outbox import Outbox
+from ..PhaseMachine.PhaseMachine import PhaseMachine
 
-# We don't worry about getting asynchronocity issues on registering/unregistering functors here, as the switchboard will take card of that.
-# However, the objects own critical areas need protection in certain cases. Fortunately, most individual operations with standard Python objects (inserting, etc.) are threadsafe.
+# The game registers its outputs with the switchboard once, and routes each message by the phase it is in (see PhaseMachine), so nothing is registered
+# or removed as turns come and go. However, the objects own critical areas need protection in certain cases. Fortunately, most individual operations with standard Python objects (inserting, etc.) are threadsafe.
+
+logger = logging.getLogger(__name__)
 
 DEBUG = True  # Currently, allows the card czar to play on his own turn and allows for one-player games.
 CARDS_PER_PLAYER = 10
+TURN_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)  # Seconds
+SUBMIT_TIMEOUT = 600  # Seconds players get to submit before the turn goes on without whoever hasn't
+CHOOSE_TIMEOUT = 600  # Seconds the czar gets to choose before a winner is picked at random
+VOTE_TIMEOUT = 120  # Seconds the audience gets to vote, in audience games
+REVEAL_PAGE_SIZE = 25  # Responses shown when they are revealed; the rest are shown on request, a page at a time, with !responses <page>
+CHECK_CARDS = DEBUG  # Check that every card is accounted for at the start of each turn, card by card, and log any problem found (see CheckCards).
+# Phase -> the phases it can go to. Each turn is "submitting" then "choosing", except that a question nobody answered goes straight to the next turn.
+PHASE_TRANSITIONS = {"setup": ("submitting", "over"),
+                     "submitting": ("submitting", "choosing", "over"),
+                     "choosing": ("submitting", "over"),
+                     "over": ()}
+MENTION_ROUTE = ("mention",)  # The route of channel messages that mention the bot (and aren't a command the phase handles)
 
-class CardsAgainstGovernance:   # cards here should be passed in as a unique copy for this class.
-    def __init__(self, switchboard, channel, client, cards):
+# switchboard can be a scope of the bot's switchboard dedicated to this game (see DiscordSwitchboard.CreateScope), in which case player DMs are routed
+# into it as players join and EndGame detaches it. outbox should be shared between games on the same client; one is made if it isn't given.
+#
+# Persistence: every change to the game goes through one of the actions (Join, Start, Submit, Choose, Skip), which first passes the change to journal as a
+# small event tuple, if journal is given. GetState gives a compact snapshot of the whole game. A game is rebuilt by constructing it with that state
+# (or from scratch, for a game that had no snapshot yet) and then handing the events journaled since to ApplyEvent in order. seed decides every
+# shuffle of the game's decks, the turn order and the winners picked when the czar runs out of time, so replaying the same events deals the same
+# cards; give the same seed when rebuilding. Beyond picking a seed if none is given, a game never draws on the random module's global state.
+# resolve_user(user_id, name) must return the discord user to use for a player, when rebuilding.
+# scheduler is a Scheduler.DeadlineScheduler, shared between games, that times turns out (see SUBMIT_TIMEOUT and CHOOSE_TIMEOUT). Without one turns
+# wait for as long as it takes.
+# record_win(user_id, name) is called for every round won, e.g. to keep a leaderboard (see Leaderboard.Recorder). Like journal, it isn't called for
+# events replayed by ApplyEvent, so give it to a rebuilt game once it has caught up.
+#
+# In an audience game the responses are judged by a vote of everyone in the channel instead of by the czar: each member gets one vote per turn
+# (voting again moves it), and the response with the most votes wins when voting closes after VOTE_TIMEOUT, or earlier if the czar sends !closevote.
+# A vote only updates the turn's tallies, which are counted once when voting closes; nothing is sent or journaled per vote, so a flood of votes
+# costs the channel's lane a dict update each. Votes are kept in snapshots but not journaled, so a restart loses the votes cast since the last one.
+class CardsAgainstGovernance:   # cards is ((question catalog, question card ids), (answer catalog, answer card ids)). The decks copy the id arrays on write.
+    def __init__(self, switchboard, channel, client, cards, outbox=None, journal=None, seed=None, state=None, resolve_user=None, scheduler=None,
+                 record_win=None, audience=False):
         self.switchboard = switchboard
         self.channel = channel
         self.client = client
+        self.outbox = Outbox(client) if outbox is None else outbox
+        self.journal = journal
+        self.record_win = record_win
+        self.resolve_user = resolve_user
+        self.audience = audience
         self.players = []
-        
-        self.playing_area = PlayingArea()
-        self.question_area = PlayingArea()
-        self.questions_deck = Deck(cards[0])
-        self.answers_deck = Deck(cards[1])
+
+        self.seed = random.getrandbits(64) if seed is None else seed
+        # Every card's whereabouts are kept in the decks' ledgers: "draw", "discard", ("hand", user id), "play" and "question".
+        self.questions_deck = Deck(*cards[0], seed="{}:questions".format(self.seed), ledger=CardLedger(cards[0][1], track_cards=CHECK_CARDS))
+        self.answers_deck = Deck(*cards[1], seed="{}:answers".format(self.seed), ledger=CardLedger(cards[1][1], track_cards=CHECK_CARDS))
+        self.playing_area = PlayingArea(self.answers_deck)
+        self.question_area = PlayingArea(self.questions_deck, "question")
+        self._reveal_lines = []  # The current turn's responses, as rendered for the czar
         self.turn_generator = None
         self.cur_czar = None
-        self.new_question = None
+        self.czar_index = -1
+        self.turn = 0  # Turns set up so far
+        self.new_question = None  # Card id
         self.score = {}
-        
-        # Setup.
-        asyncio.run_coroutine_threadsafe(
-            self.client.send_message(self.channel, "Cards against Governance is now in setup. Register with the game by mentioning the bot. Start the game with !startcardsgame."),
-            asyncio.get_event_loop())
-        setup_id = self.switchboard.RegisterOutput(self.SetupPlayers, PriorityLevel.PRIORITY, channel_id=channel.id, mentions=self.client.user.id)
-        self.switchboard.RegisterOutput(self.StartGame, PriorityLevel.PRIORITY, channel_id=channel.id, starts_with="!startcardsgame",
-                                        remove_self_when_done=True, remove_when_done=[(setup_id, PriorityLevel.PRIORITY)])
-                                        
+        self.votes = {}  # Voter's user id -> position of the response they voted for, this turn
+        self.tallies = []  # Votes per response, by position, this turn
+        self._positions = {}  # Player's user id -> position of their response, this turn, so that nobody votes for their own
+        self._players_by_id = {}  # user id -> Player
+        # Routes are ("channel", command), ("dm", command) and MENTION_ROUTE.
+        if audience:
+            judging = {("channel", "!vote"): self.Vote, ("channel", "!closevote"): self.CloseVote}
+        else:
+            judging = {("channel", "!choose"): self.ResolveTurn}
+        judging[("channel", "!responses")] = self.ShowResponses
+        self.machine = PhaseMachine({"setup": {MENTION_ROUTE: self.SetupPlayers, ("channel", "!startcardsgame"): self.StartGame},
+                                     "submitting": {("dm", "!submit"): self.WaitForCardPlay},
+                                     "choosing": judging,
+                                     "over": {}},
+                                    "setup", PHASE_TRANSITIONS)
+        self.channel_commands = frozenset(route[1] for handlers in self.machine.phases.values() for route in handlers if route[0] == "channel")
+        self.scheduler = scheduler
+        self._deadline = None  # The Timer for the current phase
+
         self.player_lock = threading.Lock()
         self.has_played = {}
-    
+        self.waiting_on = 0  # Players in has_played who haven't played yet, so that the last submission is spotted without going through them all
+
+        # Metrics, recorded into the switchboard's registry if it has one.
+        self.turn_started = None
+        self._turn_seconds = None
+        if switchboard.metrics is not None:
+            self._turn_seconds = switchboard.metrics.Histogram("game_turn_seconds", "Time from a turn being set up to the czar choosing a winner",
+                                                               buckets=TURN_BUCKETS)
+        self._votes_total = None
+        if audience and switchboard.metrics is not None:
+            self._votes_total = switchboard.metrics.Counter("game_votes_total", "Audience votes counted")
+
+        self.registrations = switchboard.Registrations("game-{}".format(channel.id))
+        self.registrations.RegisterOutput(self.OnChannelMessage, PriorityLevel.PRIORITY, channel_id=channel.id, with_envelope=True)
+        if state is not None:
+            self.SetState(state)
+            return
+        # Setup.
+        self.outbox.Send(self.channel, "Cards against Governance is now in setup. Register with the game by mentioning the bot. Start the game with !startcardsgame." +
+                         (" Everyone in the channel gets to vote on the responses." if audience else ""))
+
+    # "setup", then "submitting" and "choosing" in turn, and "over" once the game has ended.
+    @property
+    def phase(self):
+        return self.machine.phase
+
+    # Every message in the game's channel. Passes (returns None) on whatever the current phase doesn't handle.
+    async def OnChannelMessage(self, message, envelope):
+        handler = None
+        if envelope.command is not None:
+            handler = self.machine.Handler(("channel", envelope.command))
+        if handler is None and self.client.user.id in envelope.mention_ids:
+            handler = self.machine.Handler(MENTION_ROUTE)
+        return None if handler is None else await handler(message, envelope)
+
+    # A player's DM, from their inbox. Players only take the DMs the game is waiting on (see _Expect), and pass the rest, so that another game the
+    # player is in can take them. The turn may have moved on since the DM was taken, so it still goes by the current phase's table.
+    async def OnPlayerMessage(self, player, message, envelope):
+        handler = self.machine.Handler(("dm", envelope.command))
+        if handler is not None:
+            await handler(player, message, envelope)
+
+    # Waits on a player's submission this turn: they take !submit by DM until they've played, or the turn moves on.
+    def _Expect(self, player):
+        self.has_played[player.user.id] = False
+        player.AddResponse("submit", partial(self.OnPlayerMessage, player), override=True, command="!submit")
+
+    def _StopExpecting(self, player):
+        if "submit" in player.input_responses:
+            player.RemoveResponse("submit")
+
+    def _Record(self, event):
+        if self.journal is not None:
+            self.journal(event)
+
+    # Replaces the current deadline, if any, with callback in delay seconds.
+    def _SetDeadline(self, delay, callback):
+        self._ClearDeadline()
+        if self.scheduler is not None:
+            self._deadline = self.scheduler.Schedule(delay, callback)
+
+    def _ClearDeadline(self):
+        if self._deadline is not None:
+            self._deadline.Cancel()
+            self._deadline = None
+
     # TODO: Get current round, etc.
-    
-    def GetCzar(self):  # A generator that returns the current czar. Changing self.players will change its operation.
-        cur_index = -1
+
+    def GetCzar(self):  # A generator that returns the current czar. Changing self.players will change its operation. Carries on from czar_index.
         while True:
-            cur_index = (cur_index+ 1) % len(self.players)
-            yield self.players[cur_index]    
-    
+            self.czar_index = (self.czar_index + 1) % len(self.players)
+            yield self.players[self.czar_index]
+
     # Handles setup and getting players.
-    async def SetupPlayers(self, message):
+    async def SetupPlayers(self, message, envelope):
         for player in self.players:
-            if player.id == message.author.id:
+            if player.user.id == message.author.id:
                 return False
-        self.players.append(Player(message.author, self.switchboard, self.client))
-        self.score[message.author.id] = [message.author.name, 0]
+        self.Join(message.author)
         return True
-        
-    # Handles starting the game itself.
-    async def StartGame(self, message):
+
+    def Join(self, user):
+        self._Record(("join", user.id, user.name))
+        self._AddPlayer(user)
+        self.score[user.id] = [user.name, 0]
+
+    def _AddPlayer(self, user):
+        player = Player(user, self.switchboard, self.client, self.outbox, hand_key=("hand", self.channel.id),
+                        owner="game-{} player-{}".format(self.channel.id, user.id))
+        self.players.append(player)
+        self._players_by_id[user.id] = player
+        self.switchboard.AddRoute(is_private=True, author_id=user.id)
+        return player
+
+    # Handles starting the game itself. Refuses to start if the packs can't fill every player's hand, or have no questions.
+    async def StartGame(self, message, envelope):
         if len(self.players) < 2 and not DEBUG:
-            asyncio.run_coroutine_threadsafe(
-            self.client.send_message(self.channel, "Not enough players!"),
-            asyncio.get_event_loop())
+            self.outbox.Send(self.channel, "Not enough players!")
+            return False
+        needed = len(self.players) * CARDS_PER_PLAYER
+        if self.answers_deck.Available() < needed or not self.questions_deck.Available():
+            self.outbox.Send(self.channel, "Not enough cards! {} players need {} answer cards and at least one question, but these packs have {} answers "
+                             "and {} questions. Start a new game with more packs.".format(len(self.players), needed, self.answers_deck.Available(),
+                                                                                          self.questions_deck.Available()))
             return False
+        self.Start()
+        return True
+
+    # order is the players' user ids in turn order, when replaying.
+    def Start(self, order=None):
         # Deal a hand to each player. Note that it doesn't matter that we haven't determined turn order yet, as this is all randomized anyway.
-        for player in self.players:
-            player.hand = []  # players will get their full hands at start of turn
-        asyncio.run_coroutine_threadsafe(
-            self.client.send_message(self.channel, "Game is started, your hand has been PM'd to you."),
-            asyncio.get_event_loop())
+        self.outbox.Send(self.channel, "Game is started, your hand has been PM'd to you.")
         # Determine turn order:
-        random.shuffle(list(self.players))
-        asyncio.run_coroutine_threadsafe(
-            self.client.send_message(self.channel, "Turn order is: " + ", ".join(player.user.name for player in self.players)),
-            asyncio.get_event_loop())
+        if order is None:
+            random.Random("{}:order".format(self.seed)).shuffle(self.players)
+            order = [player.user.id for player in self.players]
+        else:
+            players = {player.user.id: player for player in self.players}
+            self.players = [players[user_id] for user_id in order]
+        self._Record(("start", order))
+        self.outbox.Send(self.channel, "Turn order is: " + ", ".join(player.user.name for player in self.players))
         self.turn_generator = self.GetCzar()
         self.SetupTurn()
-        return True
-        
+
     def SetupTurn(self):
+        if CHECK_CARDS:
+            problems = self.CheckCards()
+            if problems:
+                logger.error("Cards have gone astray in the game in channel %s: %s", self.channel.id, "; ".join(problems))
+        # Questions go back to the deck at the end of every turn, so this only runs out if the game somehow started without any.
+        new_question = self.questions_deck.Deal(1, destination=self.question_area.location)
+        if not new_question:
+            logger.error("The game in channel %s has no question cards left", self.channel.id)
+            self.outbox.Send(self.channel, "There are no question cards left, so the game can't go on. End it with !cardendgame.")
+            return
+        self.turn_started = perf_counter()
+        self.turn += 1
+        self.machine.Enter("submitting")
         # Each player draws until they have ten cards.
         for player in self.players:
-            player.hand.extend(self.answers_deck.Deal(CARDS_PER_PLAYER - len(player.hand)))
-            player.DisplayHand()
+            player.AddCards(self.answers_deck.Deal(CARDS_PER_PLAYER - len(player.hand), destination=("hand", player.user.id)))
+            player.DisplayHand(self.answers_deck.catalog)
         self.cur_czar = next(self.turn_generator)
-        new_question = self.questions_deck.Deal(1)
         self.new_question = new_question[0]
         self.question_area.Play(self.new_question, self.cur_czar.user.id)
-        asyncio.run_coroutine_threadsafe(
-            self.client.send_message(self.channel,
-                                     ''.join(["Current Card Czar: ", self.cur_czar.user.name, "\n\nQuestion card:```", new_question[0].description, "```\n\nSubmit your reply by PM using !submit (number) (number)"])),
-            asyncio.get_event_loop())
+        self.outbox.Send(self.channel, self._QuestionMessage())
         for player in self.players:
             if not DEBUG and player.user == self.cur_czar.user:
                 continue
-            player.AddResponse("WaitForCardPlay", partial(self.WaitForCardPlay, player))
-        
-    async def WaitForCardPlay(self, player, message):
-        words = message.content.lower().split()
-        if words[0] != "!submit":            
+            self._Expect(player)  # Otherwise the round would end as soon as the first player submitted.
+        self.waiting_on = len(self.has_played)
+        self._SetDeadline(SUBMIT_TIMEOUT, self.SubmitTimeout)
+
+    def _QuestionMessage(self):
+        return ''.join(["Current Card Czar: ", self.cur_czar.user.name, "\n\nQuestion card:```", self.questions_deck.catalog.Description(self.new_question), "```\n\nSubmit your reply by PM using !submit (number) (number)"])
+
+    # Runs from the player's inbox, so the turn may have moved on (or the player submitted already) since the DM was taken.
+    async def WaitForCardPlay(self, player, message, envelope):
+        if self.phase != "submitting" or self.has_played.get(player.user.id) is not False or not envelope.args:
             return
-        if len(words) < 2:
+        if envelope.int_args is None:
+            player.SendMessage("Command improperly formatted! Try again.")
             return
         card_choices = set()
-        for word in words[1:]:
-            try:
-                card_choice = int(word)
-            except (ValueError, TypeError):
-                player.SendMessage("Command improperly formatted! Try again.")
-                return
+        for card_choice in envelope.int_args:
             if card_choice < 0 or card_choice > len(player.hand) - 1:
                 player.SendMessage("Card # out of range! Try Again.")
                 return
             card_choices.add(card_choice)
-        if len(card_choices) != self.new_question.data["num_answers"]:
+        if len(card_choices) != self.questions_deck.catalog.Data(self.new_question)["num_answers"]:
             player.SendMessage("Wrong number of answers!")
             return
+        self.Submit(player, card_choices)
+
+    # card_choices are positions in the player's hand.
+    def Submit(self, player, card_choices):
+        self._Record(("submit", player.user.id, sorted(card_choices)))
         actual_cards = player.GetCards(card_choices)
         for card in actual_cards:
-            self.playing_area.Play(card, player.user.id)
-        player.RemoveResponse("WaitForCardPlay")
+            self.playing_area.Play(card, player.user.id, source=("hand", player.user.id))
         with self.player_lock:
             self.has_played[player.user.id] = True
-            for id, has_played in self.has_played.items():
-                if (id != self.cur_czar.user.id or DEBUG) and not has_played:
-                    return
+            self._StopExpecting(player)
+            self.waiting_on -= 1
+            if self.waiting_on:
+                return
             self.has_played.clear()
+            self._Judge("")
+
+    # Reveals the responses and waits for the czar's choice, or the audience's votes.
+    def _Judge(self, prefix):
+        self.machine.Enter("choosing")
+        if self.audience:
+            self._StartVote()
+        self._SendReveal(prefix)
+        if self.audience:
+            self._SetDeadline(VOTE_TIMEOUT, self.VoteTimeout)
+        else:
+            self._SetDeadline(CHOOSE_TIMEOUT, self.ChooseTimeout)
+
+    # Goes on without the players who haven't submitted yet. If nobody has, the question is skipped and the next czar is up.
+    def SubmitTimeout(self):
+        self._deadline = None
+        self.Skip()
+
+    def Skip(self):
+        self._Record(("skip",))
+        with self.player_lock:
             for player in self.players:
-                if not DEBUG and player.user == self.cur_czar.user:
-                    continue
-            # TODO: fancify card list display
-            asyncio.run_coroutine_threadsafe(
-            self.client.send_message(self.channel,
-                                     ''.join(["All responses received. ", self.cur_czar.user.name, " should choose their favorite response with !choose #\n\n", '\n'.join(str(x) + ": " + ','.join(x.description for x in self.playing_area.current_cards[source_id]) for x, source_id in enumerate(self.playing_area.current_cards.keys()))])),
-            asyncio.get_event_loop())
-            self.switchboard.RegisterOutput(self.ResolveTurn, PriorityLevel.PRIORITY, channel_id=self.channel.id,
-                                            author_id=self.cur_czar.user.id, starts_with="!choose",
-                                            remove_self_when_done=True)
-            print("hmm")
-            
-    async def ResolveTurn(self, message):
-        words = message.content.lower().split()
-        if words[0] != "!choose":            
-            return
-        if len(words) < 2:
+                if self.has_played.get(player.user.id) is False:
+                    self._StopExpecting(player)
+                    player.SendMessage("Time's up! You've been skipped this turn.")
+            self.has_played.clear()
+            self.waiting_on = 0
+            if self.playing_area.current_cards:
+                self._Judge("Time's up! ")
+                return
+        self.outbox.Send(self.channel, "Nobody played in time, so this question is skipped.")
+        self.question_area.EndTurn()
+        self.SetupTurn()
+
+    def ChooseTimeout(self):
+        self._deadline = None
+        self.outbox.Send(self.channel, self.cur_czar.user.name + " ran out of time, so the winner is picked at random.")
+        self.Choose(random.Random("{}:choose:{}".format(self.seed, self.turn)).randrange(len(self.playing_area.current_cards)))
+
+    # TODO: fancify card list display
+    # The responses' lines are rendered once per turn; responses are only ever added to the end, so only new ones need rendering. The reveal shows
+    # the first REVEAL_PAGE_SIZE responses, so that it stays one message however many players there are; the rest are shown page by page on request.
+    def _RevealLines(self):
+        lines = self._reveal_lines
+        responses = self.playing_area.current_cards
+        for x, cards in enumerate(islice(responses.values(), len(lines), None), len(lines)):
+            lines.append(str(x) + ": " + ','.join(self.answers_deck.catalog.Description(card_id) for card_id in cards))
+        return lines
+
+    # Returns (the text of page, the number of pages). page counts from 1.
+    def _RevealPage(self, page):
+        lines = self._RevealLines()
+        pages = (len(lines) + REVEAL_PAGE_SIZE - 1) // REVEAL_PAGE_SIZE
+        start = (page - 1) * REVEAL_PAGE_SIZE
+        text = '\n'.join(lines[start:start + REVEAL_PAGE_SIZE])
+        if pages > 1:
+            text += "\n(Page {} of {}. See the others with !responses <page>.)".format(page, pages)
+        return text, pages
+
+    def _StartVote(self, votes=None):
+        responses = self.playing_area.current_cards
+        self._positions = {user_id: x for x, user_id in enumerate(responses)}
+        self.tallies = [0] * len(responses)
+        self.votes = {} if votes is None else dict(votes)
+        for choice in self.votes.values():
+            self.tallies[choice] += 1
+
+    def _SendReveal(self, prefix):
+        if self.audience:
+            header = ''.join(["All responses received. Everyone can vote for their favorite response with !vote #. Voting closes in ",
+                              str(VOTE_TIMEOUT), " seconds, or when ", self.cur_czar.user.name, " sends !closevote.\n\n"])
+        else:
+            header = ''.join(["All responses received. ", self.cur_czar.user.name, " should choose their favorite response with !choose #\n\n"])
+        self.outbox.Send(self.channel, prefix + header + self._RevealPage(1)[0])
+
+    async def ShowResponses(self, message, envelope):
+        int_args = envelope.int_args
+        if not int_args or len(int_args) != 1:
             return False
-        try:
-            choice = int(words[1])
-        except (ValueError, TypeError):
-            asyncio.run_coroutine_threadsafe(
-                self.client.send_message(self.channel, "Command improperly formatted! Try again."),
-                asyncio.get_event_loop())
+        text, pages = self._RevealPage(int_args[0])
+        if not 1 <= int_args[0] <= pages:
+            self.outbox.Send(self.channel, "There are only {} pages of responses.".format(pages))
+            return False
+        self.outbox.Send(self.channel, text)
+        return True
+
+    # An audience member's vote. Votes that aren't a valid response number, or are for the voter's own response, are ignored without a reply, as
+    # a reply per vote is what would slow a flood of them down.
+    async def Vote(self, message, envelope):
+        int_args = envelope.int_args
+        if not int_args:
+            return False
+        choice = int_args[0]
+        tallies = self.tallies
+        if choice < 0 or choice >= len(tallies):
+            return False
+        voter_id = envelope.author_id
+        if self._positions.get(voter_id) == choice:
+            return False
+        previous = self.votes.get(voter_id)
+        if previous == choice:
+            return True
+        if previous is not None:
+            tallies[previous] -= 1
+        tallies[choice] += 1
+        self.votes[voter_id] = choice
+        if self._votes_total is not None:
+            self._votes_total.Inc()
+        return True
+
+    async def CloseVote(self, message, envelope):
+        if envelope.author_id != self.cur_czar.user.id or envelope.args:
+            return None
+        self._CountVotes()
+        return True
+
+    def VoteTimeout(self):
+        self._deadline = None
+        self._CountVotes()
+
+    # The response with the most votes wins; a tie (or a vote nobody took part in) is settled at random between the leaders.
+    def _CountVotes(self):
+        tallies = self.tallies
+        most = max(tallies)
+        leaders = [x for x, votes in enumerate(tallies) if votes == most]
+        choice = leaders[0] if len(leaders) == 1 else random.Random("{}:vote:{}".format(self.seed, self.turn)).choice(leaders)
+        if most:
+            self.outbox.Send(self.channel, "Voting is closed. Votes: " + ", ".join("{}: {}".format(x, votes) for x, votes in enumerate(tallies) if votes))
+        else:
+            self.outbox.Send(self.channel, "Voting is closed. Nobody voted, so the winner is picked at random.")
+        self.Choose(choice)
+
+    async def ResolveTurn(self, message, envelope):
+        if envelope.author_id != self.cur_czar.user.id:
+            return None
+        if not envelope.args:
+            return False
+        if envelope.int_args is None:
+            self.outbox.Send(self.channel, "Command improperly formatted! Try again.")
             return False
-        ref_list = list(self.playing_area.current_cards.keys())
-        if choice < 0 or choice > len(ref_list) - 1:
-            asyncio.run_coroutine_threadsafe(
-                self.client.send_message(self.channel, "Card # out of range! Try Again."),
-                asyncio.get_event_loop())
+        choice = envelope.int_args[0]
+        if choice < 0 or choice > len(self.playing_area.current_cards) - 1:
+            self.outbox.Send(self.channel, "Card # out of range! Try Again.")
             return False
-        winner = ref_list[choice]
+        self.Choose(choice)
+        return True
+
+    # choice is the position of the winning response, as revealed.
+    def Choose(self, choice):
+        self._Record(("choose", choice))
+        self._ClearDeadline()
+        winner = list(self.playing_area.current_cards.keys())[choice]
         self.score[winner][1] += 1
-        asyncio.run_coroutine_threadsafe(
-                self.client.send_message(self.channel, ''.join(["That belonged to ", self.score[winner][0], ", who now has ", str(self.score[winner][1]), " points!"])),
-                asyncio.get_event_loop())
+        if self.record_win is not None:
+            self.record_win(winner, self.score[winner][0])
+        if self._turn_seconds is not None:
+            self._turn_seconds.Observe(perf_counter() - self.turn_started)
+        self.outbox.Send(self.channel, ''.join(["That belonged to ", self.score[winner][0], ", who now has ", str(self.score[winner][1]), " points!"]))
         self.playing_area.EndTurn()
+        self._reveal_lines = []
+        self.votes = {}
+        self.tallies = []
+        self._positions = {}
         self.question_area.EndTurn()
         self.SetupTurn()
-        return True
 
+    # Where each deck's cards actually are, as (question locations, answer locations), each mapping ledger locations to card ids.
+    def CardLocations(self):
+        questions = {"draw": self.questions_deck.draw_pool, "discard": self.questions_deck.discard,
+                     self.question_area.location: self.question_area.CardIds()}
+        answers = {"draw": self.answers_deck.draw_pool, "discard": self.answers_deck.discard,
+                   self.playing_area.location: self.playing_area.CardIds()}
+        for player in self.players:
+            answers[("hand", player.user.id)] = player.hand
+        return questions, answers
+
+    # Returns a list of problems with the game's cards (lost, duplicated, or not where the ledgers say), empty if every card is accounted for.
+    def CheckCards(self):
+        questions, answers = self.CardLocations()
+        return (["Questions: " + problem for problem in self.questions_deck.ledger.Check(questions)] +
+                ["Answers: " + problem for problem in self.answers_deck.ledger.Check(answers)])
+
+    # Replays an event passed to journal, without journaling or recording it again.
+    def ApplyEvent(self, event):
+        journal, self.journal = self.journal, None
+        record_win, self.record_win = self.record_win, None
+        try:
+            kind = event[0]
+            if kind == "join":
+                self.Join(self.resolve_user(event[1], event[2]))
+            elif kind == "start":
+                self.Start(event[1])
+            elif kind == "submit":
+                self.Submit(next(player for player in self.players if player.user.id == event[1]), set(event[2]))
+            elif kind == "choose":
+                self.Choose(event[1])
+            elif kind == "skip":
+                self.Skip()
+            else:
+                raise ValueError("Unknown game event " + repr(kind))
+        finally:
+            self.journal = journal
+            self.record_win = record_win
+
+    # A snapshot of the game, made only of plain picklable values.
+    def GetState(self):
+        return {"phase": self.phase,
+                "players": [player.GetState() for player in self.players],
+                "score": {user_id: tuple(entry) for user_id, entry in self.score.items()},
+                "czar_index": self.czar_index,
+                "turn": self.turn,
+                "question": self.new_question,
+                "has_played": dict(self.has_played),
+                "votes": dict(self.votes),
+                "questions_deck": self.questions_deck.GetState(),
+                "answers_deck": self.answers_deck.GetState(),
+                "question_area": self.question_area.GetState(),
+                "playing_area": self.playing_area.GetState()}
+
+    # Restores a snapshot from GetState into a newly constructed game, and sets the deadline of whatever the game was waiting on.
+    def SetState(self, state):
+        self.machine.Restore(state["phase"])
+        for player_state in state["players"]:
+            self._AddPlayer(self.resolve_user(player_state[0], player_state[1])).SetState(player_state)
+        self.score = {user_id: list(entry) for user_id, entry in state["score"].items()}
+        self.czar_index = state["czar_index"]
+        self.turn = state.get("turn", 0)  # Snapshots from before turns were counted don't have it
+        self.new_question = state["question"]
+        self.has_played = {}
+        for user_id, has_played in state["has_played"].items():
+            if has_played:
+                self.has_played[user_id] = True
+            else:
+                self._Expect(self._players_by_id[user_id])
+        self.waiting_on = sum(1 for has_played in self.has_played.values() if not has_played)
+        self.questions_deck.SetState(state["questions_deck"])
+        self.answers_deck.SetState(state["answers_deck"])
+        self.question_area.SetState(state["question_area"])
+        self.playing_area.SetState(state["playing_area"])
+        questions, answers = self.CardLocations()
+        self.questions_deck.ledger.Reset(questions)
+        self.answers_deck.ledger.Reset(answers)
+        if self.phase == "setup":
+            return
+        self.turn_generator = self.GetCzar()
+        self.cur_czar = self.players[self.czar_index]
+        self.turn_started = perf_counter()
+        if self.phase == "submitting":
+            self._SetDeadline(SUBMIT_TIMEOUT, self.SubmitTimeout)
+        elif self.audience:
+            self._StartVote(state.get("votes"))  # Snapshots from before audience games don't have it
+            self._SetDeadline(VOTE_TIMEOUT, self.VoteTimeout)
+        else:
+            self._SetDeadline(CHOOSE_TIMEOUT, self.ChooseTimeout)
+
+    # Swaps the outbox the game and its players send through, e.g. to stop muting a game once it has been rebuilt.
+    def SetOutbox(self, outbox):
+        self.outbox = outbox
+        for player in self.players:
+            player.outbox = outbox
+
+    # Tells the channel (and the players who still have to play) where a rebuilt game was left off.
+    def Resume(self):
+        if self.phase == "setup":
+            self.outbox.Send(self.channel, "Cards against Governance was restarted and is still in setup. Register by mentioning the bot, and start the game with !startcardsgame.")
+            return
+        restarted = "Cards against Governance was restarted. Carrying on where we left off.\n\n"
+        if self.phase != "submitting":
+            self._SendReveal(restarted)
+            return
+        self.outbox.Send(self.channel, restarted + self._QuestionMessage())
+        for player in self.players:
+            if self.has_played.get(player.user.id) is False:
+                player.DisplayHand(self.answers_deck.catalog, force=True)
+
+    # Posts the final scores and stops the game from receiving any more messages. Everything the game and its players registered is released, so
+    # nothing is left behind even when the game was given a switchboard shared with others rather than a scope.
     def EndGame(self):
-        pass
-    
\ No newline at end of file
+        self.machine.Enter("over")
+        self._ClearDeadline()
+        self.registrations.Release()
+        for player in self.players:
+            player.Release()
+        self.switchboard.Detach()
+        standings = sorted(self.score.values(), key=lambda x: x[1], reverse=True)
+        self.outbox.Send(self.channel, "Game over! Final scores:\n" + "\n".join(name + ": " + str(points) for name, points in standings))
@@ -1,82 +1,256 @@
 import random
-import warnings
-from collections import OrderedDict
-
-# A very basic card, might have additional features in the future. Mainly, if just warns if destroyed without being flagged for destruction, indicating illogical destruction.
-class Card:
-    def __init__(self, description, data):
-        self.description = description
-        self.okay_to_delete = False
-        self.owner = None   # Will be referenced to return cards to by PlayingArea
-        self.data = data
-        
-    def __del__(self):
-        if not self.okay_to_delete:
-            warnings.warn("Card Object destroyed abnormally!")
-            
-    def Return(self):
-        self.owner.Return(self)
-
-# A very basic card deck. Feel free to extend or inherit as desired.
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+from itertools import repeat
+
+# A very basic card, might have additional features in the future. Cards are immutable and shared through a CardCatalog; decks, hands and playing
+# areas only ever hold a card's id, which is its index in the catalog.
+Card = namedtuple("Card", ["description", "data"])
+
+# One row per distinct card, plus how many copies of each card a full deck has. Build it once and share it between every game using those cards.
+# cards can be any sequence of Cards (e.g. a lazily decoded CardPack.PackCards); other iterables are read into a tuple.
+class CardCatalog:
+    def __init__(self, cards, counts):
+        self.cards = cards if hasattr(cards, "__getitem__") else tuple(cards)
+        self.counts = array('I', counts)
+
+    # card_list is a sequence of (description, count, data)
+    @classmethod
+    def FromList(cls, card_list):
+        return cls((Card(description, data) for description, _, data in card_list), (count for _, count, _ in card_list))
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __getitem__(self, card_id):
+        return self.cards[card_id]
+
+    def Description(self, card_id):
+        return self.cards[card_id].description
+
+    def Data(self, card_id):
+        return self.cards[card_id].data
+
+    # Returns the ids of a full, unshuffled deck: each card's id repeated once per copy.
+    def DeckIds(self):
+        card_ids = array('I')
+        for card_id, count in enumerate(self.counts):
+            card_ids.extend(repeat(card_id, count))
+        return card_ids
+
+# Where a card that has been dealt goes, unless the caller says otherwise: out of the deck's hands, and no longer tracked by its CardLedger.
+DEALT = "dealt"
+
+# Keeps count of how many of a deck's cards are in each location (the deck's "draw" and "discard" piles, and whatever the game deals into, e.g.
+# ("hand", user id) or a PlayingArea's location), so that a game can check at any time that no card has been lost or duplicated. A move only
+# updates two counters. With track_cards, it also keeps per-card counts for each location, so that Check can say exactly which cards are off, at the
+# cost of O(cards moved) per move and O(cards) to set up.
+class CardLedger:
+    def __init__(self, card_ids, location="draw", track_cards=False):
+        self.total = len(card_ids)
+        self.counts = {location: self.total}
+        self.track_cards = track_cards
+        self.expected = Counter(card_ids) if track_cards else None
+        self.cards = {location: Counter(card_ids)} if track_cards else {}
+
+    def Move(self, source, destination, card_ids):
+        number = len(card_ids)
+        if not number or source == destination:
+            return
+        counts = self.counts
+        remaining = counts.get(source, 0) - number
+        if remaining:
+            counts[source] = remaining
+        else:
+            del counts[source]
+        counts[destination] = counts.get(destination, 0) + number
+        if self.track_cards:
+            self.cards.setdefault(source, Counter()).subtract(card_ids)
+            self.cards.setdefault(destination, Counter()).update(card_ids)
+
+    def Count(self, location):
+        return self.counts.get(location, 0)
+
+    # Recounts every location from the cards actually there (location -> card ids), e.g. after restoring a game. total is left alone, so that
+    # Check still compares against the cards the deck started with.
+    def Reset(self, locations):
+        self.counts = {location: len(card_ids) for location, card_ids in locations.items() if len(card_ids)}
+        if self.track_cards:
+            self.cards = {location: Counter(card_ids) for location, card_ids in locations.items()}
+
+    # Returns a list of problems, empty if every card is accounted for. actual optionally maps locations to the card ids really there, to check
+    # the counters against.
+    def Check(self, actual=None):
+        problems = []
+        accounted = sum(self.counts.values())
+        if accounted != self.total:
+            problems.append("{} cards accounted for, expected {}".format(accounted, self.total))
+        for location, number in self.counts.items():
+            if number < 0:
+                problems.append("{} cards in {}".format(number, location))
+        if self.track_cards:
+            total = Counter()
+            for cards in self.cards.values():
+                total.update(cards)
+            for card_id in set(total) | set(self.expected):
+                if total[card_id] != self.expected[card_id]:
+                    problems.append("{} copies of card {}, expected {}".format(total[card_id], card_id, self.expected[card_id]))
+        if actual is not None:
+            for location, card_ids in actual.items():
+                if len(card_ids) != self.Count(location):
+                    problems.append("{} cards in {}, the ledger says {}".format(len(card_ids), location, self.Count(location)))
+                elif self.track_cards and +Counter(card_ids) != +self.cards.get(location, Counter()):
+                    problems.append("The cards in {} don't match the ledger".format(location))
+        return problems
+
+
+# A very basic card deck, holding card ids from catalog. Feel free to extend or inherit as desired.
+# card_ids is not copied up front: the deck shares it (e.g. with a cached deck template) until the deck first changes, so making a deck is O(1).
+# The deck is never shuffled as a whole. Each card dealt is picked at random from the draw pool as it is dealt (an incremental Fisher-Yates
+# shuffle: the pick is swapped with the last card and popped), so dealing k cards costs O(k) however big the deck, and folding the discard pile
+# back in is just appending it to the draw pool. Every card remaining is equally likely to be dealt next, exactly as if the pool had been shuffled.
+# With initial_shuffle False, cards are dealt from the end of card_ids, in order, until the discard pile is first folded back in.
+# Treat draw_pool as read-only from outside; its order means nothing.
+# The picks are drawn from seed and the number of reshuffles so far, so a deck's whole history can be rebuilt from its state (see GetState) and
+# the deals made since. seed can be anything random.Random accepts; a random one is picked if it isn't given.
+# If ledger (a CardLedger for card_ids) is given, every card that enters or leaves the deck is recorded in it; see Deal and ReturnMany.
 class Deck:
-    def __init__(self, cards, initial_shuffle = True):
-        self.draw_pool = cards
-        self.discard = []
-        for card in cards:
-            card.owner = self  # Set owner
-        if initial_shuffle:
-            self.Reshuffle()
-            
-    def __del__(self):
-        # None of these cards will ever be deleted while this Deck still exists, so this guarantees that okay_to_delete is set before their destructors are called.
-        for card in self.draw_pool:
-            card.okay_to_delete = True
-        for card in self.discard:
-            card.okay_to_delete = True
-    
+    def __init__(self, catalog, card_ids, initial_shuffle = True, seed=None, ledger=None):
+        self.catalog = catalog
+        self.draw_pool = card_ids
+        self.discard = array('I')
+        self._shared = True
+        self._random_draws = initial_shuffle
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.shuffles = 0
+        self.draws = 0  # Random picks made since the last reshuffle
+        self._rng = None  # Made on the first pick after each reshuffle
+        self.ledger = ledger
+
+    # Copy-on-write: take a private copy of the draw pool before the first change to it.
+    def _Own(self):
+        if self._shared:
+            self.draw_pool = array('I', self.draw_pool)
+            self._shared = False
+
+    # The generator for the current reshuffle, caught up with the picks already made from it (e.g. by the deck this one's state came from).
+    def _Rng(self):
+        if self._rng is None:
+            self._rng = random.Random("{}:{}".format(self.seed, self.shuffles))
+            for _ in range(self.draws):
+                self._rng.random()
+        return self._rng
+
+    # Moves number cards from the draw pool to output, which must not be more than the pool holds.
+    def _Draw(self, number, output):
+        pool = self.draw_pool
+        if not self._random_draws:
+            output.extend(pool[len(pool) - number:])
+            del pool[len(pool) - number:]
+            return
+        # int(random() * n) is a little quicker than randrange, and its bias (under n / 2**53) is far too small to ever show.
+        uniform = self._Rng().random
+        for _ in range(number):
+            x = int(uniform() * len(pool))
+            output.append(pool[x])
+            pool[x] = pool[-1]
+            pool.pop()
+        self.draws += number
+
+    # Folds the discard pile back into the draw pool. As every deal picks at random, that's as good as shuffling them together.
     def Reshuffle(self):
+        self._Own()
+        if self.ledger is not None:
+            self.ledger.Move("discard", "draw", self.discard)
         self.draw_pool.extend(self.discard)
-        self.discard.clear()
-        random.shuffle(self.draw_pool)
-    
-    # Returns cards dealt AND ALSO REMOVES THEM FROM THE DECK. Make sure to take ownership.
+        del self.discard[:]
+        self.shuffles += 1
+        self.draws = 0
+        self._rng = None
+        self._random_draws = True
+
+    # How many cards Deal can hand out, counting the discard pile it reshuffles in.
+    def Available(self):
+        return len(self.draw_pool) + len(self.discard)
+
+    # Returns card ids dealt AND ALSO REMOVES THEM FROM THE DECK. Make sure to take ownership.
     # If reshuffle is True, it will reshuffle the deck to draw the remaining cards if not enough
-    # cards left. If False, it will deal out the remaining cards and return.
-    def Deal(self, number, reshuffle=True):
-        # Check for reshuffle
-        output_list = []
-        if number > len(self.draw_pool):
-            # Deal out remaining cards
-            output_list.extend(self.draw_pool)
-            self.draw_pool.clear()
-            if not reshuffle:
-                return output_list
+    # cards left. If False, it will deal out the remaining cards and return. Either way, it never deals
+    # more cards than the deck has. destination is the ledger location the cards are dealt into.
+    def Deal(self, number, reshuffle=True, destination=DEALT):
+        self._Own()
+        output_list = array('I')
+        # Deal out what the draw pool has first, and only then fold the discard back in for the rest.
+        self._Draw(min(number, len(self.draw_pool)), output_list)
+        if number > len(output_list) and reshuffle:
             self.Reshuffle()
-            number -= len(output_list)
-        output_list.extend(self.draw_pool.pop() for _ in range(number))
+            self._Draw(min(number - len(output_list), len(self.draw_pool)), output_list)
+        if self.ledger is not None:
+            self.ledger.Move("draw", destination, output_list)
         return output_list
-        
-    # Returns card to the deck in the discard pile
-    def Return(self, card):
-        self.discard.append(card)
 
-# A temporary object for holding played cards. Returns cards to their owning decks when done. Extend for further behavior.
+    # Returns a card to the deck in the discard pile. source is the ledger location it is coming back from.
+    def Return(self, card_id, source=DEALT):
+        self.discard.append(card_id)
+        if self.ledger is not None:
+            self.ledger.Move(source, "discard", (card_id,))
+
+    def ReturnMany(self, card_ids, source=DEALT):
+        self.discard.extend(card_ids)
+        if self.ledger is not None:
+            self.ledger.Move(source, "discard", card_ids)
+
+    # A compact, picklable copy of the deck's state. A deck that hasn't changed since it was made doesn't store its cards, as SetState on a deck
+    # made from the same card_ids gets them back.
+    def GetState(self):
+        draw_pool = None if self._shared else self.draw_pool.tobytes()
+        return (draw_pool, self.discard.tobytes(), self._random_draws, self.seed, self.shuffles, self.draws)
+
+    # Also takes the states of decks from before picks were made as cards are dealt, which shuffled their whole draw pool up front: a pool that was
+    # shuffled is as good as any to pick from, and one that still needed shuffling will be picked from at random anyway.
+    def SetState(self, state):
+        if len(state) == 5:
+            draw_pool, discard, needs_shuffle, self.seed, self.shuffles = state
+            self._random_draws = True
+            self.draws = 0
+        else:
+            draw_pool, discard, self._random_draws, self.seed, self.shuffles, self.draws = state
+        if draw_pool is not None:
+            self.draw_pool = array('I', draw_pool)
+            self._shared = False
+        self.discard = array('I', discard)
+        self._rng = None
+
+# A temporary object for holding played cards. Returns cards to their owning deck when done. Extend for further behavior.
+# location is the area's name in the owner's CardLedger, if it has one.
 class PlayingArea:
-    def __init__(self):
-        self.current_cards = OrderedDict()
+    def __init__(self, owner, location="play"):
+        self.owner = owner  # The Deck played cards are returned to
+        self.location = location
+        self.current_cards = OrderedDict()  # source_id -> array of card ids
+
+    # source is the ledger location the card comes from, or None if it was dealt straight into this area.
+    def Play(self, card_id, source_id, source=None):
+        cards = self.current_cards.get(source_id)
+        if cards is None:
+            cards = self.current_cards[source_id] = array('I')
+        cards.append(card_id)
+        if source is not None and self.owner.ledger is not None:
+            self.owner.ledger.Move(source, self.location, (card_id,))
 
-    def __del__(self):
-        # None of these cards will ever be deleted while this still exists, so this guarantees that okay_to_delete is set before their destructors are called.
-        for cards in self.current_cards.values():
-            for card in cards:
-                card.okay_to_delete = True
-        
-    def Play(self, card, source_id):
-        self.current_cards.setdefault(source_id, [])
-        self.current_cards[source_id].append(card)
-        
     def EndTurn(self):
         for cards in self.current_cards.values():
-            for card in cards:
-                card.Return()
-        self.current_cards.clear()
\ No newline at end of file
+            self.owner.ReturnMany(cards, self.location)
+        self.current_cards.clear()
+
+    def CardIds(self):
+        card_ids = array('I')
+        for cards in self.current_cards.values():
+            card_ids.extend(cards)
+        return card_ids
+
+    def GetState(self):
+        return [(source_id, cards.tobytes()) for source_id, cards in self.current_cards.items()]
+
+    def SetState(self, state):
+        self.current_cards = OrderedDict((source_id, array('I', cards)) for source_id, cards in state)
@@ -1,4 +1,5 @@
-"""A class that acts like a switchboard for discord messages. The class can be recursive.
+"""A class that acts like a switchboard for discord messages. The class can be recursive: see CreateScope for giving a subsystem (e.g. one game) its own
+child switchboard that only sees the messages routed to it.
 
 Python 3.5+ only.
 
@@ -7,16 +8,41 @@ Usage:
 1. Set up the DiscordSwitchboard object. Make sure to include the right functor outputs.
 2. Include an await switchboard.on_message(message) somewhere in your discord client on_message (or ensure_future if you prefer)
 3. Make sure to hold onto a reference to the object to keep it alive/modify it as desired.
-4, Each switchboard internally can only process if/then for messages one-by-one. If you have two users you are _certain_ cannot possibly collide with each other, then
-   spin more than one switchboard onto multiple parallel threads. This evil is necessary to ensure users get reliable switchboard behavior.
+4, By default, each switchboard internally can only process if/then for messages one-by-one. Construct it with lanes=True to instead serialize messages per lane
+   (the channel, or the author for private channels): messages in one lane are still handled strictly in order, but different lanes make progress concurrently,
+   so one slow output no longer holds up every other channel and DM. Registration changes made while handling a message are deferred until that message's
+   lane is done with it, just as they are deferred until the whole switchboard is done in the default mode.
+   Don't nest a default-mode switchboard under a lane-mode one: its lock is held across awaits and two lanes reaching it at once would block the event loop.
+5. Pass a Metrics.MetricsRegistry as metrics to count hits and misses per relay entry (entries are labelled by their output's name, e.g.
+   Player.on_message, and routes into a scope by the scope's name, see OutputName) and time matchers, outputs, lock waits and holds, and the
+   number of deferred registration changes. Scopes share their parent's.
+6. Every message is wrapped once in a MessageEnvelope, which is handed down to nested switchboards. Register command handlers with command="!name" rather
+   than starts_with, and with_envelope=True to receive the envelope with the parsed command and arguments.
+7. Outputs of the general and fallback relays, and closures, run in their own tasks, started through the switchboard's Supervisor.TaskSupervisor
+   (switchboard.tasks; pass tasks to share one). At most GENERAL_OUTPUT_LIMIT general and FALLBACK_OUTPUT_LIMIT fallback outputs run at once per
+   switchboard, failures are logged, and Detach cancels whatever a scope still has running. Anything else a scope's owner starts (e.g. a game's
+   players' workers) should go through scope.tasks too.
+8. Registrations(owner) gives a handle that registers outputs under owner and removes them all at once with Release(), for something (e.g. a
+   player) sharing a switchboard with others. RegisterOutput(..., weak=True) holds the output (e.g. a bound method) through a weak reference
+   instead: once its object is gone, the entry is dropped on the next message. LiveHandlers() lists every entry, through nested scopes, with its
+   owner and age, to find what is still registered that shouldn't be.
 
 """
 from collections import OrderedDict
 from enum import Enum
 from functools import partial
+from itertools import count
+from time import monotonic, perf_counter
 import asyncio
-import discord
 import threading
+import weakref
+
+from ..Metrics.Metrics import SIZE_BUCKETS
+from ..Supervisor.Supervisor import TaskSupervisor
+
+GENERAL_OUTPUT_LIMIT = 64  # Most general relay outputs one switchboard runs at once; the rest wait their turn
+FALLBACK_OUTPUT_LIMIT = 16  # Likewise for fallback outputs
+OUTPUT_LIMITS = {"general": GENERAL_OUTPUT_LIMIT, "fallback": FALLBACK_OUTPUT_LIMIT}
 
 class PriorityLevel(Enum):
     PRIORITY = 1
@@ -24,6 +50,352 @@ class PriorityLevel(Enum):
     GENERAL_BLOCKING = 3
     FALLBACK = 4
 
+# A prefix trie over starts_with strings, stored as given. Each node is a dict of character -> child node, and the None key of a node
+# holds the entries (key -> sequence number) whose prefix ends at that node. Messages are matched by their lowercased content, so (as with
+# start_check) a prefix with capitals in it never matches.
+class PrefixTrie:
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def Add(self, prefix, key, sequence):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, {})[key] = sequence
+        self.size += 1
+
+    def Remove(self, prefix, key):
+        path = []
+        node = self.root
+        for char in prefix:
+            path.append((node, char))
+            node = node[char]
+        del node[None][key]
+        if not node[None]:
+            del node[None]
+        # Prune empty branches so dead prefixes don't slow down later walks.
+        while path and not node:
+            parent, char = path.pop()
+            del parent[char]
+            node = parent
+        self.size -= 1
+
+    # Returns the entry buckets of every stored prefix that content starts with, shortest first.
+    def Matches(self, content):
+        buckets = []
+        node = self.root
+        for char in content:
+            node = node.get(char)
+            if node is None:
+                break
+            bucket = node.get(None)
+            if bucket is not None:
+                buckets.append(bucket)
+        return buckets
+
+
+# The fields of a message that matchers and handlers look at, computed once per message rather than once per matcher or handler.
+# A message is a command if its first word starts with COMMAND_PREFIX: command is then that word, lowercased, and args the words after it as typed.
+# int_args is args converted to ints, or None if any of them isn't one. Everything past the ids is worked out on first use, so chatter that no
+# matcher needs to tokenize never is.
+COMMAND_PREFIX = "!"
+_UNPARSED = object()
+
+class MessageEnvelope:
+    __slots__ = ("message", "content", "author_id", "channel_id", "is_private", "_mention_ids", "_command", "_args", "_int_args")
+
+    def __init__(self, message):
+        self.message = message
+        self.content = message.content.lower()
+        self.author_id = message.author.id
+        self.channel_id = message.channel.id
+        self.is_private = bool(message.channel.is_private)
+        self._mention_ids = None
+        self._command = _UNPARSED
+        self._args = None
+        self._int_args = _UNPARSED
+
+    @property
+    def mention_ids(self):
+        if self._mention_ids is None:
+            self._mention_ids = frozenset(user.id for user in self.message.mentions)
+        return self._mention_ids
+
+    @property
+    def command(self):
+        if self._command is _UNPARSED:
+            self._Parse()
+        return self._command
+
+    @property
+    def args(self):
+        if self._command is _UNPARSED:
+            self._Parse()
+        return self._args
+
+    @property
+    def int_args(self):
+        if self._int_args is _UNPARSED:
+            try:
+                self._int_args = tuple(int(arg) for arg in self.args)
+            except ValueError:
+                self._int_args = None
+        return self._int_args
+
+    def _Parse(self):
+        if not self.content.startswith(COMMAND_PREFIX):
+            self._command = None
+            self._args = ()
+            return
+        words = self.message.content.split()
+        self._command = words[0].lower()
+        self._args = tuple(words[1:])
+
+
+# A relay entry's conditions (the arguments of RegisterOutput) compiled into one plain, synchronous callable on a MessageEnvelope. The switchboard
+# calls Predicates directly and only awaits matchers that are anything else (i.e. user supplied coroutines). command must equal the message's
+# MessageEnvelope.command (so "!choose" matches "!choose 1" but not "!chooser"), unlike starts_with which is a plain prefix of the content.
+# By default all conditions must hold; with match_any, one is enough. negate inverts the result (used by MustHave, whose matchers pick the messages to
+# ignore). Non-negated all-conditions Predicates are indexed by RelayTable from their attributes.
+class Predicate:
+    __slots__ = ("author_id", "channel_id", "mentions", "starts_with", "is_private", "command", "match_any", "negate")
+
+    def __init__(self, author_id=None, channel_id=None, mentions=None, starts_with=None, is_private=None, command=None, match_any=False, negate=False):
+        self.author_id = author_id
+        self.channel_id = channel_id
+        self.mentions = mentions
+        self.starts_with = starts_with
+        self.is_private = None if is_private is None else bool(is_private)
+        self.command = None if command is None else command.lower()
+        self.match_any = match_any
+        self.negate = negate
+
+    def __bool__(self):  # Whether there are any conditions at all
+        return not (self.author_id is None and self.channel_id is None and self.mentions is None and self.starts_with is None and self.is_private is None
+                    and self.command is None)
+
+    def __call__(self, envelope):
+        if self.match_any:
+            holds = ((self.channel_id is not None and envelope.channel_id == self.channel_id) or
+                     (self.command is not None and envelope.command == self.command) or
+                     (self.starts_with is not None and envelope.content.startswith(self.starts_with)) or
+                     (self.mentions is not None and self.mentions in envelope.mention_ids) or
+                     (self.author_id is not None and envelope.author_id == self.author_id) or
+                     (self.is_private is not None and envelope.is_private == self.is_private))
+        else:
+            holds = ((self.channel_id is None or envelope.channel_id == self.channel_id) and
+                     (self.command is None or envelope.command == self.command) and
+                     (self.starts_with is None or envelope.content.startswith(self.starts_with)) and
+                     (self.mentions is None or self.mentions in envelope.mention_ids) and
+                     (self.author_id is None or envelope.author_id == self.author_id) and
+                     (self.is_private is None or envelope.is_private == self.is_private))
+        return holds != self.negate
+
+
+# An OrderedDict of relay entries that also indexes the routing conditions of each entry, so that a message only visits the
+# entries that could possibly match it. Each entry is filed under its single most selective condition (author, then command, then channel,
+# then starts_with, then is_private); the full matcher is still run on every candidate, so the index only has to be a superset.
+# Commands come before channels so that chatter in a busy channel never even visits the entries waiting on that channel's commands.
+# Entries whose matcher is a plain Predicate are indexed by its conditions; others are indexed by the conditions given to Insert, if any. Entries with
+# neither (e.g. assigned directly with [] with a custom matcher) are wildcards and are always candidates.
+# Iteration order is unchanged and candidates are returned in insertion order, so first come, first served still holds.
+class RelayTable(OrderedDict):
+    def __init__(self):
+        super().__init__()
+        self._sequence = count()
+        self._routes = {}  # key -> (index name, index key, sequence number)
+        self._by_author = {}
+        self._by_command = {}
+        self._by_channel = {}
+        self._by_private = {}
+        self._prefixes = PrefixTrie()
+        self._wildcards = {}
+        self.names = {}  # key -> OutputName of the entry's output
+        self.origins = {}  # key -> (owner, monotonic time registered)
+        self.version = 0  # Goes up whenever an entry is added or removed, so callers can tell cheaply whether the table changed.
+
+    # owner is whatever the entry is registered on behalf of, for LiveHandlers; re-inserting an entry without one keeps its owner and age.
+    def Insert(self, key, entry, author_id=None, channel_id=None, starts_with=None, is_private=None, command=None, owner=None):
+        origin = None
+        if key in self:  # Re-inserting keeps the entry's place in line, as with a plain OrderedDict.
+            origin = self.origins.get(key)
+            sequence = self._Unindex(key)
+        else:
+            sequence = next(self._sequence)
+        self.version += 1
+        super().__setitem__(key, entry)
+        self.names[key] = OutputName(entry[1])
+        self.origins[key] = origin if origin is not None and owner is None else (owner, monotonic())
+        matcher = entry[0]
+        if type(matcher) is Predicate and not matcher.match_any and not matcher.negate:
+            author_id, channel_id, starts_with, is_private = matcher.author_id, matcher.channel_id, matcher.starts_with, matcher.is_private
+            command = matcher.command
+        if author_id is not None:
+            self._by_author.setdefault(author_id, {})[key] = sequence
+            self._routes[key] = ("author", author_id, sequence)
+        elif command is not None:
+            command = command.lower()
+            self._by_command.setdefault(command, {})[key] = sequence
+            self._routes[key] = ("command", command, sequence)
+        elif channel_id is not None:
+            self._by_channel.setdefault(channel_id, {})[key] = sequence
+            self._routes[key] = ("channel", channel_id, sequence)
+        elif starts_with:
+            self._prefixes.Add(starts_with, key, sequence)
+            self._routes[key] = ("prefix", starts_with, sequence)
+        elif is_private is not None:
+            self._by_private.setdefault(bool(is_private), {})[key] = sequence
+            self._routes[key] = ("private", bool(is_private), sequence)
+        else:
+            self._wildcards[key] = sequence
+            self._routes[key] = ("wildcard", None, sequence)
+
+    def __setitem__(self, key, entry):
+        if key in self and entry[0] is self[key][0]:  # Replacing an entry's output or closures keeps its place and its conditions.
+            super().__setitem__(key, entry)
+            self.names[key] = OutputName(entry[1])
+        else:
+            self.Insert(key, entry)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._Unindex(key)
+
+    def pop(self, key, *args):
+        if key not in self:
+            return super().pop(key, *args)
+        entry = self[key]
+        del self[key]
+        return entry
+
+    def clear(self):
+        version = self.version
+        super().clear()
+        self.__init__()
+        self.version = version + 1
+
+    # The author ids entries are indexed under, e.g. the users whose DMs a root switchboard routes into scopes.
+    def Authors(self):
+        return self._by_author.keys()
+
+    # Returns the sequence number the entry was filed under.
+    def _Unindex(self, key):
+        self.version += 1
+        del self.names[key]
+        del self.origins[key]
+        index, index_key, sequence = self._routes.pop(key)
+        if index == "prefix":
+            self._prefixes.Remove(index_key, key)
+        elif index == "wildcard":
+            del self._wildcards[key]
+        else:
+            buckets = {"author": self._by_author, "command": self._by_command, "channel": self._by_channel, "private": self._by_private}[index]
+            bucket = buckets[index_key]
+            del bucket[key]
+            if not bucket:
+                del buckets[index_key]
+        return sequence
+
+    # Returns a snapshot list of (key, entry) for the entries that could match the message, in insertion order. Takes a MessageEnvelope.
+    def Candidates(self, envelope):
+        buckets = []
+        if self._wildcards:
+            buckets.append(self._wildcards)
+        if self._by_author:
+            bucket = self._by_author.get(envelope.author_id)
+            if bucket:
+                buckets.append(bucket)
+        if self._by_command and envelope.command is not None:
+            bucket = self._by_command.get(envelope.command)
+            if bucket:
+                buckets.append(bucket)
+        if self._by_channel:
+            bucket = self._by_channel.get(envelope.channel_id)
+            if bucket:
+                buckets.append(bucket)
+        if self._prefixes.size:
+            buckets.extend(self._prefixes.Matches(envelope.content))
+        if self._by_private:
+            bucket = self._by_private.get(envelope.is_private)
+            if bucket:
+                buckets.append(bucket)
+        if not buckets:
+            return []
+        if len(buckets) == 1:  # Each bucket is already in insertion order.
+            return [(key, self[key]) for key in buckets[0]]
+        found = {}
+        for bucket in buckets:
+            found.update(bucket)
+        return [(key, self[key]) for key in sorted(found, key=found.__getitem__)]
+
+
+def _CurrentTask():
+    try:
+        return asyncio.current_task()
+    except AttributeError:  # Python < 3.7
+        return asyncio.Task.current_task()
+    except RuntimeError:  # No running loop
+        return None
+
+
+# The per-lane state for a lane-mode switchboard. waiting counts the messages holding or queued on the lock, so idle lanes can be dropped.
+class _Lane:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+        self.deferred_actions = []
+
+
+# Wraps an output so that it is called as output(message, envelope), with the message's MessageEnvelope, and can use the already parsed
+# command and arguments. RegisterOutput(..., with_envelope=True) does this for you.
+class EnvelopeOutput:
+    __slots__ = ("output",)
+
+    def __init__(self, output):
+        self.output = output
+
+    def __call__(self, message, envelope):
+        return self.output(message, envelope)
+
+
+async def _Passed():
+    return None
+
+
+# Holds an output through a weak reference (a WeakMethod for bound methods), so that the registration doesn't keep the output's object alive. Once
+# the object is gone the output passes, and on_death(self) is called so the switchboard can drop the entry. Called as (message, envelope), like
+# EnvelopeOutput, and calls the output with the envelope only if with_envelope.
+class WeakOutput:
+    __slots__ = ("ref", "name", "with_envelope", "__weakref__")
+
+    def __init__(self, output, with_envelope=False, on_death=None):
+        callback = None if on_death is None else lambda ref, self_ref=weakref.ref(self): self_ref() is not None and on_death(self_ref())
+        reference = weakref.WeakMethod if hasattr(output, "__self__") and hasattr(output, "__func__") else weakref.ref
+        self.ref = reference(output, callback)
+        self.name = OutputName(output)
+        self.with_envelope = with_envelope
+
+    def __call__(self, message, envelope):
+        output = self.ref()
+        if output is None:
+            return _Passed()
+        return output(message, envelope) if self.with_envelope else output(message)
+
+
+# The name entries are labelled with in metrics: the qualified name of the output (looking through partials), or its type for other callables. A
+# route into a scope is labelled with the scope's name (e.g. "scope:game-123"), so that each scope's traffic is counted apart.
+def OutputName(output):
+    while isinstance(output, (partial, EnvelopeOutput)):
+        output = output.func if isinstance(output, partial) else output.output
+    if type(output) is WeakOutput:
+        return output.name
+    if type(output) is DiscordSwitchboard:
+        return "scope:" + output.name
+    name = getattr(output, "__qualname__", None)
+    return name if isinstance(name, str) else type(output).__name__
+
+
 # A decorator. Function must have no return value.
 def SafeLock(func):
     def new_func(self, *args, **kwargs):
@@ -31,22 +403,25 @@ def SafeLock(func):
     return new_func
     
 class DiscordSwitchboard:
-    def __init__(self):
+    def __init__(self, lanes=False, metrics=None, tasks=None):
         self.lock = threading.Lock()
+        self.tasks = TaskSupervisor(limits=OUTPUT_LIMITS) if tasks is None else tasks
         # Internal only.
         self._overriding = OrderedDict()
-        # All conditional relays are of the form OrderedDict[id: (matching_coroutine(message)->bool, output_coroutine(message) OR DiscordSwitchboard), Closure (run when done)].
+        # All conditional relays are of the form OrderedDict[id: (matching_coroutine(message)->bool OR Predicate, output_coroutine(message) OR DiscordSwitchboard), Closure (run when done)].
         # where id is id(matching_coroutine) to facilitate look-up. Hold onto the functor or id if you wish to remove/modify this later. (id is returned by all relevant utility functions)
         # Note that for priority_relay the output_coroutine is expect to return a value (None if the output "passes (chooses to do nothing and should be passed to next ouput)", False if the message was not processed, True if it was processed succesfully.)
         
         # Note that id is for the _coroutine_, not the Task. Use functools.partial if you wish to anonymize a coroutine.
         
         # You are free to add your own matcher/output, but the utility functions are recommended for this purpose. If you do do so, remember to take the lock first.
+        # The conditional relays are RelayTables, which index entries by their routing conditions. Entries you add directly by key are
+        # treated as wildcards (checked for every message); use RelayTable.Insert with the conditions if you want them indexed.
         
         # For priority relay
-        self.priority_relay = OrderedDict()  # Meant for dedicated lines. Checked _first_, and the first matching_coroutine that returns true will be the only one to output (unless it returns None). First come, first served.
-        self.general_relay = OrderedDict()  # Checked after priority. All matches are processed and will output asynchronously (outputs will not block each other, but all matches are checked first)
-        self.blocking_relay = OrderedDict()  # Checked after general relay. Matches and outputs are processed in order and will block. First come, first served.
+        self.priority_relay = RelayTable()  # Meant for dedicated lines. Checked _first_, and the first matching_coroutine that returns true will be the only one to output (unless it returns None). First come, first served.
+        self.general_relay = RelayTable()  # Checked after priority. All matches are processed and will output asynchronously (outputs will not block each other, but all matches are checked first)
+        self.blocking_relay = RelayTable()  # Checked after general relay. Matches and outputs are processed in order and will block. First come, first served.
         # list[output_coroutine(message)]  # Run last, only if nothing else matched. Unconditional, asynchronous. Keys are id(output)
         self.fallback_relay = OrderedDict() 
         self.priority_dict = {PriorityLevel.PRIORITY: self.priority_relay,
@@ -60,11 +435,85 @@ class DiscordSwitchboard:
         self._is_active = False
         self._deferred_actions = []
         self._deferred_actions_async = []
+
+        # Lane mode. The main lock is then only ever held for synchronous registration changes, never across an await.
+        self.lanes = lanes
+        self._lanes = {}  # lane key -> _Lane
+        self._lane_tasks = {}  # Task currently dispatching -> its _Lane, so registration changes can be deferred to the right lane.
+
+        # Scopes. parent is the switchboard this one was created from with CreateScope, and _routes the ids of its entries in the parent's priority relay.
+        self.name = "root"
+        self.parent = None
+        self._routes = []
+
+        # (priority, id, WeakOutput) of weak outputs whose object is gone, appended by the weak reference callback (which can run at any point) and
+        # removed from the relays at the start of the next on_message.
+        self._dead = []
+
+        # Instrumentation, if metrics (a MetricsRegistry) is given.
+        self.metrics = metrics
+        self._entry_stats = {}  # (relay name, entry name) -> (hit counter, miss counter, output latency histogram)
+        if metrics is not None:
+            self._matcher_seconds = {relay_name: metrics.Histogram("switchboard_matcher_seconds", "Time to evaluate one relay entry's matcher",
+                                                                   relay=relay_name)
+                                     for relay_name in ("priority", "general", "blocking")}
+            mode = "lane" if lanes else "global"
+            self._lock_wait_seconds = metrics.Histogram("switchboard_lock_wait_seconds", "Time on_message waited for the dispatch lock", mode=mode)
+            self._lock_hold_seconds = metrics.Histogram("switchboard_lock_hold_seconds", "Time on_message held the dispatch lock", mode=mode)
+            self._deferred_count = metrics.Histogram("switchboard_deferred_actions", "Registration changes deferred until a dispatch finished",
+                                                     buckets=SIZE_BUCKETS)
         
-    async def __call__(self, message):
-        await on_message(message)
+    # Used when this switchboard is nested as the output of another. A nested switchboard that didn't process the message passes (returns None),
+    # so that the parent goes on to offer it to its other outputs.
+    async def __call__(self, message, envelope=None):
+        return_val = await self.on_message(message, envelope)
+        return return_val if return_val else None
+
+    # Creates a child switchboard that receives the messages matching conditions (same arguments as RegisterOutput), plus anything later added with
+    # AddRoute. Routes live in this switchboard's indexed priority relay, so the cost of reaching a scope doesn't grow with the number of scopes.
+    # The scope's tasks are supervised by a child of this switchboard's supervisor, called name.
+    def CreateScope(self, name="scope", **conditions):
+        # Nested switchboards must use the same mode, see the module docstring.
+        scope = DiscordSwitchboard(lanes=self.lanes, metrics=self.metrics, tasks=self.tasks.Child(name))
+        scope.name = name
+        scope.parent = self
+        scope.AddRoute(**conditions)
+        return scope
+
+    # Routes messages matching conditions from the parent into this scope, and returns the id of the route. Does nothing for a root switchboard,
+    # which already sees everything.
+    def AddRoute(self, **conditions):
+        if self.parent is None:
+            return None
+        route_id = self.parent.RegisterOutput(self, PriorityLevel.PRIORITY, owner=self.name, **conditions)
+        self._routes.append(route_id)
+        return route_id
+
+    def RemoveRoute(self, route_id):
+        self._routes.remove(route_id)
+        self.parent.RunOrDeferIfActive(partial(self.parent._RemoveOutput, route_id, PriorityLevel.PRIORITY))
+
+    # Removes every route into this scope from its parent, and cancels the scope's tasks (except the one calling this). The scope's own relays are
+    # left alone, but nothing will reach them anymore.
+    def Detach(self):
+        if self.parent is None:
+            return
+        for route_id in self._routes:
+            self.parent.RunOrDeferIfActive(partial(self.parent._RemoveOutput, route_id, PriorityLevel.PRIORITY))
+        self._routes.clear()
+        if self.metrics is not None:
+            self.parent._DropEntryStats(OutputName(self))
+        self.tasks.Close()
     
     def RunOrDeferIfActive(self, func):
+        if self.lanes:
+            lane = self._lane_tasks.get(_CurrentTask()) if self._lane_tasks else None
+            if lane is not None:
+                lane.deferred_actions.append(func)
+            else:
+                with self.lock:
+                    func()
+            return
         with self.active_lock:
             if self._is_active:
                 self._deferred_actions.append(func)
@@ -74,85 +523,199 @@ class DiscordSwitchboard:
 
     # returns False if the message is not processed by anything, or the output of a successful priority_relay output, or True if something processed the message.
     # priority_relay outputs can also return False or None if they wish to signal a failure (which will also prevent the operation of all closures, self-removal, etc.)
-    async def on_message(self, message):
+    # envelope is the message's MessageEnvelope, if the caller already has one.
+    async def on_message(self, message, envelope=None):
+        if envelope is None:
+            envelope = MessageEnvelope(message)
+        if self._dead:
+            self.RunOrDeferIfActive(self._PurgeDead)
+        if self.lanes:
+            return await self._DispatchInLane(message, envelope)
+        start = perf_counter()
         with self.lock:  # This is unfortunate but necessary.
+            acquired = perf_counter()
             with self.active_lock:
                 self._is_active = True
-            return_val = None
-            while True:
-                for matcher, output, closure_list in self._overriding.values():
-                    if await matcher(message):
-                        return_val = await output(message)
-                        if return_val is not None and return_val:
-                            if closure_list is not None:
-                                for closure in closure_list:
-                                    await closure()
-                            break
-                if return_val is not None:
-                    break
-                for matcher, output, closure_list in self.priority_relay.values():
-                    if await matcher(message):
-                        return_val = await output(message)
-                        if return_val is not None:
-                            if return_val:
-                                if closure_list is not None:
-                                    for closure in closure_list:
-                                        await closure()
-                                break
-                            else:
-                                break
-                        
-                if return_val is not None:
-                    break
-                any_found = False
-                
-                # This is awkward but necessary.
-                value_list = list(self.general_relay.values())
-                matchers = [asyncio.ensure_future(value[0](message)) for value in value_list]
-                matches = await asyncio.gather(*matchers)
-                all_closures = []
-                for index, match in enumerate(matches):
-                    if match:
-                        asyncio.run_coroutine_threadsafe(value_list[index][1](message), asyncio.get_event_loop())
-                        if value_list[index][2]:
-                            all_closures.extend(value_list[index][2])
-                        any_found = True
-                
-                for matcher, output, closure_list in self.blocking_relay.values():
-                    if await matcher(message):
-                        await output(message)
-                        if closure_list is not None:
-                            all_closures.extend(closure_list)
-                        any_found = True
-
-                if not self.fallback_relay:
-                    for closure in all_closures:
-                        asyncio.run_coroutine_threadsafe(closure(), asyncio.get_event_loop())
-                    return_val = any_found
-                    break
-                
-                if not any_found:
-                    for output, closure_list in self.fallback_relay.values():
-                        asyncio.run_coroutine_threadsafe(output(message), asyncio.get_event_loop())
-                        if closure_list is not None:
-                            all_closures.extend(closure_list)
-                for closure in all_closures:
-                    asyncio.run_coroutine_threadsafe(closure(), asyncio.get_event_loop())
-                return_val = True
-                break
+            return_val = await self._Dispatch(message, envelope)
             with self.active_lock:
                 self._is_active = False
+                if self.metrics is not None:
+                    self._deferred_count.Observe(len(self._deferred_actions) + len(self._deferred_actions_async))
                 for action in self._deferred_actions:
                     action()
                 self._deferred_actions.clear()
                 for action in self._deferred_actions_async:
                     await action()
                 self._deferred_actions_async.clear()
-        
-    
+        if self.metrics is not None:
+            self._lock_wait_seconds.Observe(acquired - start)
+            self._lock_hold_seconds.Observe(perf_counter() - acquired)
+        return return_val
+
+    # Private channels get one lane per author, everything else one lane per channel.
+    @staticmethod
+    def LaneKey(envelope):
+        if envelope.is_private:
+            return ("author", envelope.author_id)
+        return ("channel", envelope.channel_id)
+
+    async def _DispatchInLane(self, message, envelope):
+        key = self.LaneKey(envelope)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane()
+        lane.waiting += 1
+        start = perf_counter()
+        try:
+            async with lane.lock:
+                acquired = perf_counter()
+                task = _CurrentTask()
+                self._lane_tasks[task] = lane
+                try:
+                    return_val = await self._Dispatch(message, envelope)
+                finally:
+                    del self._lane_tasks[task]
+                    if self.metrics is not None:
+                        self._deferred_count.Observe(len(lane.deferred_actions))
+                    with self.lock:
+                        for action in lane.deferred_actions:
+                            action()
+                    lane.deferred_actions.clear()
+                if self.metrics is not None:
+                    self._lock_wait_seconds.Observe(acquired - start)
+                    self._lock_hold_seconds.Observe(perf_counter() - acquired)
+        finally:
+            lane.waiting -= 1
+            if not lane.waiting:
+                del self._lanes[key]
+        return return_val
+
+    def _EntryStats(self, relay_name, entry_name):
+        stats = self._entry_stats.get((relay_name, entry_name))
+        if stats is None:
+            help = "Relay entries whose matcher was run on a message, by whether it matched"
+            stats = self._entry_stats[(relay_name, entry_name)] = (
+                self.metrics.Counter("switchboard_entry_matches_total", help, relay=relay_name, entry=entry_name, result="hit"),
+                self.metrics.Counter("switchboard_entry_matches_total", help, relay=relay_name, entry=entry_name, result="miss"),
+                self.metrics.Histogram("switchboard_output_seconds", "Time spent in a relay entry's output", relay=relay_name, entry=entry_name))
+        return stats
+
+    # Stops reporting the metrics of entries labelled entry_name, e.g. a detached scope's routes.
+    def _DropEntryStats(self, entry_name):
+        for relay_name, name in [key for key in self._entry_stats if key[1] == entry_name]:
+            del self._entry_stats[(relay_name, name)]
+            for result in ("hit", "miss"):
+                self.metrics.Remove("switchboard_entry_matches_total", relay=relay_name, entry=entry_name, result=result)
+            self.metrics.Remove("switchboard_output_seconds", relay=relay_name, entry=entry_name)
+
+    # Runs a relay entry's matcher, recording metrics if enabled. Only matchers that aren't Predicates are awaited.
+    async def _Match(self, relay_name, entry_name, matcher, message, envelope):
+        if self.metrics is None:
+            if type(matcher) is Predicate:
+                return matcher(envelope)
+            return await matcher(message)
+        start = perf_counter()
+        matched = matcher(envelope) if type(matcher) is Predicate else await matcher(message)
+        self._matcher_seconds[relay_name].Observe(perf_counter() - start)
+        self._EntryStats(relay_name, entry_name)[0 if matched else 1].Inc()
+        return matched
+
+    # Runs an output, recording metrics if enabled. Nested switchboards are handed the envelope so they don't rebuild it.
+    async def _Output(self, relay_name, entry_name, output, message, envelope):
+        start = perf_counter()
+        try:
+            if type(output) is DiscordSwitchboard or type(output) is EnvelopeOutput or type(output) is WeakOutput:
+                return await output(message, envelope)
+            return await output(message)
+        finally:
+            if self.metrics is not None:
+                self._EntryStats(relay_name, entry_name)[2].Observe(perf_counter() - start)
+
+    # The routing itself. The caller is responsible for serialization and for running deferred actions afterwards.
+    async def _Dispatch(self, message, envelope):
+        return_val = None
+        while True:
+            for matcher, output, closure_list in self._overriding.values():
+                if (matcher(envelope) if type(matcher) is Predicate else await matcher(message)):
+                    return_val = await output(message)
+                    if return_val is not None and return_val:
+                        if closure_list is not None:
+                            for closure in closure_list:
+                                await closure()
+                        break
+            if return_val is not None:
+                break
+            names = self.priority_relay.names
+            for key, (matcher, output, closure_list) in self.priority_relay.Candidates(envelope):
+                name = names.get(key)
+                if await self._Match("priority", name, matcher, message, envelope):
+                    return_val = await self._Output("priority", name, output, message, envelope)
+                    if return_val is not None:
+                        if return_val:
+                            if closure_list is not None:
+                                for closure in closure_list:
+                                    await closure()
+                            break
+                        else:
+                            break
+                    
+            if return_val is not None:
+                break
+            any_found = False
+            
+            # This is awkward but necessary. Predicates are evaluated on the spot; only other matchers are gathered.
+            names = self.general_relay.names
+            value_list = [(names.get(key), value) for key, value in self.general_relay.Candidates(envelope)]
+            matches = [None] * len(value_list)
+            pending = []
+            for index, (name, value) in enumerate(value_list):
+                if type(value[0]) is Predicate and self.metrics is None:
+                    matches[index] = value[0](envelope)
+                else:
+                    pending.append((index, asyncio.ensure_future(self._Match("general", name, value[0], message, envelope))))
+            if pending:
+                for (index, _), match in zip(pending, await asyncio.gather(*(future for _, future in pending))):
+                    matches[index] = match
+            all_closures = []
+            for index, match in enumerate(matches):
+                if match:
+                    name, value = value_list[index]
+                    self.tasks.Spawn(self._Output("general", name, value[1], message, envelope), "general")
+                    if value[2]:
+                        all_closures.extend(value[2])
+                    any_found = True
+            
+            names = self.blocking_relay.names
+            for key, (matcher, output, closure_list) in self.blocking_relay.Candidates(envelope):
+                name = names.get(key)
+                if await self._Match("blocking", name, matcher, message, envelope):
+                    await self._Output("blocking", name, output, message, envelope)
+                    if closure_list is not None:
+                        all_closures.extend(closure_list)
+                    any_found = True
+
+            if not self.fallback_relay:
+                for closure in all_closures:
+                    self.tasks.Spawn(closure())
+                return_val = any_found
+                break
+            
+            if not any_found:
+                for output, closure_list in self.fallback_relay.values():
+                    self.tasks.Spawn(self._Output("fallback", OutputName(output), output, message, envelope), "fallback")
+                    if closure_list is not None:
+                        all_closures.extend(closure_list)
+            for closure in all_closures:
+                self.tasks.Spawn(closure())
+            return_val = True
+            break
+        return return_val
+
     @staticmethod
     async def message_ignored(message):
         return False
+
+    # The coroutine checkers below are kept for callers building their own async matchers; the switchboard itself compiles conditions into Predicates.
     
     @staticmethod
     async def author_check(id, message, polarity=True):
@@ -174,6 +737,20 @@ class DiscordSwitchboard:
     async def private_check(message, polarity=True):
         return message.channel.is_private == polarity
     
+    # Not Safe. Drops the entries of weak outputs that died, unless the entry has since been replaced.
+    def _PurgeDead(self):
+        while self._dead:
+            priority, id, output = self._dead.pop()
+            relay = self.priority_dict[priority]
+            entry = relay.get(id)
+            if entry is not None and entry[1] is output:
+                del relay[id]
+
+    # Removes an output by the id RegisterOutput returned. Does nothing if it has already been removed.
+    @SafeLock
+    def RemoveOutput(self, id, priority):
+        self.priority_dict[priority].pop(id, None)
+
     # Not Safe, used as closures.
     def _RemoveOutput(self, id, priority):
         del self.priority_dict[priority][id]
@@ -207,44 +784,50 @@ class DiscordSwitchboard:
     
     # These affect this class, forcing the class to acknowledge only certain messages. Using named arguments is highly recommended.
     # Setting any=True causes this class to accept messages that meet _any_ condition, rather than all. Currently, this is irreversible.
-    def MustHave(self, author_id=None, channel_id=None, mentions=None, starts_with=None, is_private=None, any=False):
-        # If any = True, we want checkers to return positive checks then check until one is True. Otherwise, we want them to return negative checks.
-        checkers = self.GetCheckers(author_id, channel_id, mentions, starts_with, is_private, polarity=any)
-        if checkers:
-            async def any_checker(message):
-                for checker in checkers:
-                    if await checker(message):
-                        return (not any)  # If any, then this means a checker was True, which means we _don't_ want the message ignored. If not any, then this means we do want it ignored.
-                return any
+    def MustHave(self, author_id=None, channel_id=None, mentions=None, starts_with=None, is_private=None, any=False, command=None):
+        # The overriding matcher picks the messages to ignore: those where the conditions (any or all of them) don't hold.
+        ignore_checker = Predicate(author_id, channel_id, mentions, starts_with, is_private, command, match_any=any, negate=True)
+        if ignore_checker:
             def func():
-                a_checker = lambda x: any_checker(x)
-                self._overriding[id(a_checker)] = (a_checker, self.message_ignored, None)
+                self._overriding[id(ignore_checker)] = (ignore_checker, self.message_ignored, None)
             self.RunOrDeferIfActive(func)
     
     # These add outputs to the priority relay, with given conditions optionally. The conditions are ignored for the fallbacks.
-    def RegisterOutput(self, output, priority, author_id=None, channel_id=None, mentions=None, starts_with=None, is_private=None, remove_self_when_done=False, remove_when_done=None, closure_list=None):
+    # command matches the message's command word exactly (see MessageEnvelope). With with_envelope=True the output is called as output(message, envelope)
+    # and can read the parsed command and arguments off the envelope instead of parsing message.content again; the returned id is unaffected.
+    # owner labels the entry in LiveHandlers (see Registrations). With weak=True the output is held through a weak reference, see WeakOutput; weak
+    # outputs can't be fallbacks.
+    def RegisterOutput(self, output, priority, author_id=None, channel_id=None, mentions=None, starts_with=None, is_private=None, remove_self_when_done=False, remove_when_done=None, closure_list=None,
+                       command=None, with_envelope=False, owner=None, weak=False):
+        if weak:
+            if priority == PriorityLevel.FALLBACK:
+                raise ValueError("Fallback outputs can't be weak")
+            output = WeakOutput(output, with_envelope, lambda dead: self._dead.append((priority, key, dead)))
+        elif with_envelope:
+            output = EnvelopeOutput(output)
         if priority == PriorityLevel.FALLBACK:
             # Determine closures
             closure_list = [] if closure_list is None else closure_list
             if remove_self_when_done:
                 closure_list.append(partial(self._RemoveOutputAsync, id(output), priority))
             if remove_when_done is not None:
-                for closure_id, priority in remove_when_done:
-                    closure_list.append(partial(self._RemoveOutputAsync, closure_id, priority))
-            with self.lock:
-                self.priority_dict[priority].append(output, closure_list)
+                for closure_id, closure_priority in remove_when_done:
+                    closure_list.append(partial(self._RemoveOutputAsync, closure_id, closure_priority))
+            def func():
+                self.fallback_relay[id(output)] = (output, closure_list)
+            self.RunOrDeferIfActive(func)
             return id(output)
-        checkers = self.GetCheckers(author_id, channel_id, mentions, starts_with, is_private)
-        this_checker = partial(self.CheckConditions, checkers)
+        this_checker = Predicate(author_id, channel_id, mentions, starts_with, is_private, command)
+        key = id(this_checker)
         # Determine closures
         closure_list = [] if closure_list is None else closure_list
         if remove_self_when_done:
             closure_list.append(partial(self._RemoveOutputAsync, id(this_checker), priority))
         if remove_when_done is not None:
-            for closure_id, priority in remove_when_done:
-                closure_list.append(partial(self._RemoveOutputAsync, closure_id, priority))  
+            for closure_id, closure_priority in remove_when_done:  # Don't shadow priority, it's used below.
+                closure_list.append(partial(self._RemoveOutputAsync, closure_id, closure_priority))
         def func():
-            self.priority_dict[priority][id(this_checker)] = (this_checker, output, closure_list)
+            self.priority_dict[priority].Insert(id(this_checker), (this_checker, output, closure_list), owner=owner)
         self.RunOrDeferIfActive(func)
         return id(this_checker)
         
@@ -252,8 +835,53 @@ class DiscordSwitchboard:
     @SafeLock
     def AddClosure(self, id, priority, closure):
         self.priority_dict[priority][id][2].append(closure)
-    
-    
-    
-    
-    
\ No newline at end of file
+
+    # A handle that registers outputs on this switchboard under owner and releases them together, see Registrations.
+    def Registrations(self, owner):
+        return Registrations(self, owner)
+
+    # Every entry of every relay, this switchboard's and its nested switchboards', as a list of (path, owner, relay name, entry name, age in
+    # seconds). path names the switchboards from this one down (e.g. "root/game-123"); owner and age are None for entries added without
+    # RegisterOutput, and for fallbacks. A nested switchboard routed to more than once is listed once.
+    def LiveHandlers(self, now=None, path=None, _seen=None):
+        now = monotonic() if now is None else now
+        path = self.name if path is None else path
+        seen = {id(self)} if _seen is None else _seen
+        handlers = []
+        for relay_name, relay in (("overriding", self._overriding), ("priority", self.priority_relay), ("general", self.general_relay),
+                                  ("blocking", self.blocking_relay), ("fallback", self.fallback_relay)):
+            names = getattr(relay, "names", {})
+            origins = getattr(relay, "origins", {})
+            for key, entry in list(relay.items()):
+                output = entry[1] if len(entry) == 3 else entry[0]
+                owner, registered = origins.get(key, (None, None))
+                handlers.append((path, owner, relay_name, names.get(key) or OutputName(output), None if registered is None else now - registered))
+                if type(output) is DiscordSwitchboard and id(output) not in seen:
+                    seen.add(id(output))
+                    handlers.extend(output.LiveHandlers(now, path + "/" + output.name, seen))
+        return handlers
+
+
+# Registers outputs on a switchboard on behalf of one owner (e.g. a player), and removes every one of them at once with Release, so that the owner
+# doesn't have to keep track of their ids. Takes the same arguments as DiscordSwitchboard.RegisterOutput, except owner.
+class Registrations:
+    def __init__(self, switchboard, owner):
+        self.switchboard = switchboard
+        self.owner = owner
+        self.ids = []  # (id, priority) of the outputs registered and not yet released
+
+    def RegisterOutput(self, output, priority, **conditions):
+        output_id = self.switchboard.RegisterOutput(output, priority, owner=self.owner, **conditions)
+        self.ids.append((output_id, priority))
+        return output_id
+
+    # Removes one output registered through this handle.
+    def Remove(self, output_id, priority):
+        self.ids.remove((output_id, priority))
+        self.switchboard.RemoveOutput(output_id, priority)
+
+    # Removes every output registered through this handle. Safe to call more than once.
+    def Release(self):
+        ids, self.ids = self.ids, []
+        for output_id, priority in ids:
+            self.switchboard.RemoveOutput(output_id, priority)
@@ -0,0 +1,235 @@
+"""Crash-safe persistence for live games: an append-only journal of game events plus periodic compact snapshots.
+
+Usage:
+
+1. Make a GameStore(directory) and call Load() once, before any game is created. It returns every game that was live when the bot last stopped, as
+   game id -> (header, state, events): rebuild each game from its state (None if it never made it into a snapshot) and replay its events in order,
+   then Track it. See CardsAgainstGovernance for how a game does that.
+2. Add new games with Add(game_id, header, game); header is whatever is needed to construct the game again (e.g. its packs and seed). Pass
+   Journal(game_id) to the game as its journal, and call Remove(game_id) when it ends.
+3. Start() the store. It fsyncs the journal every sync_interval seconds and writes a snapshot every snapshot_interval seconds. await Stop() on
+   shutdown, which writes a last snapshot.
+
+Journal records are pickled (game id, event) tuples, framed with their length and a CRC so that a record torn by a crash is recognized and dropped,
+with everything after it. Events written since the last fsync can be lost on a power failure (a crash of the bot alone loses nothing); that is the
+price of batching the fsyncs.
+
+A snapshot holds each game's pickled (header, state), and only games that changed since the last snapshot are pickled again. Taking one starts a new
+journal file, and older journal files are deleted once the snapshot is safely on disk, so recovery never replays more than snapshot_interval
+seconds of events, however long the games have been running.
+
+Everything here is meant to be used from the event loop thread. Snapshots and journal fsyncs take turns (see _lock), and a disk write that was
+handed to the executor is always waited for before the next one starts, even if whoever started it was cancelled, so that two snapshots never race
+on the same files.
+"""
+from struct import Struct
+from zlib import crc32
+import asyncio
+import logging
+import os
+import pickle
+
+logger = logging.getLogger(__name__)
+
+PICKLE_PROTOCOL = 4
+SNAPSHOT_VERSION = 1
+JOURNAL_PREFIX = "journal."
+SNAPSHOT_FILE = "snapshot"
+RECORD_HEADER = Struct('<II')  # Payload length, CRC32 of the payload
+
+
+# Reads the records of a journal file, stopping at the first one that is incomplete or corrupt.
+def ReadJournal(path):
+    records = []
+    with open(path, "rb") as f:
+        data = f.read()
+    position = 0
+    while position < len(data):
+        if position + RECORD_HEADER.size > len(data):
+            logger.warning("Journal %s ends in a partial record at byte %d", path, position)
+            break
+        length, checksum = RECORD_HEADER.unpack_from(data, position)
+        payload = data[position + RECORD_HEADER.size:position + RECORD_HEADER.size + length]
+        if len(payload) != length or crc32(payload) != checksum:
+            logger.warning("Journal %s has a torn record at byte %d; ignoring the rest", path, position)
+            break
+        records.append(pickle.loads(payload))
+        position += RECORD_HEADER.size + length
+    return records
+
+
+# An append-only file of records. Append hands each record to the OS straight away, so that it survives the process being killed; Sync fsyncs.
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+        self.pending = 0  # Records appended since the last Sync
+
+    def Append(self, record):
+        payload = pickle.dumps(record, PICKLE_PROTOCOL)
+        self.file.write(RECORD_HEADER.pack(len(payload), crc32(payload)))
+        self.file.write(payload)
+        self.file.flush()
+        self.pending += 1
+
+    def Sync(self):
+        if self.pending:
+            os.fsync(self.file.fileno())
+            self.pending = 0
+
+    def Close(self):
+        self.Sync()
+        self.file.close()
+
+
+class GameStore:
+    def __init__(self, directory, snapshot_interval=300, sync_interval=1.0):
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval
+        self.sync_interval = sync_interval
+        self.generation = 0  # Of the current journal file
+        self.journal = None
+        self._games = {}  # game id -> (header, game)
+        self._blobs = {}  # game id -> pickled (header, state) from the last snapshot
+        self._dirty = set()  # Games changed since the last snapshot
+        self._task = None
+        self._lock = asyncio.Lock()  # Held by Snapshot and Sync, so that a snapshot never closes the journal file an fsync is still working on
+        self._pending = None  # The latest disk write handed to the executor, which carries on even if its caller is cancelled
+        os.makedirs(directory, exist_ok=True)
+
+    def _JournalPath(self, generation):
+        return os.path.join(self.directory, "{}{:08d}".format(JOURNAL_PREFIX, generation))
+
+    def _JournalGenerations(self):
+        return sorted(int(name[len(JOURNAL_PREFIX):]) for name in os.listdir(self.directory)
+                      if name.startswith(JOURNAL_PREFIX) and name[len(JOURNAL_PREFIX):].isdigit())
+
+    # Returns the games that were live, as game id -> (header, state or None, [events]), and opens a new journal file to carry on in.
+    def Load(self):
+        games = {}
+        start = 0
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+            if snapshot["version"] != SNAPSHOT_VERSION:
+                raise ValueError("Unsupported snapshot version " + str(snapshot["version"]))
+            start = snapshot["journal"]
+            for game_id, blob in snapshot["games"].items():
+                header, state = pickle.loads(blob)
+                games[game_id] = (header, state, [])
+        generations = self._JournalGenerations()
+        for generation in generations:
+            if generation < start:
+                continue
+            for game_id, event in ReadJournal(self._JournalPath(generation)):
+                if event[0] == "create":
+                    games[game_id] = (event[1], None, [])
+                elif event[0] == "end":
+                    games.pop(game_id, None)
+                elif game_id in games:
+                    games[game_id][2].append(event)
+        # Never append to a file that might end in a torn record.
+        self.generation = max(generations[-1] + 1 if generations else 0, start)
+        self.journal = Journal(self._JournalPath(self.generation))
+        return games
+
+    # Starts persisting a new game.
+    def Add(self, game_id, header, game):
+        self.journal.Append((game_id, ("create", header)))
+        self.Track(game_id, header, game)
+
+    # Starts persisting a game rebuilt from Load, whose creation is already on record.
+    def Track(self, game_id, header, game):
+        self._games[game_id] = (header, game)
+        self._dirty.add(game_id)
+
+    # Returns the journal callable for a game: it records an event for the game.
+    def Journal(self, game_id):
+        def Record(event):
+            self.journal.Append((game_id, event))
+            self._dirty.add(game_id)
+        return Record
+
+    def Remove(self, game_id):
+        if self._games.pop(game_id, None) is None:
+            return
+        self.journal.Append((game_id, ("end",)))
+        self._blobs.pop(game_id, None)
+        self._dirty.discard(game_id)
+
+    # Runs function(*args) in the default executor. Call with _lock held.
+    async def _Write(self, function, *args):
+        if self._pending is not None and not self._pending.done():
+            await asyncio.shield(self._pending)  # Left running by a cancelled caller
+        self._pending = asyncio.get_event_loop().run_in_executor(None, function, *args)
+        await asyncio.shield(self._pending)
+
+    # Fsyncs the journal in the default executor, so that the event loop doesn't wait on the disk.
+    async def Sync(self):
+        async with self._lock:
+            if self.journal.pending:
+                self.journal.pending = 0
+                await self._Write(os.fsync, self.journal.file.fileno())
+
+    # Writes a snapshot of every game and moves on to a new journal file. Returns once the snapshot is on disk and the old journals are gone.
+    async def Snapshot(self):
+        async with self._lock:
+            if self._pending is not None and not self._pending.done():
+                await asyncio.shield(self._pending)  # An fsync of the journal about to be closed
+            await self._Snapshot()
+
+    async def _Snapshot(self):
+        # Everything up to writing the new snapshot's contents happens without yielding, so it matches the point the journal was cut at exactly.
+        self.journal.Close()
+        self.generation += 1
+        self.journal = Journal(self._JournalPath(self.generation))
+        for game_id in self._dirty:
+            if game_id in self._games:
+                header, game = self._games[game_id]
+                self._blobs[game_id] = pickle.dumps((header, game.GetState()), PICKLE_PROTOCOL)
+        self._dirty.clear()
+        data = pickle.dumps({"version": SNAPSHOT_VERSION, "journal": self.generation, "games": dict(self._blobs)}, PICKLE_PROTOCOL)
+        generation = self.generation
+        await self._Write(self._WriteSnapshot, data, generation)
+
+    def _WriteSnapshot(self, data, generation):
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        for old_generation in self._JournalGenerations():
+            if old_generation < generation:
+                os.remove(self._JournalPath(old_generation))
+
+    async def _Run(self):
+        since_snapshot = 0
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            since_snapshot += self.sync_interval
+            try:
+                if since_snapshot >= self.snapshot_interval:
+                    since_snapshot = 0
+                    await self.Snapshot()
+                else:
+                    await self.Sync()
+            except OSError:
+                logger.exception("Couldn't persist games to %s", self.directory)
+
+    def Start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._Run())
+
+    async def Stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.Snapshot()  # Waits for any write the cancelled task left running
+        self.journal.Sync()
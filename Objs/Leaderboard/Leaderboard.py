@@ -0,0 +1,168 @@
+"""A leaderboard of rounds won, kept across games, channels and seasons in a local SQLite database.
+
+Usage:
+
+1. Make a Leaderboard(path) and Start() it from within the event loop. await Stop() on shutdown, which writes whatever is still buffered.
+2. Give each game Recorder(channel_id) as the callable it reports wins to: recorder(user id, name) for every round won.
+3. await Top(...) and await Rank(...) answer leaderboard queries.
+
+Recording a win only appends it to an in-memory buffer. Every flush_interval seconds the buffer is aggregated and written in a single transaction, so
+the cost per round on the event loop stays the same however many games are playing. A batch that fails to write (e.g. the database is busy for
+longer than BUSY_TIMEOUT) stays buffered and is retried on the next flush. Wins still in the buffer when the bot crashes are lost.
+
+Only aggregates are stored: each user's points overall and per channel, for each season (see season_format) and for all time (season ALL_TIME).
+They are indexed by points, so top-N and rank queries only walk the part of the index above the entries they return, never the history of wins.
+Queries flush the buffer first, so they always see every win recorded before them.
+
+All database access happens on one thread of the leaderboard's own, so the event loop never waits on the disk. Several processes (e.g. shards) can
+share one database file.
+"""
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+ALL_TIME = "all"  # The season that adds up every season
+BUSY_TIMEOUT = 5000  # Milliseconds a write waits for another process (e.g. another shard) to let go of the database before failing
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS user_points (season TEXT NOT NULL, user_id TEXT NOT NULL, name TEXT, points INTEGER NOT NULL DEFAULT 0, "
+    "PRIMARY KEY (season, user_id))",
+    "CREATE INDEX IF NOT EXISTS user_points_rank ON user_points (season, points DESC)",
+    "CREATE TABLE IF NOT EXISTS channel_points (season TEXT NOT NULL, channel_id TEXT NOT NULL, user_id TEXT NOT NULL, name TEXT, "
+    "points INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (season, channel_id, user_id))",
+    "CREATE INDEX IF NOT EXISTS channel_points_rank ON channel_points (season, channel_id, points DESC)",
+)
+
+
+class Leaderboard:
+    # season_format is the time.strftime format (in UTC) that names the season a win falls in; the default makes a season of each month.
+    def __init__(self, path, flush_interval=1.0, season_format="%Y-%m"):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.season_format = season_format
+        self.pending = deque()  # (time, channel id, user id, name), in the order the wins happened
+        self.flushed = 0  # Wins written so far
+        self.flushes = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)  # The database's one thread
+        self._connection = None
+        self._task = None
+
+    def Season(self, when=None):
+        return time.strftime(self.season_format, time.gmtime(when))
+
+    # Returns the callable a game reports wins to.
+    def Recorder(self, channel_id):
+        append = self.pending.append
+        def Record(user_id, name):
+            append((time.time(), channel_id, user_id, name))
+        return Record
+
+    def _Connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT / 1000)
+            self._connection.execute("PRAGMA busy_timeout={}".format(BUSY_TIMEOUT))
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                self._connection.execute(statement)
+            self._connection.commit()
+        return self._connection
+
+    async def _Run(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+
+    # Writes every win buffered so far. If the write fails, the wins go back to the front of the buffer for the next flush.
+    async def Flush(self):
+        if not self.pending:
+            return
+        wins = []
+        while self.pending:
+            wins.append(self.pending.popleft())
+        try:
+            await self._Run(self._Write, wins)
+        except sqlite3.Error:  # Not on cancellation: the database thread carries on with the write regardless.
+            self.pending.extendleft(reversed(wins))
+            raise
+        self.flushed += len(wins)
+        self.flushes += 1
+
+    def _Write(self, wins):
+        user_points = Counter()  # (season, user id) -> points
+        channel_points = Counter()  # (season, channel id, user id) -> points
+        names = {}  # user id -> latest name
+        seasons = {}  # Seasons are usually the same for a whole batch, so each distinct time.strftime result is reused
+        for when, channel_id, user_id, name in wins:
+            season = seasons.get(int(when) // 3600)
+            if season is None:
+                season = seasons[int(when) // 3600] = self.Season(when)
+            for each_season in (season, ALL_TIME):
+                user_points[(each_season, user_id)] += 1
+                channel_points[(each_season, channel_id, user_id)] += 1
+            names[user_id] = name
+        connection = self._Connection()
+        with connection:
+            connection.executemany("INSERT OR IGNORE INTO user_points (season, user_id) VALUES (?, ?)", user_points.keys())
+            connection.executemany("UPDATE user_points SET points = points + ?, name = ? WHERE season = ? AND user_id = ?",
+                                   ((points, names[user_id], season, user_id) for (season, user_id), points in user_points.items()))
+            connection.executemany("INSERT OR IGNORE INTO channel_points (season, channel_id, user_id) VALUES (?, ?, ?)", channel_points.keys())
+            connection.executemany("UPDATE channel_points SET points = points + ?, name = ? WHERE season = ? AND channel_id = ? AND user_id = ?",
+                                   ((points, names[user_id], season, channel_id, user_id)
+                                    for (season, channel_id, user_id), points in channel_points.items()))
+
+    # The top number players of season (the current one if None), overall or in one channel, as a list of (name, points).
+    async def Top(self, number, season=None, channel_id=None):
+        await self.Flush()
+        return await self._Run(self._Top, number, self.Season() if season is None else season, channel_id)
+
+    def _Top(self, number, season, channel_id):
+        if channel_id is None:
+            query = "SELECT name, points FROM user_points WHERE season = ? ORDER BY points DESC, user_id LIMIT ?"
+            return self._Connection().execute(query, (season, number)).fetchall()
+        query = "SELECT name, points FROM channel_points WHERE season = ? AND channel_id = ? ORDER BY points DESC, user_id LIMIT ?"
+        return self._Connection().execute(query, (season, channel_id, number)).fetchall()
+
+    # A user's (rank, points, name) in season (the current one if None), overall or in one channel, or None if they haven't won a round there.
+    # Players with the same points share a rank.
+    async def Rank(self, user_id, season=None, channel_id=None):
+        await self.Flush()
+        return await self._Run(self._Rank, user_id, self.Season() if season is None else season, channel_id)
+
+    def _Rank(self, user_id, season, channel_id):
+        connection = self._Connection()
+        if channel_id is None:
+            table, where, args = "user_points", "season = ?", (season,)
+        else:
+            table, where, args = "channel_points", "season = ? AND channel_id = ?", (season, channel_id)
+        row = connection.execute("SELECT points, name FROM {} WHERE {} AND user_id = ?".format(table, where), args + (user_id,)).fetchone()
+        if row is None:
+            return None
+        ahead = connection.execute("SELECT COUNT(*) FROM {} WHERE {} AND points > ?".format(table, where), args + (row[0],)).fetchone()[0]
+        return ahead + 1, row[0], row[1]
+
+    async def _Loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.Flush()
+            except sqlite3.Error:
+                logger.exception("Couldn't write the leaderboard to %s", self.path)
+
+    def Start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._Loop())
+
+    async def Stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.Flush()
+        await self._Run(self._Close)
+        self._executor.shutdown(wait=False)
+
+    def _Close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,211 @@
+"""Lightweight in-process metrics: counters, gauges and fixed-bucket histograms, rendered in the Prometheus text format.
+
+Usage:
+
+1. Make a MetricsRegistry (or use DEFAULT_REGISTRY) and hand it to whatever should be instrumented.
+2. Get metrics once with registry.Counter/Gauge/Histogram(name, help, **labels) and keep hold of them; getting the same name and labels again returns
+   the same object. Updating a metric is then just an addition (plus a bisect for histograms), cheap enough to leave on under load. A counter or
+   gauge given a function is read from it when rendered instead, e.g. for a count something else already keeps.
+3. registry.RenderPrometheus() gives the text exposition format; PrometheusFileWriter writes it to a file periodically, for a node exporter's textfile
+   collector or similar. registry.Summary() gives a short human-readable digest.
+
+Everything here is meant to be used from the event loop thread and does no locking.
+"""
+from bisect import bisect_left
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, for latency histograms: 10us to 10s.
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds for small counts, e.g. queue lengths.
+SIZE_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+# A value that only goes up: incremented, or read from function each time the metric is rendered.
+class Counter:
+    kind = "counter"
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def Inc(self, amount=1):
+        self.value += amount
+
+    def Get(self):
+        return self.function() if self.function is not None else self.value
+
+    def Samples(self, name, labels):
+        yield name, labels, self.Get()
+
+
+# A value that is set, or read from function each time the metric is rendered.
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def Set(self, value):
+        self.value = value
+
+    def Get(self):
+        return self.function() if self.function is not None else self.value
+
+    def Samples(self, name, labels):
+        yield name, labels, self.Get()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last count is for values above every bucket
+        self.sum = 0
+        self.count = 0
+
+    def Observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # An estimate of the given quantile: the upper bound of the bucket it falls in.
+    def Quantile(self, fraction):
+        if not self.count:
+            return 0
+        target = fraction * self.count
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            if running >= target:
+                return bound
+        return float("inf")
+
+    def Samples(self, name, labels):
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            yield name + "_bucket", labels + (("le", repr(float(bound))),), running
+        yield name + "_bucket", labels + (("le", "+Inf"),), self.count
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, self.count
+
+
+def _EscapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._families = {}  # name -> (kind, help, {labels tuple: metric})
+
+    def _Get(self, cls, name, help, labels, *args):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (cls.kind, help, {})
+        elif family[0] != cls.kind:
+            raise ValueError(name + " is already registered as a " + family[0])
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = cls(*args)
+        return metric
+
+    def Counter(self, name, help="", function=None, **labels):
+        counter = self._Get(Counter, name, help, labels)
+        if function is not None:
+            counter.function = function
+        return counter
+
+    def Gauge(self, name, help="", function=None, **labels):
+        gauge = self._Get(Gauge, name, help, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def Histogram(self, name, help="", buckets=LATENCY_BUCKETS, **labels):
+        return self._Get(Histogram, name, help, labels, buckets)
+
+    # Stops reporting a metric, e.g. a gauge for something that no longer exists.
+    def Remove(self, name, **labels):
+        family = self._families.get(name)
+        if family is not None:
+            family[2].pop(tuple(sorted(labels.items())), None)
+
+    def RenderPrometheus(self):
+        lines = []
+        for name in sorted(self._families):
+            kind, help, metrics = self._families[name]
+            if help:
+                lines.append("# HELP " + name + " " + help.replace("\\", "\\\\").replace("\n", "\\n"))
+            lines.append("# TYPE " + name + " " + kind)
+            for labels in sorted(metrics):
+                for sample_name, sample_labels, value in metrics[labels].Samples(name, labels):
+                    if sample_labels:
+                        sample_name += "{" + ",".join(key + "=\"" + _EscapeLabel(label) + "\"" for key, label in sample_labels) + "}"
+                    lines.append(sample_name + " " + repr(float(value)))
+        return "\n".join(lines) + "\n"
+
+    # A short digest for humans: counters and gauges with their values, histograms with their count, p50 and p99. At most limit lines per metric name,
+    # busiest first.
+    def Summary(self, limit=5):
+        lines = []
+        for name in sorted(self._families):
+            kind, _, metrics = self._families[name]
+            if kind == "histogram":
+                rows = sorted(metrics.items(), key=lambda x: x[1].count, reverse=True)[:limit]
+                for labels, metric in rows:
+                    if metric.count:
+                        lines.append("{}{} n={} p50<={:g} p99<={:g}".format(name, _FormatLabels(labels), metric.count, metric.Quantile(0.5), metric.Quantile(0.99)))
+            else:
+                rows = sorted(((labels, metric.Get()) for labels, metric in metrics.items()),
+                              key=lambda x: x[1], reverse=True)[:limit]
+                for labels, value in rows:
+                    lines.append("{}{} {:g}".format(name, _FormatLabels(labels), value))
+        return "\n".join(lines)
+
+
+def _FormatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(key + "=" + str(value) for key, value in labels) + "}"
+
+
+# Periodically writes registry.RenderPrometheus() to path. The file is replaced atomically, so readers never see a partial write.
+class PrometheusFileWriter:
+    def __init__(self, registry, path, interval=15):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._task = None
+
+    def Write(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.registry.RenderPrometheus())
+        os.replace(temp_path, self.path)
+
+    async def _Run(self):
+        while True:
+            try:
+                self.Write()
+            except OSError:
+                logger.exception("Couldn't write metrics to %s", self.path)
+            await asyncio.sleep(self.interval)
+
+    def Start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._Run())
+
+    def Stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+DEFAULT_REGISTRY = MetricsRegistry()
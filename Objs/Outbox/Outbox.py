@@ -0,0 +1,226 @@
+"""An outbound message queue for a discord client.
+
+Usage:
+
+1. Make one Outbox(client) per client and share it, so that pacing is per destination rather than per caller.
+2. Call outbox.Send(destination, text) instead of client.send_message. It never blocks; delivery happens in a background task per destination.
+3. await outbox.Flush() if you need everything queued so far to be delivered (e.g. before logging out).
+4. To keep a single, current copy of something (e.g. a player's hand) instead of posting it again and again, Send it with a key. A keyed message
+   that is still queued is simply replaced by the next one with the same key. Once it has been sent, the next one edits it in place, as long as it
+   is still the latest message sent to that destination and the client can edit messages (has an edit_message coroutine); otherwise it is sent
+   as a new message.
+
+Messages are queued per destination (user or channel). Consecutive queued messages to the same destination are coalesced into a single send, as long
+as the result fits in discord's message limit, and each destination is paced by a token bucket so that bursts (e.g. dealing hands to every player at
+once) drain at a rate discord will accept instead of running into its rate limits. Keyed messages are always sent on their own, so that they can be
+edited later. GetStats reports queue depths, delivery latency and how many sends were saved by replacing or editing keyed messages.
+"""
+from collections import OrderedDict, deque
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 2000  # Discord's limit on the length of a single message
+LATENCY_SAMPLES = 1024  # How many recent delivery latencies GetStats works from
+EDITABLE_LIMIT = 4096  # How many destinations' latest keyed messages are kept around to be edited
+BUCKET_LIMIT = 4096  # How many destinations' token buckets are kept, most recently sent to; a forgotten one starts again full
+
+
+# Splits text into pieces no longer than limit, breaking on newlines where possible.
+def SplitMessage(text, limit=MESSAGE_LIMIT):
+    pieces = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            pieces.append(text[:limit])
+            text = text[limit:]
+        else:
+            pieces.append(text[:cut])
+            text = text[cut + 1:]
+    pieces.append(text)
+    return pieces
+
+
+# Swallows everything sent to it. Stands in for a game's Outbox while the game is being rebuilt, so replaying it doesn't repeat its messages.
+class NullOutbox:
+    def Send(self, destination, content, key=None):
+        pass
+
+
+# A classic token bucket: holds up to burst tokens, refilled at rate tokens per second.
+class TokenBucket:
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.last = clock()
+
+    def _Refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def TryTake(self, amount=1):
+        self._Refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    # Seconds until amount tokens will be available (0 if they already are).
+    def Delay(self, amount=1):
+        self._Refill()
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+
+# The queue for a single destination. Items are [content, enqueue time, key].
+class _Route:
+    def __init__(self, destination, bucket):
+        self.destination = destination
+        self.queue = deque()
+        self.bucket = bucket
+        self.worker = None
+
+
+class Outbox:
+    # rate and burst configure the token bucket of each destination. client only needs a send_message(destination, content) coroutine, which should
+    # return the message it sent if keyed messages are to be edited.
+    def __init__(self, client, rate=1.0, burst=5, limit=MESSAGE_LIMIT, separator="\n", clock=time.monotonic):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.limit = limit
+        self.separator = separator
+        self.clock = clock
+        self._routes = {}  # destination id -> _Route. Routes are dropped once drained, so this only holds destinations with pending messages.
+        self._buckets = OrderedDict()  # destination id -> TokenBucket, least recently sent to first. Outlives the routes, so pacing holds between bursts.
+        self._editable = OrderedDict()  # destination id -> (key, message) when the latest message sent there was keyed, least recently sent first
+
+        self.enqueued = 0
+        self.delivered = 0  # Messages handed to Send that have been sent (coalesced or not)
+        self.sends = 0  # Actual send_message calls
+        self.failed = 0
+        self.replaced = 0  # Keyed messages that took the place of one still queued
+        self.edits = 0  # Keyed messages delivered by editing the previous one
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    # key, if given, makes this the latest version of a message that should be replaced rather than repeated; see the module docstring.
+    def Send(self, destination, content, key=None):
+        route = self._routes.get(destination.id)
+        if route is None:
+            route = self._routes[destination.id] = _Route(destination, self._Bucket(destination.id))
+        self.enqueued += 1
+        if key is not None and route.queue and route.queue[-1][2] == key:
+            # The older version was never sent, so it counts as delivered along with this one.
+            route.queue[-1][0] = content
+            self.replaced += 1
+            self.delivered += 1
+            return
+        route.queue.append([content, self.clock(), key])
+        if route.worker is None:
+            route.worker = asyncio.ensure_future(self._Drain(route))
+
+    def _Bucket(self, destination_id):
+        bucket = self._buckets.get(destination_id)
+        if bucket is None:
+            bucket = self._buckets[destination_id] = TokenBucket(self.rate, self.burst, self.clock)
+            if len(self._buckets) > BUCKET_LIMIT:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(destination_id)
+        return bucket
+
+    # Waits until every message queued so far has been sent (or has failed).
+    async def Flush(self):
+        while True:
+            workers = [route.worker for route in self._routes.values() if route.worker is not None]
+            if not workers:
+                return
+            await asyncio.wait(workers)
+
+    # Takes as many queued messages from the front of the route as fit in one send. Returns the content, the enqueue times of the messages, and the
+    # key if it is a keyed message (which is always sent alone). A message too long for one send is split, and its pieces lose their key.
+    def _Coalesce(self, route):
+        content, enqueued_at, key = route.queue.popleft()
+        if len(content) > self.limit:
+            pieces = SplitMessage(content, self.limit)
+            # The remainder goes back to the front; it counts as delivered once its last piece is sent.
+            route.queue.appendleft([self.separator.join(pieces[1:]), enqueued_at, None])
+            return pieces[0], [], None
+        if key is not None:
+            return content, [enqueued_at], key
+        parts = [content]
+        times = [enqueued_at]
+        length = len(content)
+        while route.queue and route.queue[0][2] is None:
+            next_content = route.queue[0][0]
+            length += len(self.separator) + len(next_content)
+            if length > self.limit:
+                break
+            parts.append(next_content)
+            times.append(route.queue.popleft()[1])
+        return self.separator.join(parts), times, None
+
+    # Sends content, or edits the latest message sent to the route's destination if that has the same key. Returns the message sent.
+    async def _Deliver(self, route, content, key):
+        destination_id = route.destination.id
+        previous = self._editable.pop(destination_id, None)
+        if key is not None and previous is not None and previous[0] == key and hasattr(self.client, "edit_message"):
+            try:
+                sent = await self.client.edit_message(previous[1], content)
+                self.edits += 1
+                return sent
+            except Exception:
+                logger.warning("Couldn't edit a message to %s; sending it anew", destination_id, exc_info=True)
+        return await self.client.send_message(route.destination, content)
+
+    async def _Drain(self, route):
+        try:
+            while route.queue:
+                delay = route.bucket.Delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+                route.bucket.TryTake()
+                content, times, key = self._Coalesce(route)
+                try:
+                    sent = await self._Deliver(route, content, key)
+                except Exception:
+                    logger.exception("Failed to send a message to %s", route.destination.id)
+                    self.failed += len(times)
+                    continue
+                self.sends += 1
+                self.delivered += len(times)
+                if key is not None and sent is not None:
+                    self._editable[route.destination.id] = (key, sent)
+                    if len(self._editable) > EDITABLE_LIMIT:
+                        self._editable.popitem(last=False)
+                now = self.clock()
+                self.latencies.extend(now - enqueued_at for enqueued_at in times)
+        finally:
+            route.worker = None
+            if not route.queue and self._routes.get(route.destination.id) is route:
+                del self._routes[route.destination.id]
+
+    def GetStats(self):
+        depths = [len(route.queue) for route in self._routes.values()]
+        latencies = sorted(self.latencies)
+        stats = {"queued": sum(depths),
+                 "max_queue_depth": max(depths) if depths else 0,
+                 "destinations": len(depths),
+                 "enqueued": self.enqueued,
+                 "delivered": self.delivered,
+                 "sends": self.sends,
+                 "failed": self.failed,
+                 "replaced": self.replaced,
+                 "edits": self.edits}
+        if latencies:
+            stats["latency_p50"] = latencies[len(latencies) // 2]
+            stats["latency_p99"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            stats["latency_max"] = latencies[-1]
+        return stats
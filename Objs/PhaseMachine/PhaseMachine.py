@@ -0,0 +1,44 @@
+"""A table-driven state machine for routing messages by the phase something (e.g. a game) is in.
+
+Usage:
+
+1. Make a PhaseMachine(phases, initial, transitions), where phases maps each phase to {route: handler} and transitions maps each phase to the
+   phases it can go to. A route is whatever key the owner derives from a message, e.g. ("dm", "!submit").
+2. Register the owner's switchboard outputs once, and have them look up Handler(route) for every message.
+3. Enter(phase) on every phase change. Restore(phase) jumps straight to a phase, e.g. when rebuilding from a snapshot.
+
+Looking up a handler is a single dict lookup in the current phase's table, and a phase change swaps which table that is, so nothing is registered or
+removed with the switchboard as phases come and go. Entering a phase the current one can't go to raises ValueError.
+"""
+
+
+class PhaseMachine:
+    # Every phase reachable through transitions must be in phases, even if it handles nothing.
+    def __init__(self, phases, initial, transitions):
+        self.phases = {phase: dict(handlers) for phase, handlers in phases.items()}
+        self.transitions = {phase: frozenset(targets) for phase, targets in transitions.items()}
+        for phase, targets in self.transitions.items():
+            unknown = (targets | {phase}) - self.phases.keys()
+            if unknown:
+                raise ValueError("Unknown phases " + ", ".join(sorted(map(str, unknown))))
+        self.phase = None
+        self._handlers = {}
+        self.changes = 0
+        self.Restore(initial)
+
+    def Enter(self, phase):
+        if phase not in self.transitions.get(self.phase, ()):
+            raise ValueError("Can't go from phase {!r} to {!r}".format(self.phase, phase))
+        self.phase = phase
+        self._handlers = self.phases[phase]
+        self.changes += 1
+
+    def Restore(self, phase):
+        if phase not in self.phases:
+            raise ValueError("Unknown phase " + repr(phase))
+        self.phase = phase
+        self._handlers = self.phases[phase]
+
+    # The current phase's handler for route, or None.
+    def Handler(self, route):
+        return self._handlers.get(route)
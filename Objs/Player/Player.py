@@ -1,55 +1,143 @@
 from ..DiscordSwitchboard.DiscordSwitchboard import PriorityLevel
-import asyncio
+from array import array
+from collections import OrderedDict, deque
+import logging
+
+logger = logging.getLogger(__name__)
+
+INBOX_LIMIT = 8  # DMs a player can have waiting for their handlers before further ones are dropped
 
 # An object that manages PM interaction with the player of a card game, and holds their cards.
+# A DM only goes to the responses registered for its command (see AddResponse), and is passed on if there are none. DMs are handled one at a time,
+# in the order they arrived, by a single worker task per player that runs while the player's inbox isn't empty. The worker is started through the
+# switchboard's task supervisor, so it is cancelled along with the rest of the game's tasks.
+
+# The hand's rendered lines are cached, and only the ones a change to the hand invalidates are rendered again; a hand that hasn't changed since it
+# was last displayed isn't sent again. If hand_key is given, hands are sent with it as their Outbox key, so that a new hand edits the last one in
+# place where it can (see Outbox).
 
-# Takes immediate ownership of the PM channel
+# Takes immediate ownership of the PM channel, until Release. The hand is an array of card ids; see Deck.CardCatalog. Treat it as read-only from
+# outside, and change it with AddCards and GetCards, which keep the rendered hand up to date.
+
+# The switchboard only holds the player weakly, so a player its owner has let go of drops out of the switchboard by itself, along with its hand and
+# responses. owner labels the player's registration in the switchboard's LiveHandlers.
 class Player:
-    def __init__(self, user, switchboard, client):
+    def __init__(self, user, switchboard, client, outbox, hand_key=None, owner=None):
         self.user = user
         self.switchboard = switchboard
-        switchboard.RegisterOutput(self.on_message, PriorityLevel.PRIORITY, is_private=True, author_id=self.user.id)
-        self.hand = None
-        self.input_responses = {}
+        self.registrations = switchboard.Registrations("player-{}".format(user.id) if owner is None else owner)
+        self.registrations.RegisterOutput(self.on_message, PriorityLevel.PRIORITY, is_private=True, author_id=self.user.id, with_envelope=True,
+                                          weak=True)
+        self.hand = array('I')
+        self.hand_key = hand_key
+        self._lines = []  # Rendered lines for the start of the hand that hasn't changed since they were rendered
+        self._shown = None  # The hand as last displayed
+        self.input_responses = {}  # id -> (command, functor)
+        self._by_command = {}  # command (None for every DM) -> OrderedDict[id: functor]
         self.client = client
+        self.outbox = outbox
+        self.inbox = deque()  # (message, envelope, handlers)
+        self.worker = None
+        self.dropped = 0
     
-    def __del__(self):
-        for card in self.hand:
-            card.okay_to_delete = True
-    
-    # Add a hand query
+    # Add a hand query. functor is called as functor(message, envelope) with the DM's parsed MessageEnvelope, for the DMs whose command is command
+    # (e.g. "!submit"), or for every DM if command is None.
     
-    def AddResponse(self, id, functor, override=False):  # id can be whatever the caller wants, but should be unique
-        if not override and id in self.input_responses:
-            raise LookupException("This id already has a functor!")
-        self.input_responses[id] = functor
+    def AddResponse(self, id, functor, override=False, command=None):  # id can be whatever the caller wants, but should be unique
+        if id in self.input_responses:
+            if not override:
+                raise LookupError("This id already has a functor!")
+            self.RemoveResponse(id)
+        if command is not None:
+            command = command.lower()
+        self.input_responses[id] = (command, functor)
+        self._by_command.setdefault(command, OrderedDict())[id] = functor
         
     def RemoveResponse(self, id):
-        del self.input_responses[id]
+        command, _ = self.input_responses.pop(id)
+        handlers = self._by_command[command]
+        del handlers[id]
+        if not handlers:
+            del self._by_command[command]
+
+    # Gives up the PM channel and drops every response, e.g. when the game is over. DMs already queued are still handled.
+    def Release(self):
+        self.registrations.Release()
+        self.input_responses.clear()
+        self._by_command.clear()
         
-    async def on_message(self, message):
-        for func in self.input_responses.values():
-             asyncio.run_coroutine_threadsafe(func(message), asyncio.get_event_loop())
+    # Passes (returns None) when nothing registered on this player wants the message, so that another game this user is in can take it.
+    # The handlers are picked now, in registration order, and run by the worker; a DM that arrives with the inbox full is dropped.
+    async def on_message(self, message, envelope):
+        handlers = []
+        if envelope.command is not None and envelope.command in self._by_command:
+            handlers.extend(self._by_command[envelope.command].values())
+        if None in self._by_command:
+            handlers.extend(self._by_command[None].values())
+        if not handlers:
+            return None
+        return self.Post(message, envelope, handlers)
+
+    # Queues a DM for handlers, each called as handler(message, envelope) by the worker, in order, so that the player's DMs are handled one at a
+    # time. Returns True, as the DM is taken even if the inbox is full and it's dropped.
+    def Post(self, message, envelope, handlers):
+        if len(self.inbox) >= INBOX_LIMIT:
+            self.dropped += 1
+            return True
+        self.inbox.append((message, envelope, handlers))
+        if self.worker is None:
+            self.worker = self.switchboard.tasks.Spawn(self._Drain())
         return True
+
+    async def _Drain(self):
+        try:
+            while self.inbox:
+                message, envelope, handlers = self.inbox.popleft()
+                for func in handlers:
+                    try:
+                        await func(message, envelope)
+                    except Exception:
+                        logger.exception("Response to %s from %s failed", envelope.command, self.user.id)
+        finally:
+            self.worker = None
              
-    def DisplayHand(self):
-        card_list_string = "\n".join(str(x) + ": " + card.description for x, card in enumerate(self.hand))
-        self.SendMessage("Your Hand:\n" + card_list_string)
+    # catalog is the CardCatalog the hand's card ids come from. Does nothing if the hand is just as it was last displayed, unless force is True.
+    def DisplayHand(self, catalog, force=False):
+        lines = self._lines
+        for x in range(len(lines), len(self.hand)):
+            lines.append(str(x) + ": " + catalog.Description(self.hand[x]))
+        text = "Your Hand:\n" + "\n".join(lines)
+        if text == self._shown and not force:
+            return
+        self._shown = text
+        self.outbox.Send(self.user, text, self.hand_key)
     
     def SendMessage(self, message):
-        asyncio.run_coroutine_threadsafe(
-            self.client.send_message(self.user, message),
-            asyncio.get_event_loop())
+        self.outbox.Send(self.user, message)
     
-    # Removes and returns a set of cards from the player's hand.
+    # (user id, name, hand) for snapshots. The user itself and the responses are the game's to restore.
+    def GetState(self):
+        return (self.user.id, self.user.name, self.hand.tobytes())
+
+    def SetState(self, state):
+        self.hand = array('I', state[2])
+        self._lines = []
+        self._shown = None
+
+    def AddCards(self, card_ids):
+        self.hand.extend(card_ids)
+
+    # Removes and returns a set of cards (given by their positions in the hand) from the player's hand.
     def GetCards(self, card_set):
-        removed_cards = []
-        new_hand = []
-        for x, card in enumerate(self.hand):
+        removed_cards = array('I')
+        new_hand = array('I')
+        for x, card_id in enumerate(self.hand):
             if x in card_set:
-                card_set.remove(x)
-                removed_cards.append(self.hand[x])
+                removed_cards.append(card_id)
             else:
-                new_hand.append(self.hand[x])
+                new_hand.append(card_id)
         self.hand = new_hand
-        return removed_cards
\ No newline at end of file
+        # The cards before the first one removed keep their positions, so their lines are still good.
+        if card_set:
+            del self._lines[min(card_set):]
+        return removed_cards
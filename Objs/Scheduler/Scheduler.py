@@ -0,0 +1,133 @@
+"""Deadlines for many concurrent timers (e.g. every game's turn timeout) from a single heap and a single event loop timer.
+
+Usage:
+
+1. Make one DeadlineScheduler and share it. Start() it from within the event loop.
+2. timer = scheduler.Schedule(delay, callback, *args) calls callback(*args) on the event loop thread once delay seconds have passed.
+   timer.Cancel() stops it; Reschedule(timer, delay) moves it, returning the timer to hold onto from then on.
+3. Callbacks are plain functions and should be quick. A callback that raises is logged and doesn't affect the other timers.
+
+Scheduling and cancelling are O(log n) and O(1): cancelled timers are just marked and are dropped when they reach the top of the heap, or all at once
+when they come to outnumber the live ones. However many timers there are, only the earliest is ever handed to the event loop.
+
+The clock can be injected. To drive the scheduler by hand (e.g. in a test, with a fake clock), don't Start it; advance the clock and call RunDue.
+"""
+from heapq import heappush, heappop, heapify
+from itertools import count
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+COMPACT_MINIMUM = 64  # Cancelled timers tolerated in the heap before it's worth compacting
+
+
+class Timer:
+    __slots__ = ("scheduler", "when", "callback", "args", "cancelled")
+
+    def __init__(self, scheduler, when, callback, args):
+        self.scheduler = scheduler
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def Cancel(self):
+        self.scheduler.Cancel(self)
+
+
+class DeadlineScheduler:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []  # (when, sequence number, Timer). The sequence number keeps timers due at the same time in the order they were scheduled.
+        self._sequence = count()
+        self._cancelled = 0  # Cancelled timers still in the heap
+        self._running = False
+        self._handle = None  # The event loop timer for the earliest deadline, while running
+        self._armed_at = None
+        self.fired = 0
+
+    def __len__(self):  # Timers still pending
+        return len(self._heap) - self._cancelled
+
+    def Schedule(self, delay, callback, *args):
+        timer = Timer(self, self.clock() + delay, callback, args)
+        heappush(self._heap, (timer.when, next(self._sequence), timer))
+        if self._running and (self._armed_at is None or timer.when < self._armed_at):
+            self._Arm()
+        return timer
+
+    # Does nothing if the timer has already fired or been cancelled.
+    def Cancel(self, timer):
+        if timer.cancelled:
+            return
+        timer.cancelled = True
+        timer.callback = timer.args = None  # Let go of whatever the callback holds onto straight away.
+        self._cancelled += 1
+        if self._cancelled > COMPACT_MINIMUM and self._cancelled * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapify(self._heap)
+            self._cancelled = 0
+
+    def Reschedule(self, timer, delay):
+        callback, args = timer.callback, timer.args
+        self.Cancel(timer)
+        return self.Schedule(delay, callback, *args)
+
+    # The time the earliest pending timer is due, or None.
+    def NextDeadline(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heappop(self._heap)
+            self._cancelled -= 1
+        return self._heap[0][0] if self._heap else None
+
+    # Fires every timer that is due, in deadline order, and returns how many fired.
+    def RunDue(self):
+        fired = 0
+        while True:
+            when = self.NextDeadline()
+            if when is None or when > self.clock():
+                break
+            timer = heappop(self._heap)[2]
+            callback, args = timer.callback, timer.args
+            # A fired timer counts as cancelled, so that cancelling it later is harmless.
+            timer.cancelled = True
+            timer.callback = timer.args = None
+            fired += 1
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("Timer callback %r failed", callback)
+        self.fired += fired
+        return fired
+
+    def _Arm(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            self._armed_at = None
+        when = self.NextDeadline()
+        if when is None:
+            return
+        self._armed_at = when
+        self._handle = asyncio.get_event_loop().call_later(max(0, when - self.clock()), self._Fire)
+
+    def _Fire(self):
+        self._handle = None
+        self._armed_at = None
+        self.RunDue()
+        if self._running:
+            self._Arm()
+
+    def Start(self):
+        if not self._running:
+            self._running = True
+            self._Arm()
+
+    def Stop(self):
+        self._running = False
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            self._armed_at = None
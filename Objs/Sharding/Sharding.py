@@ -0,0 +1,310 @@
+"""Runs games in a pool of worker processes, behind one gateway process that owns the discord connection.
+
+Usage:
+
+1. Write a host factory: a module-level function factory(shard, client, outbox) returning an object with a root DiscordSwitchboard as .switchboard and
+   async on_ready(), on_message(message) and Shutdown() methods (e.g. a Cardsbot). Workers are started with the "spawn" method, so the factory must be
+   importable by name and nothing else is inherited from the gateway. The host can also have a ChannelInfo() method returning {channel id:
+   picklable info} about the channels it has something going on in (e.g. a game); the gateway keeps the latest of it in .channels, e.g. for its
+   admission control.
+2. In the gateway, make a ShardGateway(shard_count, factory, bot_user, deliver) and Start() it from within the event loop, then hand every message to
+   Route. deliver(kind, destination id, name, content, key) is called on the event loop for every message a worker sends; kind is "channel" or
+   "user", and key is the key it was sent with (see Outbox), which must be picklable.
+3. await Stop() to shut the workers down cleanly; each gets to run its host's Shutdown first.
+
+Channel messages go to the worker their channel id hashes to (see ShardFor), so a game always lives on the same worker. DMs go to whichever workers
+route their author into a game, which workers report as it changes (derived from the author index of their root switchboard); DMs from anyone else
+go to shard 0, so that bot commands sent by DM are answered exactly once. Channel info is reported along with them, whenever the root switchboard's
+routes change.
+
+Everything crosses the process boundary as small tuples: PackMessage keeps only what the game code reads from a message, and workers see
+RemoteMessage/RemoteUser/RemoteChannel stand-ins built from them. A worker that dies is restarted within SUPERVISE_INTERVAL (a host with persistence
+picks its games back up when it starts), and the gateway's connection is unaffected. The restarted worker gets a new inbound queue, as the dead one
+may have died holding the old one's lock, so messages routed to a worker between its death and its restart are lost.
+"""
+from collections import namedtuple
+from functools import partial
+import asyncio
+import logging
+import multiprocessing
+import zlib
+
+logger = logging.getLogger(__name__)
+
+SUPERVISE_INTERVAL = 1.0  # Seconds between checks that every worker is alive
+STOP_TIMEOUT = 30  # Seconds a worker gets to shut down before it is terminated
+DEFAULT_SHARD = 0  # Where DMs from users no worker has claimed go
+
+
+def ShardFor(channel_id, shard_count):
+    return zlib.crc32(str(channel_id).encode()) % shard_count
+
+
+# (content, author id, author name, channel id, is private, mentioned user ids)
+# The last field is whether the author may manage the channel (see ManagesChannel), as only the gateway has the real channel to ask.
+def PackMessage(message):
+    return (message.content, message.author.id, message.author.name, message.channel.id, bool(message.channel.is_private),
+            tuple(user.id for user in message.mentions), ManagesChannel(message))
+
+
+def ManagesChannel(message):
+    if message.channel.is_private:
+        return False
+    return bool(message.channel.permissions_for(message.author).manage_channels)
+
+
+Permissions = namedtuple("Permissions", ["manage_channels"])
+
+
+class RemoteUser:
+    __slots__ = ("id", "name")
+
+    def __init__(self, id, name=None):
+        self.id = id
+        self.name = name
+
+
+# managers are the ids of the users known to be allowed to manage the channel: the author of the message it came with, if they are.
+class RemoteChannel:
+    __slots__ = ("id", "is_private", "managers")
+
+    def __init__(self, id, is_private=False, managers=()):
+        self.id = id
+        self.is_private = is_private
+        self.managers = managers
+
+    def permissions_for(self, member):
+        return Permissions(member.id in self.managers)
+
+
+class RemoteMessage:
+    __slots__ = ("content", "author", "channel", "mentions")
+
+    def __init__(self, content, author, channel, mentions):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.mentions = mentions
+
+
+def UnpackMessage(packed):
+    content, author_id, author_name, channel_id, is_private, mention_ids, manages = packed
+    return RemoteMessage(content, RemoteUser(author_id, author_name), RemoteChannel(channel_id, is_private, (author_id,) if manages else ()),
+                         [RemoteUser(user_id) for user_id in mention_ids])
+
+
+# The parts of a discord client that hosts use, for a worker. Users and channels are only ever looked up by id.
+class RemoteClient:
+    def __init__(self, user):
+        self.user = user
+
+    def get_channel(self, channel_id):
+        return RemoteChannel(channel_id)
+
+    def get_all_members(self):
+        return ()
+
+    async def logout(self):
+        pass
+
+
+# Stands in for an Outbox in a worker: every message is passed to the gateway, whose Outbox does the pacing and coalescing for all the workers.
+# Destinations with an is_private attribute are channels, anything else is a user.
+class ShardOutbox:
+    def __init__(self, queue, shard):
+        self.queue = queue
+        self.shard = shard
+        self.sends = 0
+        self.failed = 0
+        self.replaced = 0
+        self.edits = 0
+
+    def Send(self, destination, content, key=None):
+        kind = "user" if getattr(destination, "is_private", None) is None else "channel"
+        self.queue.put(("send", self.shard, kind, destination.id, getattr(destination, "name", None), content, key))
+        self.sends += 1
+
+    async def Flush(self):
+        pass
+
+    def GetStats(self):
+        return {"queued": 0, "max_queue_depth": 0, "destinations": 0, "enqueued": self.sends, "delivered": self.sends, "sends": self.sends,
+                "failed": self.failed, "replaced": self.replaced, "edits": self.edits}
+
+
+# The worker process: runs the host on its own event loop until it is told to stop.
+def RunWorker(shard, inbound, outbound, host_factory, bot_user):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_Work(shard, inbound, outbound, host_factory, bot_user))
+    finally:
+        loop.close()
+
+
+async def _Work(shard, inbound, outbound, host_factory, bot_user):
+    loop = asyncio.get_event_loop()
+    host = host_factory(shard, RemoteClient(RemoteUser(*bot_user)), ShardOutbox(outbound, shard))
+    await host.on_ready()
+    routes = _RouteReporter(shard, outbound, host)
+    routes.Report()
+    pending = set()
+    while True:
+        packed = await loop.run_in_executor(None, inbound.get)
+        if packed is None:
+            break
+        task = asyncio.ensure_future(host.on_message(UnpackMessage(packed)))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        task.add_done_callback(routes.Done)
+    if pending:
+        await asyncio.wait(pending)
+    await host.Shutdown()
+    routes.Report()
+    outbound.put(("stopped", shard))
+
+
+# Tells the gateway whose DMs the worker wants, and the host's channel info, whenever that changes.
+class _RouteReporter:
+    def __init__(self, shard, outbound, host):
+        self.shard = shard
+        self.outbound = outbound
+        self.host = host
+        self.authors = frozenset()
+        self.channels = {}
+        self.version = None
+
+    def Report(self):
+        relay = self.host.switchboard.priority_relay
+        if relay.version == self.version:
+            return
+        self.version = relay.version
+        authors = frozenset(relay.Authors())
+        if authors != self.authors:
+            self.outbound.put(("routes", self.shard, tuple(authors - self.authors), tuple(self.authors - authors)))
+            self.authors = authors
+        channel_info = getattr(self.host, "ChannelInfo", None)
+        if channel_info is None:
+            return
+        channels = channel_info()
+        changed = tuple((channel_id, info) for channel_id, info in channels.items() if self.channels.get(channel_id) != info)
+        removed = tuple(channel_id for channel_id in self.channels if channel_id not in channels)
+        if changed or removed:
+            self.outbound.put(("channels", self.shard, changed, removed))
+            self.channels = channels
+
+    def Done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Handling a message failed", exc_info=task.exception())
+        self.Report()
+
+
+class ShardGateway:
+    def __init__(self, shard_count, host_factory, bot_user, deliver):
+        self.shard_count = shard_count
+        self.host_factory = host_factory
+        self.bot_user = bot_user  # (id, name)
+        self.deliver = deliver
+        self.context = multiprocessing.get_context("spawn")
+        self.inbound = [self.context.Queue() for _ in range(shard_count)]
+        self.outbound = self.context.Queue()
+        self.processes = [None] * shard_count
+        self.routes = {}  # author id -> set of shards that want their DMs
+        self.channels = {}  # channel id -> the info its shard's host last reported for it (see ChannelInfo in the module docstring)
+        self.restarts = 0
+        self._stopping = False
+        self._stopped = set()
+        self._tasks = []
+
+    def Start(self):
+        for shard in range(self.shard_count):
+            self._Spawn(shard)
+        self._tasks = [asyncio.ensure_future(self._Read()), asyncio.ensure_future(self._Supervise())]
+
+    def _Spawn(self, shard):
+        process = self.context.Process(target=RunWorker, name="CardsbotShard-{}".format(shard), daemon=True,
+                                       args=(shard, self.inbound[shard], self.outbound, self.host_factory, self.bot_user))
+        process.start()
+        self.processes[shard] = process
+
+    # The shards a message should go to.
+    def ShardsFor(self, message):
+        if message.channel.is_private:
+            return self.routes.get(message.author.id) or (DEFAULT_SHARD,)
+        return (ShardFor(message.channel.id, self.shard_count),)
+
+    def Route(self, message):
+        packed = PackMessage(message)
+        for shard in self.ShardsFor(message):
+            self.inbound[shard].put(packed)
+
+    async def _Read(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await loop.run_in_executor(None, self.outbound.get)
+            if item is None:
+                return
+            kind = item[0]
+            if kind == "send":
+                try:
+                    self.deliver(*item[2:])
+                except Exception:
+                    logger.exception("Couldn't deliver a message from shard %d", item[1])
+            elif kind == "routes":
+                self._UpdateRoutes(item[1], item[2], item[3])
+            elif kind == "channels":
+                self.channels.update(item[2])
+                for channel_id in item[3]:
+                    self.channels.pop(channel_id, None)
+            elif kind == "stopped":
+                self._stopped.add(item[1])
+
+    def _UpdateRoutes(self, shard, added, removed):
+        for author_id in added:
+            self.routes.setdefault(author_id, set()).add(shard)
+        for author_id in removed:
+            shards = self.routes.get(author_id)
+            if shards is not None:
+                shards.discard(shard)
+                if not shards:
+                    del self.routes[author_id]
+
+    # A worker that is restarted reports all its routes and channels again, so the ones it had are dropped first.
+    def _ForgetShard(self, shard):
+        for author_id in [author_id for author_id, shards in self.routes.items() if shard in shards]:
+            self._UpdateRoutes(shard, (), (author_id,))
+        for channel_id in [channel_id for channel_id in self.channels if ShardFor(channel_id, self.shard_count) == shard]:
+            del self.channels[channel_id]
+
+    async def _Supervise(self):
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            if self._stopping:
+                return
+            for shard, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error("Shard %d exited with code %s; restarting it", shard, process.exitcode)
+                    self._ForgetShard(shard)
+                    self.restarts += 1
+                    self.inbound[shard] = self.context.Queue()
+                    self._Spawn(shard)
+
+    async def Stop(self, timeout=STOP_TIMEOUT):
+        self._stopping = True
+        for queue in self.inbound:
+            queue.put(None)
+        loop = asyncio.get_event_loop()
+        waited = 0
+        while len(self._stopped) < self.shard_count and waited < timeout:
+            await asyncio.sleep(0.1)
+            waited += 0.1
+        for shard, process in enumerate(self.processes):
+            await loop.run_in_executor(None, partial(process.join, 1 if shard in self._stopped else 0))
+            if process.is_alive():
+                logger.error("Shard %d didn't stop in time; terminating it", shard)
+                process.terminate()
+        self.outbound.put(None)
+        for task in self._tasks:
+            if not task.done():
+                await asyncio.wait([task], timeout=1)
+                task.cancel()
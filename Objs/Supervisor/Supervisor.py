@@ -0,0 +1,124 @@
+"""Tracks the tasks a subsystem starts, so that none of them is fire-and-forget: failures are logged, concurrency can be capped, and everything still
+running can be cancelled at once when the subsystem goes away.
+
+Usage:
+
+1. Make a root TaskSupervisor, and a Child of it for each part of the program with a lifetime of its own (e.g. one per game).
+2. Start tasks with supervisor.Spawn(coroutine) instead of asyncio.ensure_future. Give limits (kind -> most tasks of that kind running at once) and
+   pass kind to Spawn to cap a kind of task; tasks over the cap wait their turn, in order.
+3. Close() a child when its part of the program is done with: its tasks, and its children's, are cancelled.
+
+A task that raises is logged with the name of its supervisor and counted. Stats() gives in-flight, waiting, failed and cancelled task counts for a
+supervisor and everything under it. Everything here is meant to be used from the event loop thread.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _CurrentTask():
+    try:
+        return asyncio.current_task()
+    except AttributeError:  # Python < 3.7
+        return asyncio.Task.current_task()
+    except RuntimeError:  # No running loop
+        return None
+
+
+class TaskSupervisor:
+    def __init__(self, name="root", limits=None, parent=None):
+        self.name = name
+        self.limits = {} if limits is None else dict(limits)
+        self.parent = parent
+        self.children = set()
+        self.tasks = set()
+        self.waiting = 0  # Tasks waiting for a slot under their kind's limit
+        self.errors = 0
+        self.cancelled = 0
+        self._semaphores = {}  # kind -> Semaphore, made on first use so that it belongs to the running loop
+
+    # A supervisor for part of this one's work. It has the same limits unless it's given its own, which apply to its tasks alone.
+    def Child(self, name, limits=None):
+        child = TaskSupervisor(self.name + "/" + name, self.limits if limits is None else limits, self)
+        self.children.add(child)
+        return child
+
+    def Spawn(self, coroutine, kind=None):
+        limit = self.limits.get(kind)
+        if limit is not None:
+            coroutine = self._Limited(coroutine, kind, limit)
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self._Done)
+        return task
+
+    async def _Limited(self, coroutine, kind, limit):
+        semaphore = self._semaphores.get(kind)
+        if semaphore is None:
+            semaphore = self._semaphores[kind] = asyncio.Semaphore(limit)
+        self.waiting += 1
+        try:
+            await semaphore.acquire()
+        except BaseException:
+            coroutine.close()  # Cancelled before it started.
+            raise
+        finally:
+            self.waiting -= 1
+        try:
+            return await coroutine
+        finally:
+            semaphore.release()
+
+    def _Done(self, task):
+        self.tasks.discard(task)
+        if task.cancelled():
+            self.cancelled += 1
+            return
+        exception = task.exception()
+        if exception is not None:
+            self.errors += 1
+            logger.error("A task of %s failed", self.name, exc_info=exception)
+
+    # Cancels every task of this supervisor and its children, except the one calling it. Returns how many were cancelled.
+    def Cancel(self):
+        current = _CurrentTask()
+        cancelled = 0
+        for task in list(self.tasks):
+            if task is not current and task.cancel():
+                cancelled += 1
+        for child in list(self.children):
+            cancelled += child.Cancel()
+        return cancelled
+
+    # Cancels everything and detaches from the parent, which keeps this supervisor's counts in its own.
+    def Close(self):
+        cancelled = self.Cancel()
+        if self.parent is not None and self in self.parent.children:
+            self.parent.children.discard(self)
+            self.parent.errors += self.errors
+            self.parent.cancelled += self.cancelled + cancelled
+        return cancelled
+
+    # Waits for every task of this supervisor and its children to finish, for up to timeout seconds. Returns True if they all did.
+    async def Join(self, timeout=None):
+        current = _CurrentTask()
+        tasks = [task for task in self._AllTasks() if task is not current]
+        if not tasks:
+            return True
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        return not pending
+
+    def _AllTasks(self):
+        tasks = list(self.tasks)
+        for child in self.children:
+            tasks.extend(child._AllTasks())
+        return tasks
+
+    def Stats(self):
+        stats = {"in_flight": len(self.tasks), "waiting": self.waiting, "errors": self.errors, "cancelled": self.cancelled,
+                 "supervisors": 1}
+        for child in self.children:
+            for key, value in child.Stats().items():
+                stats[key] += value
+        return stats
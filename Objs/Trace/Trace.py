@@ -0,0 +1,77 @@
+"""Recording of the messages a bot receives and sends, so that a busy stretch of real traffic can be replayed offline (see Benchmarks/Replay.py).
+
+Usage:
+
+1. Make a TraceRecorder(path, seed, bot_user) when the bot connects, where seed is the seed every game's seed is drawn from and bot_user is the
+   bot's (id, name). Wrap the outbox every game sends through in a TracedOutbox(outbox, recorder) before any game is made.
+2. Call recorder.RecordMessage(message) for every message the bot receives, before handling it.
+3. Close() the recorder on shutdown.
+
+A trace is a text file of JSON lists, one per line. The first line is the header, {"version", "seed", "bot_user"}; then come, in order,
+["in", t, content, author id, author name, channel id, is private, [mentioned user ids], author manages the channel] for each message received, ["out", t, destination id,
+content] for each message sent (as handed to the outbox, before any coalescing), and finally ["end", t]. t is in seconds since the recording started.
+
+A replay only matches the recording if the bot started without any live games, from the same card packs and with the same code; replaying against
+a newer version of the code is how a change in behavior is caught.
+"""
+import json
+import time
+
+from ..Sharding.Sharding import PackMessage
+
+TRACE_VERSION = 1
+
+
+# Reads a trace written by a TraceRecorder. Returns (header, records), the records being the lists after the header.
+def ReadTrace(path):
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get("version") != TRACE_VERSION:
+            raise ValueError("Unsupported trace version " + str(header.get("version")))
+        return header, [json.loads(line) for line in f if line.strip()]
+
+
+class TraceRecorder:
+    def __init__(self, path, seed, bot_user, clock=time.monotonic):
+        self.path = path
+        self.clock = clock
+        self.start = clock()
+        self.file = open(path, "w")
+        self.messages = 0
+        self.sends = 0
+        self._Write({"version": TRACE_VERSION, "seed": seed, "bot_user": list(bot_user)})
+
+    def _Write(self, record):
+        self.file.write(json.dumps(record, separators=(",", ":")))
+        self.file.write("\n")
+
+    def _Time(self):
+        return round(self.clock() - self.start, 6)
+
+    def RecordMessage(self, message):
+        content, author_id, author_name, channel_id, is_private, mention_ids, manages = PackMessage(message)
+        self._Write(["in", self._Time(), content, author_id, author_name, channel_id, is_private, list(mention_ids), manages])
+        self.messages += 1
+
+    def RecordSend(self, destination, content):
+        self._Write(["out", self._Time(), destination.id, content])
+        self.sends += 1
+
+    def Close(self):
+        if not self.file.closed:
+            self._Write(["end", self._Time()])
+            self.file.close()
+
+
+# Passes everything through to outbox, recording each message sent on the way.
+class TracedOutbox:
+    def __init__(self, outbox, recorder):
+        self.outbox = outbox
+        self.recorder = recorder
+
+    def Send(self, destination, content, key=None):
+        self.recorder.RecordSend(destination, content)
+        self.outbox.Send(destination, content, key)
+
+    def __getattr__(self, name):
+        return getattr(self.outbox, name)